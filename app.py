@@ -1,9 +1,10 @@
 import sys
 import os, re
+import time
 # Add the current directory to the Python path
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
 from dotenv import load_dotenv
@@ -12,12 +13,12 @@ from flask_migrate import Migrate
 from datetime import datetime
 import numpy as np
 import googlemaps
-from openai import OpenAI
 
 
 
 # Import extensions
-from extensions import db, ma, bcrypt, migrate, get_embeddings,select_relevant_few_shots,contains_sensitive_info,contains_data_altering_operations
+from extensions import db, ma, bcrypt, migrate, get_embeddings,select_relevant_few_shots,contains_sensitive_info,contains_data_altering_operations,embedding_cache,query_result_cache,geocode_cache,coordinate_resolver,query_metrics,init_readonly_engine,spatial_index
+from observability import logger, metrics, record_http_request, request_id_var, trace_var, new_request_id
 from model.user import User, user_schema
 from blueprints.user_bp import user_bp
 from blueprints.chat_bp import chat_bp,generate_sql_query,format_response_with_gpt
@@ -41,6 +42,15 @@ app.config['SQLALCHEMY_BINDS'] = {
 }
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
+# Pooled read-only engine used for the generated TestingData queries
+init_readonly_engine(DB_CONFIG_TEST)
+
+# Load the spatial index now rather than on the first distance question; it is rebuilt when the data changes
+try:
+    spatial_index.refresh()
+except Exception as e:
+    logger.warning("Spatial index not loaded: %s", e)
+
 # Initialize CORS
 CORS(app)
 
@@ -54,8 +64,6 @@ migrate_main = Migrate(app, db, directory='migrations')
 # Initialize Flask-Migrate for the test database
 migrate_test = Migrate(app, db, directory='migrations_test')
 
-#Initialize OpenAI client
-client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
 # Initialize Google Maps client
 # gmaps = googlemaps.Client(key=os.getenv('GOOGLE_MAPS_API_KEY'))
 
@@ -73,5 +81,40 @@ def home():
     )
 
 
+@app.before_request
+def start_request():
+    # The request ID of the client is kept so that its logs can be matched with ours
+    g.request_id = request.headers.get('X-Request-ID') or new_request_id()
+    g.request_started = time.perf_counter()
+    request_id_var.set(g.request_id)
+    trace_var.set(None)
+
+
+@app.after_request
+def finish_request(response):
+    if 'request_id' not in g:
+        return response
+    response.headers['X-Request-ID'] = g.request_id
+    # Streamed responses are measured until their headers are sent
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    record_http_request(endpoint, request.method, response.status_code, time.perf_counter() - g.request_started)
+    return response
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/cache/stats')
+def cache_stats():
+    return jsonify({"embeddings": embedding_cache.stats(), "query_results": query_result_cache.stats(), "geocodes": geocode_cache.stats(), "coordinates": coordinate_resolver.stats()}), 200
+
+
+@app.route('/db/stats')
+def db_stats():
+    return jsonify({"testing_data": query_metrics.stats()}), 200
+
+
 if __name__ == '__main__':
     app.run(debug=True)
@@ -0,0 +1,396 @@
+"""
+End-to-end benchmark of /chat/ask.
+
+Everything runs locally: the main database, the TestingData database (SQLite unless --testing-db is given), the Chroma
+directory and the cache database live in a temporary directory, the model provider is the deterministic fake one with
+injected latency, and Google Maps is replaced by a fake geocoder with its own latency. A corpus of questions covering
+the table, chart, heatmap, map and PDF paths is replayed at the requested concurrency.
+
+Run from the repository root:
+
+    python benchmarks/ask_benchmark.py --requests 200 --concurrency 8 --save-baseline baseline.json
+    python benchmarks/ask_benchmark.py --requests 200 --concurrency 8 --baseline baseline.json
+
+The report gives p50/p95/p99 latencies, throughput, the latency of each path and the time spent in each stage, as
+reported by the Server-Timing header. With --baseline, every metric is compared to a saved run and the script exits
+with status 1 when one regressed by more than --tolerance.
+"""
+import argparse
+import hashlib
+import itertools
+import json
+import logging
+import os
+import random
+import re
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Files the application reads from its working directory
+WORKDIR_FILES = ['db_schema_prompt.txt', 'chart_code.txt', 'map_code.txt', 'heat_code.txt']
+
+PDF_DOC_ID = 'benchmark-doc'
+
+CORPUS = [
+    {"path": "table", "question": "List the names and cities of ten restaurants",
+     "answer": {"Score": 10, "Executable": "Yes", "Answer": 'SELECT "Name", "City" FROM restaurants LIMIT 10', "Location": "No", "ChartName": "None"}},
+    {"path": "table", "question": "Show every restaurant with a high price",
+     "answer": {"Score": 10, "Executable": "Yes", "Answer": 'SELECT "Name", "City", "Price" FROM restaurants WHERE "Price" = \'High\'', "Location": "No", "ChartName": "None"}},
+    {"path": "table", "question": "What is the average overall rating of each restaurant?",
+     "answer": {"Score": 10, "Executable": "Yes", "Answer": 'SELECT r."Name", AVG(ra."Overall_Rating") FROM restaurants r JOIN ratings ra ON r."Restaurant_ID" = ra."Restaurant_ID" GROUP BY r."Name"', "Location": "No", "ChartName": "None"}},
+    {"path": "chart", "question": "Draw a bar chart of the number of restaurants per city",
+     "answer": {"Score": 10, "Executable": "Yes", "Answer": 'SELECT "City", COUNT(*) FROM restaurants GROUP BY "City"', "Location": "No", "ChartName": "BarChart"}},
+    {"path": "chart", "question": "Plot a line chart of the food rating of every restaurant",
+     "answer": {"Score": 10, "Executable": "Yes", "Answer": 'SELECT "Restaurant_ID", AVG("Food_Rating") FROM ratings GROUP BY "Restaurant_ID" ORDER BY "Restaurant_ID"', "Location": "No", "ChartName": "LineChart"}},
+    {"path": "chart", "question": "Show a pie chart of restaurants by price range",
+     "answer": {"Score": 10, "Executable": "Yes", "Answer": 'SELECT "Price", COUNT(*) FROM restaurants GROUP BY "Price"', "Location": "No", "ChartName": "PieChart"}},
+    {"path": "heatmap", "question": "Show a heatmap of restaurants by city and price",
+     "answer": {"Score": 10, "Executable": "Yes", "Answer": 'SELECT "City", "Price", COUNT(*) FROM restaurants GROUP BY "City", "Price"', "Location": "No", "ChartName": "HeatMap"}},
+    {"path": "map", "question": "Show the first restaurant on a map",
+     "answer": {"Score": 10, "Executable": "Yes", "Answer": 'SELECT "Name", "Latitude", "Longitude" FROM restaurants LIMIT 1', "Location": "Yes", "ChartName": "GoogleMaps"}},
+    {"path": "map", "question": "Where are the restaurants of zip codes 78000 to 78004?",
+     "answer": {"Score": 10, "Executable": "Yes", "Answer": 'SELECT "Zip_Code", "Country" FROM restaurants WHERE "Zip_Code" IN (\'78000\', \'78001\', \'78002\', \'78003\', \'78004\')', "Location": "Yes", "ChartName": "GoogleMaps"}},
+    {"path": "map", "question": "Draw the area between the first three restaurants",
+     "answer": {"Score": 10, "Executable": "Yes", "Answer": 'SELECT "Name", "Latitude", "Longitude" FROM restaurants LIMIT 3', "Location": "Yes", "ChartName": "TriangleMaps"}},
+    {"path": "pdf", "question": "What does the benchmark document say about opening hours?",
+     "answer": {"Score": 10, "Executable": "PDF", "Answer": PDF_DOC_ID, "Location": "No", "ChartName": "None"}},
+    {"path": "pdf", "question": "Summarize the menu section of the benchmark document",
+     "answer": {"Score": 10, "Executable": "PDF", "Answer": PDF_DOC_ID, "Location": "No", "ChartName": "None"}},
+]
+
+CITIES = ['San Luis Potosi', 'Cuernavaca', 'Ciudad Victoria', 'Jiutepec', 'Soledad']
+PRICES = ['Low', 'Medium', 'High']
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=200, help='Number of measured requests')
+    parser.add_argument('--warmup', type=int, default=12, help='Requests sent before measuring')
+    parser.add_argument('--concurrency', type=int, default=8, help='Number of concurrent clients')
+    parser.add_argument('--paths', nargs='+', default=sorted({entry["path"] for entry in CORPUS}), help='Paths of the corpus to replay')
+    parser.add_argument('--corpus', help='JSON file with the questions to replay, in the format of CORPUS')
+    parser.add_argument('--restaurants', type=int, default=500, help='Number of seeded restaurants')
+    parser.add_argument('--consumers', type=int, default=50, help='Number of seeded consumers, each rates ten restaurants')
+    parser.add_argument('--testing-db', help='URL of the TestingData database, a temporary SQLite file by default')
+    parser.add_argument('--llm-latency', type=float, default=0.3, help='Seconds before each fake completion')
+    parser.add_argument('--llm-jitter', type=float, default=0.2, help='Maximum extra seconds added to the completion latency')
+    parser.add_argument('--embedding-latency', type=float, default=0.05, help='Seconds per fake embedding request')
+    parser.add_argument('--geocode-latency', type=float, default=0.1, help='Seconds per fake geocoding request')
+    parser.add_argument('--response-mode', choices=['code', 'payload'], default='code')
+    parser.add_argument('--cold', action='store_true', help='Disable the SQL and query result caches')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the question order')
+    parser.add_argument('--keep', action='store_true', help='Keep the temporary directory')
+    parser.add_argument('--verbose', action='store_true', help='Show the logs of the application')
+    parser.add_argument('--save-baseline', help='Write the results to this JSON file')
+    parser.add_argument('--baseline', help='Compare the results to this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='Relative change of a metric counted as a regression')
+    return parser.parse_args()
+
+
+def prepare_environment(args, workdir, corpus):
+    """
+    Sets the environment read by the application at import time and moves to the working directory.
+    """
+    for name in WORKDIR_FILES:
+        shutil.copy(os.path.join(REPO, name), workdir)
+
+    rules_path = os.path.join(workdir, 'fake_responses.json')
+    with open(rules_path, 'w') as file:
+        json.dump([{"match": f"^{re.escape(entry['question'])}$", "json": True, "response": entry["answer"]} for entry in corpus], file)
+
+    os.environ.update({
+        'OPENAI_API_KEY': os.getenv('OPENAI_API_KEY', 'benchmark'),
+        'GOOGLE_MAPS_API_KEY': 'AIzaBenchmark',
+        'SECRET_KEY': 'benchmark',
+        'DB_CONFIG': f"sqlite:///{os.path.join(workdir, 'main.sqlite3')}",
+        'DB_CONFIG_TEST': args.testing_db or f"sqlite:///{os.path.join(workdir, 'testing.sqlite3')}",
+        'CACHE_DB_PATH': os.path.join(workdir, 'cache', 'cache.sqlite3'),
+        'ANONYMIZED_TELEMETRY': 'False',
+        'LLM_PROVIDER': 'fake',
+        'FAKE_LLM_RESPONSES': rules_path,
+        'FAKE_LLM_LATENCY': str(args.llm_latency),
+        'FAKE_LLM_JITTER': str(args.llm_jitter),
+        'FAKE_EMBEDDING_LATENCY': str(args.embedding_latency),
+        'FAKE_EMBEDDING_DIM': '256',
+    })
+    if not args.verbose:
+        os.environ['LOG_LEVEL'] = 'ERROR'
+        logging.getLogger('chromadb').setLevel(logging.ERROR)
+    if args.cold:
+        os.environ.update({'SQL_CACHE_ENABLED': 'false', 'QUERY_CACHE_TTL': '0'})
+
+    os.chdir(workdir)
+    sys.path.insert(0, REPO)
+
+    # extensions opens the few-shot collection without creating it
+    import chromadb
+    from chromadb.config import Settings
+    chromadb.PersistentClient(path="chroma_data", settings=Settings()).get_or_create_collection("few_shot")
+
+
+class FakeGeocoder:
+    """
+    Stand-in for googlemaps.Client that returns a deterministic location for every address.
+    """
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def geocode(self, address):
+        with self.lock:
+            self.calls += 1
+        time.sleep(self.latency)
+        digest = hashlib.sha256(address.encode('utf-8')).digest()
+        lat = 22.0 + digest[0] / 255
+        lng = -101.0 + digest[1] / 255
+        return [{"geometry": {"location": {"lat": lat, "lng": lng}}}]
+
+
+def seed(args, corpus):
+    """
+    Seeds the TestingData tables, the few-shot examples, a PDF document and the benchmark user.
+
+    Returns:
+    - tuple: The application, the ID of the benchmark user and its authorization header.
+    """
+    from app import app
+    from extensions import db, create_token, client_chroma, openai_ef, spatial_index
+    from providers import llm
+    from model.user import User
+    from model.test import Consumer, Rating, Restaurant
+
+    rng = random.Random(args.seed)
+    with app.app_context():
+        db.create_all()
+        if Restaurant.query.count() == 0:
+            for restaurant_id in range(args.restaurants):
+                db.session.add(Restaurant(
+                    Restaurant_ID=restaurant_id, Name=f"Restaurant {restaurant_id}", City=rng.choice(CITIES), State='SLP',
+                    Country='Mexico', Zip_Code=str(78000 + restaurant_id), Latitude=22.0 + rng.random(), Longitude=-101.0 + rng.random(),
+                    Price=rng.choice(PRICES)
+                ))
+            for consumer in range(args.consumers):
+                db.session.add(Consumer(Consumer_ID=f"U{consumer}", City=rng.choice(CITIES), Latitude=22.0 + rng.random(), Longitude=-101.0 + rng.random()))
+            db.session.flush()
+            for consumer in range(args.consumers):
+                for restaurant_id in rng.sample(range(args.restaurants), min(10, args.restaurants)):
+                    db.session.add(Rating(Consumer_ID=f"U{consumer}", Restaurant_ID=restaurant_id,
+                                          Overall_Rating=rng.randint(0, 2), Food_Rating=rng.randint(0, 2), Service_Rating=rng.randint(0, 2)))
+            db.session.commit()
+        spatial_index.refresh()
+
+        user = User('benchmark', 'benchmark@example.com', 'Benchmark1!', 'benchmark')
+        db.session.add(user)
+        db.session.commit()
+        user_id = user.id
+
+    # A few examples in the main collection so that the few-shot retrieval has something to rank
+    examples = [entry for entry in corpus if entry["path"] != "pdf"]
+    client_chroma.get_collection("few_shot", embedding_function=openai_ef).add(
+        ids=[f"example{index}" for index in range(len(examples))],
+        documents=[entry["question"] for entry in examples],
+        metadatas=[{"Question": entry["question"], **entry["answer"]} for entry in examples]
+    )
+
+    # One chunk per PDF question, embedded like the question so that it is retrieved
+    pdf_questions = [entry["question"] for entry in corpus if entry["path"] == "pdf"]
+    if pdf_questions:
+        client_chroma.get_or_create_collection(name=f"user_{user_id}_pdfs", embedding_function=openai_ef).add(
+            ids=[f"{PDF_DOC_ID}_chunk{number}" for number in range(len(pdf_questions))],
+            embeddings=llm.embed(pdf_questions),
+            metadatas=[{'filename': 'benchmark.pdf', 'doc_id': PDF_DOC_ID, 'pdf_title': 'Benchmark document',
+                        'description': 'Opening hours and menu of the benchmark restaurants.', 'chunk_number': number,
+                        'chunk_text': f"Section {number}: the restaurants open at 9am and serve a seasonal menu."}
+                       for number in range(len(pdf_questions))]
+        )
+
+    with app.app_context():
+        token = create_token(user_id)
+    return app, user_id, {'Authorization': f"Bearer {token}"}
+
+
+def parse_server_timing(header):
+    stages = {}
+    for part in (header or "").split(","):
+        match = re.match(r'\s*([^;]+);dur=([0-9.]+)', part)
+        if match:
+            stages[match.group(1)] = float(match.group(2))
+    return stages
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def run(args, app, user_id, headers, corpus):
+    """
+    Replays the corpus and measures each request.
+
+    Returns:
+    - tuple: The samples and the wall-clock duration of the measured requests in seconds.
+    """
+    from extensions import db
+    from model.chat import Chat
+
+    # One chat per client so that the history of a chat grows like in a real session
+    with app.app_context():
+        chats = [Chat(f"benchmark {index}", user_id) for index in range(args.concurrency)]
+        db.session.add_all(chats)
+        db.session.commit()
+        chat_ids = [chat.id for chat in chats]
+
+    rng = random.Random(args.seed)
+    schedule = [rng.choice(corpus) for _ in range(args.warmup + args.requests)]
+    local = threading.local()
+    clients = itertools.count()
+
+    def send(entry):
+        if not hasattr(local, 'client'):
+            local.client = app.test_client()
+            local.chat_id = chat_ids[next(clients) % len(chat_ids)]
+        start = time.perf_counter()
+        response = local.client.post('/chat/ask', headers=headers, json={
+            'question': entry['question'], 'chat_id': local.chat_id, 'response_mode': args.response_mode
+        })
+        elapsed = (time.perf_counter() - start) * 1000
+        return {
+            "path": entry["path"],
+            "status": response.status_code,
+            "ms": elapsed,
+            "stages": parse_server_timing(response.headers.get('Server-Timing'))
+        }
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(send, schedule[:args.warmup]))
+        started = time.perf_counter()
+        samples = list(pool.map(send, schedule[args.warmup:]))
+        wall = time.perf_counter() - started
+    return samples, wall
+
+
+def summarize(samples, wall):
+    ok = [sample for sample in samples if sample["status"] < 500]
+    latencies = [sample["ms"] for sample in ok]
+    summary = {
+        "requests": len(samples),
+        "errors": len(samples) - len(ok),
+        "throughput": len(ok) / wall if wall else 0.0,
+        "p50": percentile(latencies, 0.50),
+        "p95": percentile(latencies, 0.95),
+        "p99": percentile(latencies, 0.99),
+        "paths": {},
+        "stages": {}
+    }
+    for path in sorted({sample["path"] for sample in ok}):
+        values = [sample["ms"] for sample in ok if sample["path"] == path]
+        summary["paths"][path] = {"count": len(values), "p50": percentile(values, 0.50), "p95": percentile(values, 0.95)}
+    stage_names = sorted({name for sample in ok for name in sample["stages"] if name != "total"})
+    for name in stage_names:
+        values = [sample["stages"][name] for sample in ok if name in sample["stages"]]
+        summary["stages"][name] = {"count": len(values), "mean": statistics.fmean(values), "p95": percentile(values, 0.95)}
+    return summary
+
+
+def print_report(summary):
+    print(f"\nrequests {summary['requests']}  errors {summary['errors']}  throughput {summary['throughput']:.2f} req/s")
+    print(f"latency p50 {summary['p50']:.1f} ms  p95 {summary['p95']:.1f} ms  p99 {summary['p99']:.1f} ms")
+    print(f"\n{'path':<10} {'count':>6} {'p50 ms':>9} {'p95 ms':>9}")
+    for path, values in summary["paths"].items():
+        print(f"{path:<10} {values['count']:>6} {values['p50']:>9.1f} {values['p95']:>9.1f}")
+    print(f"\n{'stage':<22} {'count':>6} {'mean ms':>9} {'p95 ms':>9}")
+    for name, values in sorted(summary["stages"].items(), key=lambda item: -item[1]["mean"]):
+        print(f"{name:<22} {values['count']:>6} {values['mean']:>9.1f} {values['p95']:>9.1f}")
+
+
+def compare(summary, baseline, tolerance):
+    """
+    Prints the change of every metric against the baseline.
+
+    Returns:
+    - list: The names of the metrics that regressed by more than the tolerance.
+    """
+    # (name, current, baseline, whether a higher value is better)
+    metrics = [("throughput", summary["throughput"], baseline.get("throughput"), True)]
+    metrics += [(name, summary[name], baseline.get(name), False) for name in ("p50", "p95", "p99")]
+    metrics += [(f"path {path} p95", values["p95"], baseline.get("paths", {}).get(path, {}).get("p95"), False)
+                for path, values in summary["paths"].items()]
+    metrics += [(f"stage {name} mean", values["mean"], baseline.get("stages", {}).get(name, {}).get("mean"), False)
+                for name, values in summary["stages"].items()]
+
+    regressions = []
+    print(f"\n{'metric':<30} {'baseline':>10} {'current':>10} {'change':>8}")
+    for name, current, previous, higher_is_better in metrics:
+        if not previous:
+            print(f"{name:<30} {'-':>10} {current:>10.1f} {'new':>8}")
+            continue
+        change = (current - previous) / previous
+        worse = -change if higher_is_better else change
+        flag = ""
+        if worse > tolerance:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:<30} {previous:>10.1f} {current:>10.1f} {change:>+8.1%}{flag}")
+    return regressions
+
+
+def main():
+    args = parse_args()
+    corpus = CORPUS
+    if args.corpus:
+        with open(args.corpus, 'r') as file:
+            corpus = json.load(file)
+    corpus = [entry for entry in corpus if entry["path"] in args.paths]
+    if not corpus:
+        sys.exit("No question left in the corpus")
+
+    baseline_path = os.path.abspath(args.baseline) if args.baseline else None
+    save_path = os.path.abspath(args.save_baseline) if args.save_baseline else None
+    workdir = tempfile.mkdtemp(prefix='ask_benchmark_')
+    try:
+        prepare_environment(args, workdir, corpus)
+        app, user_id, headers = seed(args, corpus)
+
+        import extensions
+        geocoder = FakeGeocoder(args.geocode_latency)
+        extensions.gmaps = geocoder
+
+        samples, wall = run(args, app, user_id, headers, corpus)
+        summary = summarize(samples, wall)
+        summary["settings"] = {name: value for name, value in vars(args).items() if name not in ('baseline', 'save_baseline', 'keep')}
+        summary["geocoder_calls"] = geocoder.calls
+        print_report(summary)
+
+        regressions = []
+        if baseline_path:
+            with open(baseline_path, 'r') as file:
+                regressions = compare(summary, json.load(file), args.tolerance)
+        if save_path:
+            with open(save_path, 'w') as file:
+                json.dump(summary, file, indent=2)
+            print(f"\nBaseline saved to {save_path}")
+    finally:
+        os.chdir(REPO)
+        if args.keep:
+            print(f"Temporary files kept in {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if regressions:
+        print(f"\n{len(regressions)} metric(s) regressed by more than {args.tolerance:.0%}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
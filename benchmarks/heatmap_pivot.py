@@ -0,0 +1,66 @@
+"""
+Benchmark of the heatmap pivot against the loop that ask() used before it.
+
+Run from the repository root, with the same .env as the application since extensions is imported:
+
+    python benchmarks/heatmap_pivot.py --sizes 100 300 1000 --legacy-max 300
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from extensions import pivot_heatmap
+
+
+def legacy_pivot(result):
+    xlabels = list(set([row[0] for row in result]))
+    ylabels = list(set([row[1] for row in result]))
+    heatmap_data = [[0 for _ in xlabels] for _ in ylabels]
+    for row in result:
+        x_index = xlabels.index(row[0])
+        y_index = ylabels.index(row[1])
+        heatmap_data[y_index][x_index] = row[2]
+    return xlabels, ylabels, heatmap_data
+
+
+def make_rows(size, duplicates):
+    rows = [(f"x{x}", f"y{y}", random.randint(0, 100)) for x in range(size) for y in range(size) for _ in range(duplicates)]
+    random.shuffle(rows)
+    return rows
+
+
+def timed(fn, rows, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(rows)
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[50, 100, 300, 1000], help='Number of labels on each axis')
+    parser.add_argument('--duplicates', type=int, default=1, help='Rows per (x, y) cell')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per measurement, the best one is reported')
+    parser.add_argument('--legacy-max', type=int, default=300, help='Largest size the legacy loop is run for')
+    args = parser.parse_args()
+
+    print(f"{'grid':>11} {'rows':>9} {'legacy ms':>11} {'pivot ms':>10} {'speedup':>8}")
+    for size in args.sizes:
+        rows = make_rows(size, args.duplicates)
+        pivot_ms = timed(pivot_heatmap, rows, args.repeat)
+        if size <= args.legacy_max:
+            legacy_ms = timed(legacy_pivot, rows, 1)
+            legacy, speedup = f"{legacy_ms:.1f}", f"{legacy_ms / pivot_ms:.1f}x"
+        else:
+            legacy, speedup = "skipped", "-"
+        print(f"{f'{size}x{size}':>11} {len(rows):>9} {legacy:>11} {pivot_ms:>10.1f} {speedup:>8}")
+
+
+if __name__ == '__main__':
+    main()
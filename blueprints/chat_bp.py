@@ -1,15 +1,17 @@
-from flask import Blueprint, request, jsonify,current_app, send_file, url_for
-from openai import OpenAI
+from flask import Blueprint, request, jsonify,current_app, send_file, url_for, Response, stream_with_context
 from model.chat import Chat, Conversation, Feedback, chat_schema, chats_schema, conversation_schema, conversations_schema,feedback_schema, feedbacks_schema
-from extensions import db,get_embeddings,select_relevant_few_shots,contains_data_altering_operations,contains_sensitive_info,get_google_maps_loc,format_address,create_token,extract_auth_token,decode_token,format_as_table,generate_chart_code,generate_map_code,generate_heatmap_code,allowed_file,process_pdf,chunk_pdf_to_chroma,extract_text_with_ocr,select_relevant_pdf_chunks
+from extensions import db,get_embeddings,select_relevant_few_shots,submit_few_shot_queries,get_or_create_collection,contains_data_altering_operations,contains_sensitive_info,coordinate_resolver,format_address,create_token,extract_auth_token,decode_token,format_as_table,format_result_with_rules,iter_table_html,pivot_heatmap,CODE_TEMPLATES,MAP_MAX_POINTS,make_visualization,render_visualization,visualization_placeholder,chart_values,map_values,heatmap_values,downsample_chart_data,allowed_file,process_pdf,chunk_pdf_to_chroma,extract_text_with_ocr,select_relevant_pdf_chunks,executor,is_follow_up_question,sql_cache_scope,lookup_sql_cache,store_sql_cache,invalidate_sql_cache,evict_sql_cache_answer,bump_cache_version,get_cache_version,execute_sql_statements,split_sql_statements,run_readonly_query,run_spatial_query,guard_query_cost,QueryCostError,QUERY_ROW_CAP,RESULT_PAGE_SIZE,TABLE_INLINE_ROWS
 import os
-from sqlalchemy import text
+from sqlalchemy.orm import selectinload
 from blueprints.fewshot_bp import fewshot_bp
-import chromadb.utils.embedding_functions as embedding_functions
+from providers import llm, embedding_function
+from observability import logger, metrics, start_trace, with_request_context
 import chromadb
 from chromadb.config import Settings
 import hashlib
 import json
+import threading
+from collections import OrderedDict
 import pdfplumber
 import pytesseract
 from PIL import Image
@@ -24,30 +26,33 @@ if not os.path.exists(UPLOAD_FOLDER):
 
 
 chat_bp = Blueprint('chat_bp', __name__)
-client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
 
 # Initialize ChromaDB client with a persistent local path
 client_chroma = chromadb.PersistentClient(path="chroma_data", settings=Settings())
 
-openai_ef = embedding_functions.OpenAIEmbeddingFunction(
-                api_key=str(os.getenv('OPENAI_API_KEY')),
-                model_name="text-embedding-3-large"
-            )
+openai_ef = embedding_function
 # Get or create the collection
 collection_name = "few_shot"
 collection = client_chroma.get_collection(name=collection_name,embedding_function=openai_ef)
 
-with open('db_schema_prompt.txt', 'r') as file:
-    db_schema_prompt = file.read()
+# Approximate number of prompt tokens that the verbatim conversation history may use
+HISTORY_TOKEN_BUDGET = int(os.getenv('HISTORY_TOKEN_BUDGET', 3000))
+HISTORY_SUMMARY_MAX_TOKENS = int(os.getenv('HISTORY_SUMMARY_MAX_TOKENS', 400))
 
-with open('chart_code.txt', 'r') as file:
-    chart_base_code = file.read()
+# Routing system prompt of each user, keyed by the version of their PDF set
+SYSTEM_PROMPT_CACHE_SIZE = int(os.getenv('SYSTEM_PROMPT_CACHE_SIZE', 1024))
+system_prompts = OrderedDict()
+system_prompts_lock = threading.Lock()
 
-with open('map_code.txt', 'r') as file:
-    map_base_code = file.read()
+# How the answers that are not charts, maps or tables are written: "rules" answers simple results with templates
+# and the others with a table, "llm" always asks the formatting model, "auto" uses the rules when they apply and
+# the chat has no negative feedback
+RESPONSE_FORMATTER = os.getenv('RESPONSE_FORMATTER', 'auto').lower()
+formatted_responses = metrics.counter('chatbot_formatted_responses_total', 'Database answers by the formatter that wrote them.', ('formatter',))
+
+with open('db_schema_prompt.txt', 'r') as file:
+    db_schema_prompt = file.read()
 
-with open('heat_code.txt', 'r') as file:
-    heat_base_code = file.read()
 
 # Create a chat
 @chat_bp.route('/chats', methods=['POST'])
@@ -63,7 +68,7 @@ def create_chat():
         try:
             user_id = decode_token(token)
         except Exception as e:
-            print(f"Error decoding token: {e}")
+            logger.warning("Error decoding token: %s", e)
             return jsonify({"message": "Invalid token"}), 401
 
         if not title or not user_id:
@@ -75,7 +80,7 @@ def create_chat():
         return chat_schema.jsonify(new_chat), 201
     
     except Exception as e:
-        print(f"Error creating chat: {e}")
+        logger.error("Error creating chat: %s", e)
         return jsonify({"message": "Internal Server Error"}), 500
 
 
@@ -93,7 +98,7 @@ def delete_chat(chat_id):
         try:
             user_id = decode_token(token)
         except Exception as e:
-            print(f"Error decoding token: {e}")
+            logger.warning("Error decoding token: %s", e)
             return jsonify({"message": "Invalid token"}), 401
 
         if not chat:
@@ -107,7 +112,7 @@ def delete_chat(chat_id):
 
         return jsonify({"message": "Chat deleted successfully"}), 200
     except Exception as e:
-        print(f"Error deleting chat: {e}")
+        logger.error("Error deleting chat: %s", e)
         return jsonify({"message": "Internal Server Error"}), 500
 
 # Edit chat title
@@ -124,7 +129,7 @@ def update_chat_title(chat_id):
         try:
             user_id = decode_token(token)
         except Exception as e:
-            print(f"Error decoding token: {e}")
+            logger.warning("Error decoding token: %s", e)
             return jsonify({"message": "Invalid token"}), 401
 
         if not new_title:
@@ -142,7 +147,7 @@ def update_chat_title(chat_id):
 
         return jsonify({"message": "Chat title updated successfully", "chat": chat_schema.dump(chat)}), 200
     except Exception as e:
-        print(f"Error updating chat title: {e}")
+        logger.error("Error updating chat title: %s", e)
         return jsonify({"message": "Internal Server Error"}), 500
 
 
@@ -157,7 +162,7 @@ def get_conversations(chat_id):
         try:
             user_id = decode_token(token)
         except Exception as e:
-            print(f"Error decoding token: {e}")
+            logger.warning("Error decoding token: %s", e)
             return jsonify({"message": "Invalid token"}), 401
 
         chat = Chat.query.get(chat_id)
@@ -171,7 +176,7 @@ def get_conversations(chat_id):
         conversations = Conversation.query.filter_by(chat_id=chat_id).order_by(Conversation.timestamp).all()
         return jsonify(conversations_schema.dump(conversations)), 200
     except Exception as e:
-        print(f"Error retrieving conversations: {e}")
+        logger.error("Error retrieving conversations: %s", e)
         return jsonify({"message": "Internal Server Error"}), 500
     
 # Get a certain conversation
@@ -186,7 +191,7 @@ def get_conversation(conversation_id):
     try:
         user_id = decode_token(token)
     except Exception as e:
-        print(f"Error decoding token: {e}")
+        logger.warning("Error decoding token: %s", e)
         return jsonify({"message": "Invalid token"}), 401
 
     if not conversation:
@@ -198,6 +203,89 @@ def get_conversation(conversation_id):
 
     return jsonify(conversation_schema.dump(conversation)), 200
 
+@chat_bp.route('/conversations/<int:conversation_id>/result', methods=['GET'])
+def get_conversation_result(conversation_id):
+    token = extract_auth_token(request)
+    if not token:
+        return jsonify({"message": "Authentication token is required"}), 401
+
+    try:
+        user_id = decode_token(token)
+    except Exception as e:
+        logger.warning("Error decoding token: %s", e)
+        return jsonify({"message": "Invalid token"}), 401
+
+    conversation = Conversation.query.get(conversation_id)
+    if not conversation:
+        return jsonify({"message": "Conversation not found"}), 404
+
+    chat = Chat.query.get(conversation.chat_id)
+    if chat.user_id != user_id:
+        return jsonify({"message": "Unauthorized"}), 403
+
+    page = request.args.get('page', 1, type=int)
+    page_size = request.args.get('page_size', RESULT_PAGE_SIZE, type=int)
+    statement_index = request.args.get('statement', 0, type=int)
+    result_format = request.args.get('format', 'json')
+    if page < 1 or not 1 <= page_size <= QUERY_ROW_CAP:
+        return jsonify({"message": f"page must be at least 1 and page_size between 1 and {QUERY_ROW_CAP}"}), 400
+    if result_format not in ("json", "html"):
+        return jsonify({"message": "format must be json or html"}), 400
+
+    statements = split_sql_statements(conversation.sql_query) if conversation.executable == "Yes" else []
+    if not 0 <= statement_index < len(statements):
+        return jsonify({"message": "This conversation has no query result"}), 404
+    if contains_data_altering_operations(statements[statement_index]):
+        return jsonify({"message": "Data-altering operations are not allowed."}), 403
+
+    try:
+        offset = (page - 1) * page_size
+        page_result = run_spatial_query(statements[statement_index], limit=page_size, offset=offset)
+        if page_result is None:
+            # Pages may go past QUERY_ROW_CAP, the guard only limits the statement to the end of the page
+            guarded_query, _ = guard_query_cost(statements[statement_index], row_limit=offset + page_size)
+            page_result = run_readonly_query(guarded_query, limit=page_size, offset=offset)
+        keys, rows, has_more = page_result
+    except QueryCostError as e:
+        return jsonify({"message": str(e)}), 403
+    except Exception as e:
+        logger.error("Error fetching the result of conversation %s: %s", conversation_id, e)
+        return jsonify({"message": "Internal Server Error"}), 500
+
+    if result_format == "html":
+        headers = {"X-Page": str(page), "X-Has-More": "true" if has_more else "false"}
+        return Response(iter_table_html(rows, keys), mimetype='text/html', headers=headers)
+
+    return jsonify({
+        "conversation_id": conversation_id,
+        "statement": statement_index,
+        "page": page,
+        "page_size": page_size,
+        "columns": keys,
+        "rows": [list(row) for row in rows],
+        "has_more": has_more,
+    }), 200
+
+@chat_bp.route('/templates/<template_id>', methods=['GET'])
+def get_code_template(template_id):
+    token = extract_auth_token(request)
+    if not token:
+        return jsonify({"message": "Authentication token is required"}), 401
+
+    try:
+        decode_token(token)
+    except Exception as e:
+        logger.warning("Error decoding token: %s", e)
+        return jsonify({"message": "Invalid token"}), 401
+
+    template = CODE_TEMPLATES.get(template_id)
+    if not template:
+        return jsonify({"message": "Template not found"}), 404
+
+    if request.headers.get('If-None-Match') == f'"{template.version}"':
+        return '', 304
+    return jsonify(template.describe()), 200, {"ETag": f'"{template.version}"', "Cache-Control": "private, max-age=86400"}
+
 # Endpoint to get all chats
 @chat_bp.route('/chats', methods=['GET'])
 def get_all_chats():
@@ -209,13 +297,13 @@ def get_all_chats():
         try:
             user_id = decode_token(token)
         except Exception as e:
-            print(f"Error decoding token: {e}")
+            logger.warning("Error decoding token: %s", e)
             return jsonify({"message": "Invalid token"}), 401
 
         chats = Chat.query.filter_by(user_id=user_id).all()
         return chats_schema.jsonify(chats), 200
     except Exception as e:
-        print(f"Error retrieving chats: {e}")
+        logger.error("Error retrieving chats: %s", e)
         return jsonify({"message": "Internal Server Error"}), 500
 
 
@@ -243,6 +331,10 @@ def submit_feedback():
     db.session.add(feedback)
     db.session.commit()
 
+    if feedback_type == 'negative':
+        # The answer may have come from the SQL cache, it must not be served again
+        evict_sql_cache_answer(conversation.sql_query)
+
     if feedback_type == 'positive':
         user_id = conversation.chat.user_id  # Assuming you have a relationship to get the user_id
         user_collection_name = f"few_shot_user_{user_id}"
@@ -277,6 +369,10 @@ def submit_feedback():
                 }]
             )
 
+            # Cached answers may have been built from the previous examples of this user
+            bump_cache_version(user_collection_name)
+            invalidate_sql_cache(user_id)
+
     return jsonify({"message": "Feedback submitted successfully"}), 201
 
 #Edit feedback
@@ -300,7 +396,7 @@ def update_feedback(conversation_id):
 
         return jsonify({"message": "Feedback updated successfully"}), 200
     except Exception as e:
-        print(f"Error updating feedback: {e}")
+        logger.error("Error updating feedback: %s", e)
         return jsonify({"message": "Internal Server Error"}), 500
 
 
@@ -324,7 +420,7 @@ def get_feedback(conversation_id):
         return jsonify(serialized_feedback), 200
 
     except Exception as e:
-        print(f"Error retrieving feedback: {e}")
+        logger.error("Error retrieving feedback: %s", e)
         return jsonify({"message": "Internal Server Error"}), 500
 
 #Get all feedbacks
@@ -347,7 +443,7 @@ def get_all_feedback():
         return jsonify(serialized_feedbacks), 200
 
     except Exception as e:
-        print(f"Error retrieving feedback: {e}")
+        logger.error("Error retrieving feedback: %s", e)
         return jsonify({"message": "Internal Server Error"}), 500
     
 
@@ -369,7 +465,7 @@ def upload_pdf():
         try:
             user_id = decode_token(token)
         except Exception as e:
-            print(f"Error decoding token: {e}")
+            logger.warning("Error decoding token: %s", e)
             return jsonify({"message": "Invalid token"}), 401
         process_result = process_pdf(filename, user_id)
         return jsonify(process_result), 201
@@ -386,7 +482,7 @@ def view_pdfs():
     try:
         user_id = decode_token(token)
     except Exception as e:
-        print(f"Error decoding token: {e}")
+        logger.warning("Error decoding token: %s", e)
         return jsonify({"message": "Invalid token"}), 401
 
     collection_name = f"user_{user_id}_pdfs"
@@ -396,7 +492,7 @@ def view_pdfs():
         return jsonify({"message": "No PDFs found for this user."}), 404
 
     items = collection.get(include=["metadatas"])
-    print(items)
+    logger.debug("PDF documents: %s", items)
     metadata_list = items.get('metadatas', [])
     filenames = list(set([item['filename'] for item in metadata_list]))
     pdf_data = [{"title": filename, "url": url_for('chat_bp.view_pdf', filename=filename, _external=True)} for filename in filenames]
@@ -412,7 +508,7 @@ def view_pdf(filename):
     try:
         user_id = decode_token(token)
     except Exception as e:
-        print(f"Error decoding token: {e}")
+        logger.warning("Error decoding token: %s", e)
         return jsonify({"message": "Invalid token"}), 401
 
     file_path = os.path.join(UPLOAD_FOLDER, filename)
@@ -431,7 +527,7 @@ def delete_pdf(filename):
     try:
         user_id = decode_token(token)
     except Exception as e:
-        print(f"Error decoding token: {e}")
+        logger.warning("Error decoding token: %s", e)
         return jsonify({"message": "Invalid token"}), 401    
     collection_name = f"user_{user_id}_pdfs"
     
@@ -441,11 +537,12 @@ def delete_pdf(filename):
         return jsonify({"message": "No PDFs found for this user."}), 404
     
     items = collection.get(include=["metadatas"], where={'filename': filename})
-    print(items)
+    logger.debug("PDF documents: %s", items)
     
     ids_to_delete = items['ids']    
 
     collection.delete(ids=ids_to_delete)
+    bump_cache_version(collection_name)
     
     file_path = os.path.join(UPLOAD_FOLDER, filename)
     if os.path.exists(file_path):
@@ -460,13 +557,14 @@ def ask():
     data = request.json
     user_question = data.get('question')
     chat_id = data.get('chat_id')
+    response_mode = data.get('response_mode', 'code')
     token = extract_auth_token(request)
     if not token:
         return "Authentication token is required"
     try:
         user_id = decode_token(token)
     except Exception as e:
-        print(f"Error decoding token: {e}")
+        logger.warning("Error decoding token: %s", e)
         return "Invalid token"
     if not user_question or not chat_id:
         return jsonify({"message": "Question and chat_id are required"}), 400
@@ -475,34 +573,246 @@ def ask():
     if contains_sensitive_info(user_question):
         return jsonify({"message": "This question asks for sensitive content and I am not allowed to answer it."}), 403
 
-    # Fetch previous conversations for context
-    previous_conversations = Conversation.query.filter_by(chat_id=chat_id).order_by(Conversation.timestamp).all()
+    chat = Chat.query.get(chat_id)
+    if not chat:
+        return jsonify({"message": "Chat not found"}), 404
 
-    collection_name = f"user_{user_id}_pdfs"
-    collection = client_chroma.get_collection(name=collection_name,embedding_function=openai_ef)
+    timings = start_trace()
 
-    if not collection:
-        return jsonify({"message": "No PDFs found for this user."}), 404
+    # Fetch previous conversations for context, shared by every prompt built for this request
+    summary, previous_conversations, conversation_history, relevant_examples = prepare_ask_context(chat, user_question, user_id, timings)
     
+    # Generate SQL query and extract relevant fields
+    with timings.stage("generate_sql"):
+        sql_query, score, executable, location, chartname = generate_sql_query(user_question, conversation_history, user_id, relevant_examples)
+
+    if executable== "PDF":
+        with timings.stage("pdf_chunks"):
+            relevant_chunks = select_relevant_pdf_chunks(user_question, user_id, sql_query)
+
+        with timings.stage("pdf_answer"):
+            response=get_pdf_answer(user_question,relevant_chunks,chat_id,previous_conversations,summary)
+        try:
+            save_conversation(chat_id, user_question, response, sql_query, score, executable, location, chartname)
+            timings.log()
+            return jsonify({"message": response}), 201, {"Server-Timing": timings.server_timing()}
+        except Exception as e:
+            logger.error("Error: %s", e)
+            return jsonify({"message": str(e)}), 500
+
+    rejection = check_generated_query(sql_query, score, executable)
+    if rejection:
+        return jsonify({"message": rejection}), 403, {"Server-Timing": timings.server_timing()}
+
+    try:
+        with timings.stage("execute_sql"):
+            query_result = execute_sql_query(sql_query)
+    except QueryCostError as e:
+        return jsonify({"message": str(e)}), 403, {"Server-Timing": timings.server_timing()}
+    except Exception as e:
+        logger.error("Error: %s", e)
+        return jsonify({"message": str(e)}), 500
+
+    try:
+        with timings.stage("render"):
+            formatted_response, visualization = render_visual_response(query_result, chartname, location, response_mode)
+        if formatted_response is None:
+            with timings.stage("format"):
+                formatted_response = format_without_llm(user_question, query_result, chat_id, previous_conversations, summary)
+                if formatted_response is None:
+                    formatted_response = format_response_with_gpt(user_question, query_result.for_prompt(), chat_id, previous_conversations, summary)
+
+        # Store the conversation
+        conversation = save_conversation(chat_id, user_question, formatted_response, sql_query, score, executable, location, chartname, visualization, query_result.estimate)
+
+        timings.log()
+        return jsonify({"message": formatted_response, **more_rows_info(query_result, conversation), **visualization_fields(visualization, response_mode)}), 201, {"Server-Timing": timings.server_timing()}
+    except Exception as e:
+        logger.error("Error: %s", e)
+        return jsonify({"message": str(e)}), 500
+
+
+# Streaming variant of the main asking route using Server-Sent Events
+@chat_bp.route('/ask/stream', methods=['POST'])
+def ask_stream():
+    data = request.json
+    user_question = data.get('question')
+    chat_id = data.get('chat_id')
+    response_mode = data.get('response_mode', 'code')
+    token = extract_auth_token(request)
+    if not token:
+        return jsonify({"message": "Authentication token is required"}), 401
+    try:
+        user_id = decode_token(token)
+    except Exception as e:
+        logger.warning("Error decoding token: %s", e)
+        return jsonify({"message": "Invalid token"}), 401
+    if not user_question or not chat_id:
+        return jsonify({"message": "Question and chat_id are required"}), 400
+
+    # Check for sensitive information
+    if contains_sensitive_info(user_question):
+        return jsonify({"message": "This question asks for sensitive content and I am not allowed to answer it."}), 403
+
+    chat = Chat.query.get(chat_id)
+    if not chat:
+        return jsonify({"message": "Chat not found"}), 404
+
+    def generate():
+        timings = start_trace()
+        yield sse_event("start", {"chat_id": chat_id})
+        try:
+            summary, previous_conversations, conversation_history, relevant_examples = prepare_ask_context(chat, user_question, user_id, timings)
+
+            with timings.stage("generate_sql"):
+                sql_query, score, executable, location, chartname = generate_sql_query(user_question, conversation_history, user_id, relevant_examples)
+            yield sse_event("routing", {"Score": score, "Executable": executable, "Location": location, "ChartName": chartname})
+
+            query_result = visualization = None
+            if executable == "PDF":
+                relevant_chunks = select_relevant_pdf_chunks(user_question, user_id, sql_query)
+                yield sse_event("formatting", {"mode": "pdf", "chunks": len(relevant_chunks)})
+                response = ""
+                for content in stream_completion("pdf_answer", build_pdf_messages(user_question, relevant_chunks, previous_conversations, summary), max_tokens=500):
+                    response += content
+                    yield sse_event("token", {"content": content})
+            else:
+                rejection = check_generated_query(sql_query, score, executable)
+                if rejection:
+                    yield sse_event("error", {"message": rejection, "status": 403})
+                    return
+
+                yield sse_event("sql", {"query": sql_query})
+                try:
+                    with timings.stage("execute_sql"):
+                        query_result = execute_sql_query(sql_query)
+                except QueryCostError as e:
+                    yield sse_event("error", {"message": str(e), "status": 403})
+                    return
+                yield sse_event("rows", {"count": len(query_result.rows), "columns": query_result.keys, "statements": len(query_result.statements), "more_rows": bool(query_result.truncated)})
+
+                with timings.stage("render"):
+                    response, visualization = render_visual_response(query_result, chartname, location, response_mode)
+                if response is None:
+                    with timings.stage("format"):
+                        response = format_without_llm(user_question, query_result, chat_id, previous_conversations, summary)
+                    if response is not None:
+                        yield sse_event("formatting", {"mode": "rules"})
+                        yield sse_event("token", {"content": response})
+                    else:
+                        yield sse_event("formatting", {"mode": "gpt"})
+                        response = ""
+                        for content in stream_completion("format", build_format_messages(user_question, query_result.for_prompt(), previous_conversations, summary), max_tokens=500):
+                            response += content
+                            yield sse_event("token", {"content": content})
+                else:
+                    yield sse_event("formatting", {"mode": chartname if chartname != "None" else "table"})
+
+            response = response.strip()
+            conversation = save_conversation(chat_id, user_question, response, sql_query, score, executable, location, chartname, visualization, query_result.estimate if query_result else None)
+            yield sse_event("timings", timings.as_dict())
+            timings.log()
+            yield sse_event("done", {"message": response, "conversation_id": conversation.id, **more_rows_info(query_result, conversation), **visualization_fields(visualization, response_mode)})
+        except Exception as e:
+            logger.error("Error: %s", e)
+            db.session.rollback()
+            yield sse_event("error", {"message": str(e), "status": 500})
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+def prepare_ask_context(chat, user_question, user_id, timings):
+    """
+    Runs the independent steps that precede the routing call concurrently: the system prompt lookup,
+    the question embedding and then the queries of the main and user few-shot collections run on the
+    worker pool while the chat history is loaded on the request thread, which owns the database session.
+
+    Returns:
+    - tuple: The chat summary, the verbatim conversations, the routing messages and the few-shot examples.
+    """
+    prompt_future = executor.submit(timings.run, "system_prompt", get_system_prompt, user_id)
+    few_shot_queries = executor.submit(with_request_context(submit_few_shot_queries), user_question, user_id, timings, top_n_main=5, top_n_user=2, distance_threshold=1.5)
+
+    with timings.stage("history"):
+        summary, previous_conversations = build_history_window(chat, load_chat_history(chat.id, after_id=chat.summarized_until))
+
+    system_prompt = prompt_future.result()
+    with timings.stage("few_shots"):
+        relevant_examples = [example for future in few_shot_queries.result() for example in future.result()]
+    conversation_history = build_conversation_history(user_question, summary, previous_conversations, system_prompt)
+    return summary, previous_conversations, conversation_history, relevant_examples
+
+
+def list_pdf_documents(user_id):
+    """
+    Lists the PDF documents uploaded by a user.
+
+    Returns:
+    - dict: The title and description of each document, keyed by document ID.
+    """
+    collection_name = f"user_{user_id}_pdfs"
+    collection = get_or_create_collection(collection_name)
+
     items = collection.get(include=["metadatas"])
     metadata_list = items.get('metadatas', [])
-    pdf_titles = ""
-    pdf_descriptions = ""
     unique_documents = {}
     for item in metadata_list:
         doc_id = item['doc_id']
         if doc_id not in unique_documents:
             unique_documents[doc_id] = (item['pdf_title'], item.get('description', 'No description available'))
+    return unique_documents
+
 
+def get_system_prompt(user_id):
+    """
+    Returns the routing system prompt of a user. It only depends on the schema and the user's PDF documents,
+    so it is built once per version of the PDF set and stays byte-identical between requests, which lets the
+    provider cache the prompt prefix.
+
+    Returns:
+    - str: The system prompt.
+    """
+    collection_name = f"user_{user_id}_pdfs"
+    key = (user_id, get_cache_version(collection_name))
+    with system_prompts_lock:
+        prompt = system_prompts.get(key)
+        if prompt is not None:
+            system_prompts.move_to_end(key)
+            return prompt
+
+    prompt = build_system_prompt(list_pdf_documents(user_id))
+    with system_prompts_lock:
+        # Versions of the same user's PDF set that are now stale
+        for stale in [cached for cached in system_prompts if cached[0] == user_id]:
+            del system_prompts[stale]
+        system_prompts[key] = prompt
+        while len(system_prompts) > SYSTEM_PROMPT_CACHE_SIZE:
+            system_prompts.popitem(last=False)
+    return prompt
+
+
+def build_system_prompt(unique_documents):
+    """
+    Builds the system message of the model that routes the question and writes the SQL query.
+
+    Parameters:
+    - unique_documents (dict): The user's PDF documents as returned by list_pdf_documents.
+
+    Returns:
+    - str: The system message.
+    """
+    pdf_titles = ""
+    pdf_descriptions = ""
     for i, (doc_id, (title, description)) in enumerate(unique_documents.items(), start=1):
         pdf_titles += f"{i}. {title} (Document ID: {doc_id})\n"
         pdf_descriptions += f"{i}. {description}\n"
 
     # Create the system message with all instructions and context
-    conversation_history = [
-        {
-            "role": "system",
-            "content": db_schema_prompt + f"""
+    return db_schema_prompt + f"""
                 You will be handling 2 cases of user questions, and you have to know which case to follow:
                 Case 1:
                     The user asks questions about the database with the schema described above. 
@@ -518,12 +828,13 @@ def ask():
                         "Executable": An "Answer" is executable if it satisfies the above guidelines. If at least one of the guidelines fails then answer with "No" and write "NULL" in the "Answer" field. Type: string. Options: "Yes" or "No".                
                         "Answer": one or multiple SQL queries (if they are multiple then they should be separated by ;) to fetch the required information from the database without any additional text or explanation. The command(s) should be compatible with PostgreSQL. Always put identifiers in the SQL queries between double quotations. Type: string.
                         "Location": Does the user sentence or question ask about a location? Type: string. Options: "Yes" or "No". 
-                        "ChartName": The type of visualization or map to be generated if any. The user may explicitly ask for the generation of a specific type of chart (e.g., 'LineChart', 'BarChart', 'PieChart') or a heatmap which is a representation of data points where individual values are depicted by varying colors, please note that heatmaps are not related to actual maps; therefore, they dont require any address ('HeatMap'). Additionally, the user might request directions to a certain location ('GoogleMaps') or the creation of a triangle/polygon map based on three input locations to visualize a specific area ('TriangleMaps'). If none of these are requested, reply with 'None'. Options: 'LineChart', 'BarChart', 'PieChart', 'GoogleMaps', 'HeatMap', 'TriangleMaps', 'None'. Type: string.
+                        "ChartName": The type of visualization or map to be generated if any. The user may explicitly ask for the generation of a specific type of chart (e.g., 'LineChart', 'BarChart', 'PieChart') or a heatmap which is a representation of data points where individual values are depicted by varying colors, please note that heatmaps are not related to actual maps; therefore, they dont require any address ('HeatMap'). Additionally, the user might request directions to a certain location ('GoogleMaps') or to see several locations marked on a map ('GoogleMaps'), or the creation of a triangle/polygon map based on three or more input locations to visualize a specific area ('TriangleMaps'). If none of these are requested, reply with 'None'. Options: 'LineChart', 'BarChart', 'PieChart', 'GoogleMaps', 'HeatMap', 'TriangleMaps', 'None'. Type: string.
                     }}
                     Important Notes:
                     1) Contextual Understanding: Understand and maintain context as the user may ask follow-up questions. In some cases, follow-up questions or statements may be unclear at first. For example, the user could ask for addresses which are returned to him in a list, then he sends "2" in a follow-up message which means that he wants the second option. 
                     2) Location-related information (such as address, city, state) and contact information are not considered sensitive and you may retrieve them. If the user asks a location related question then you must fetch the full address that answers that question. When you write queries that fetch state or city, the data may be stored as an abbreviation; example: "California" and "CA".
                     3) HeatMaps: HeatMaps are not related in any way to actual location-based maps. Never fetch locations for a heatmap unless the user explicitly asks you to do so. When the user asks for heatmap, he will specify what data would be the x-axis, y-axis and data points. You must fetch what he wants in the following order: x-axis, y axis, data points.
+                    4) Distances: To find the restaurants or consumers closest to a location or within a distance of it, never compute distances in SQL. Instead write a statement of its own calling one of these functions: SELECT * FROM nearest_restaurants(latitude, longitude, k), SELECT * FROM restaurants_within(latitude, longitude, radius_km), SELECT * FROM nearest_consumers(latitude, longitude, k), SELECT * FROM consumers_within(latitude, longitude, radius_km). The location may also be given as a consumer ID, a restaurant name or a city instead of the latitude and longitude, example: SELECT * FROM nearest_restaurants('U1001', 3). They return the name (or consumer ID), city, state, country, latitude, longitude and Distance_km of each match, closest first.
                 Case 2:
                     The user asks questions about certain PDF documents with the following titles and document ids:
                     {pdf_titles}
@@ -538,16 +849,30 @@ def ask():
                         "ChartName": "None". Type: string.
                     }}
             """
-        }
-    ]
+
+
+def build_conversation_history(user_question, summary, previous_conversations, system_prompt):
+    """
+    Builds the messages sent to the model that routes the question and writes the SQL query.
+    The messages only grow at the end from one request to the next so that their prefix can be cached.
+
+    Parameters:
+    - user_question (str): The question asked by the user.
+    - summary (str or None): The running summary of the chat.
+    - previous_conversations (list): The conversations to include verbatim.
+    - system_prompt (str): The system prompt returned by get_system_prompt.
+
+    Returns:
+    - list: The messages, starting with the system message.
+    """
+    conversation_history = [{"role": "system", "content": system_prompt}]
+
+    if summary:
+        conversation_history.append({"role": "system", "content": f"Summary of the earlier conversation: {summary}"})
 
     # Append previous conversations in alternating user and assistant roles
     for convo in previous_conversations:
-        user_query_with_feedback = convo.user_query
-        feedbacks = Feedback.query.filter_by(conversation_id=convo.id, feedback_type='negative').all()
-        for feedback in feedbacks:
-            user_query_with_feedback += f" (Negative feedback on assistant response: {feedback.feedback_comment})"
-        conversation_history.append({"role": "user", "content": user_query_with_feedback})
+        conversation_history.append({"role": "user", "content": query_with_feedback(convo)})
         conversation_history.append({
             "role": "assistant",
             "content": json.dumps({
@@ -561,152 +886,191 @@ def ask():
 
     # Add the current user question
     conversation_history.append({"role": "user", "content": user_question})
-    
-    # Generate SQL query and extract relevant fields
-    sql_query, score, executable, location, chartname = generate_sql_query(user_question, conversation_history, user_id)
+    return conversation_history
 
-    if executable== "PDF":
-        relevant_chunks = select_relevant_pdf_chunks(user_question, user_id, sql_query)
-
-        response=get_pdf_answer(user_question,relevant_chunks,chat_id)
-        try:
-            conversation = Conversation(
-            chat_id=chat_id,
-            user_query=user_question,
-            response=response,
-            sql_query=sql_query,
-            score=score,
-            executable=executable,
-            location=location,
-            chartname=chartname
-            )
-            db.session.add(conversation)
-            db.session.commit()
-
-            return jsonify({"message": response}), 201
-        except Exception as e:
-            print(f"Error: {e}")
-            return jsonify({"message": str(e)}), 500
 
-    if score < 4:
-        return jsonify({"message": "I'm here to answer questions related to the database. Could you please ask something relevant?"}), 403
+def check_generated_query(sql_query, score, executable):
+    """
+    Returns the message explaining why a generated query must not be run, or None if it may be run.
+    """
+    if score is None or score < 4:
+        return "I'm here to answer questions related to the database. Could you please ask something relevant?"
     if executable == "No":
-        return jsonify({"message": "This question asks for sensitive content and I am not allowed to answer it."}), 403
+        return "This question asks for sensitive content and I am not allowed to answer it."
 
-    
     # Check for data-altering operations
     if contains_data_altering_operations(sql_query):
-        return jsonify({"message": "Data-altering operations are not allowed."}), 403
-
-    try:
-        engine = db.get_engine(current_app, bind='TestingData')
-        session = engine.connect()
-        data = session.execute(text(sql_query))
-        result=data.fetchall()
-
-        print(f"SQL Query Result: {result}")
-        if chartname in ["LineChart", "BarChart", "PieChart"]:
-            keys=data.keys()
-            keys=list(keys)
-            print(keys)
-            if len(keys)>2:
-                formatted_response = format_as_table(result,keys)
-            else:
-                result_adjusted = [{"labelX": str(row[0]), "labelY": row[1]} for row in result]
-                chart_code = generate_chart_code(result_adjusted, keys[0], keys[1], chartname, chart_base_code)
-                formatted_response = f"Here is your {chartname}: {chart_code}"
-        elif chartname== "HeatMap":
-            keys=data.keys()
-            keys=list(keys)
-            print(keys)
-            if len(keys)>3:
-                formatted_response = format_as_table(result,keys)
-            else:
-                xlabels = list(set([row[0] for row in result]))
-                ylabels = list(set([row[1] for row in result]))
-        
-                # Initialize the heatmap data with zeros
-                heatmap_data = [[0 for _ in xlabels] for _ in ylabels]
-        
-                # Populate the heatmap data with actual values
-                for row in result:
-                    x_index = xlabels.index(row[0])
-                    y_index = ylabels.index(row[1])
-                    heatmap_data[y_index][x_index] = row[2]
-                print(heatmap_data)
-                heat_code = generate_heatmap_code(xlabels, ylabels, heatmap_data, heat_base_code)
-                formatted_response = f"Here is your heatmap: {heat_code}"
-
-        elif len(result) > 30:
-            keys=data.keys()
-            keys=list(keys)
-            formatted_response = format_as_table(result,keys)
-        elif location == "Yes" and chartname =="GoogleMaps":
-            if len(result) > 1:
-                formatted_response = format_response_with_gpt(user_question, result, chat_id)
-            else:
-                address = format_address(result[0])
-                lat , lng = get_google_maps_loc(address)
-                coordinates=[{"lat":lat , "lng":lng }]
-                map_code = generate_map_code(coordinates,chartname,map_base_code)
-                formatted_response = f"Here is the map to {address}: {map_code}"
-        elif location == "Yes" and chartname == "TriangleMaps":
-            if len(result)==3:
-                coordinates=[]
-                for row in result:
-                    address = format_address(row)
-                    lat , lng =get_google_maps_loc(address)
-                    coordinates.append({"lat":lat , "lng":lng})
-                map_code=generate_map_code(coordinates,chartname,map_base_code)
-                formatted_response = f"Here is your requested area: {map_code}"
-            else:
-                formatted_response = format_response_with_gpt(user_question, result, chat_id)
+        return "Data-altering operations are not allowed."
+    return None
+
+
+def execute_sql_query(sql_query):
+    """
+    Runs the statements of a generated query against the TestingData database.
+
+    Returns:
+    - QueryResult: The combined result of the statements.
+    """
+    query_result = execute_sql_statements(sql_query)
+    logger.debug("SQL Query Result: %s", query_result.for_prompt())
+    return query_result
+
+
+def format_result_tables(query_result):
+    # Only the first TABLE_INLINE_ROWS rows of each table go into the answer, the rest is served by the result endpoint
+    query_result.inline_rows = TABLE_INLINE_ROWS
+    tables = "\n".join(format_as_table(rows, keys, TABLE_INLINE_ROWS) for keys, rows in query_result.tables())
+    if query_result.incomplete_statements():
+        tables += f"\n<p>Only the first {TABLE_INLINE_ROWS} rows are shown, more rows are available.</p>"
+    return tables
+
+
+def more_rows_info(query_result, conversation):
+    """
+    Tells the client where to fetch the rest of a result that was cut at QUERY_ROW_CAP rows or
+    shown as a table cut at TABLE_INLINE_ROWS rows.
+
+    Returns:
+    - dict: Empty when the whole result was returned, otherwise the "more_rows" marker and the page URL of each cut statement.
+    """
+    incomplete = query_result.incomplete_statements() if query_result is not None else []
+    if not incomplete:
+        return {}
+    return {
+        "more_rows": True,
+        "conversation_id": conversation.id,
+        "result_urls": [url_for('chat_bp.get_conversation_result', conversation_id=conversation.id, statement=index, page=1) for index in incomplete],
+    }
+
+
+def render_visual_response(query_result, chartname, location, response_mode="code"):
+    """
+    Renders the query result as a chart, heatmap, map or table when the question calls for one.
+    In payload mode the code of a chart, heatmap or map is not rendered, the client renders the payload.
+
+    Returns:
+    - tuple: The formatted response (str), or None when the result should be formatted by GPT,
+      and the data payload of the chart, heatmap or map (dict), or None for other answers.
+    """
+    visualization = build_visualization(query_result, chartname, location)
+    if isinstance(visualization, dict):
+        if response_mode == "payload":
+            return visualization["caption"], visualization
+        return render_visualization(visualization), visualization
+    return visualization, None
+
+
+def build_visualization(query_result, chartname, location):
+    # Returns the payload of a chart, heatmap or map, the HTML of a table, or None for GPT
+    result, keys = query_result.rows, query_result.keys
+    if chartname in ["LineChart", "BarChart", "PieChart"]:
+        logger.debug("Result columns: %s", keys)
+        if len(keys)>2:
+            return format_result_tables(query_result)
+        result_adjusted = [{"labelX": str(row[0]), "labelY": row[1]} for row in result]
+        result_adjusted, reduction = downsample_chart_data(result_adjusted, chartname)
+        caption = f"Here is your {chartname}"
+        if reduction:
+            caption += f" (reduced from {reduction['original_points']} to {reduction['points']} points)"
+        visualization = make_visualization("chart", caption, chart_values(result_adjusted, keys[0], keys[1], chartname))
+        if reduction:
+            visualization["reduction"] = reduction
+        return visualization
+    elif chartname== "HeatMap":
+        logger.debug("Result columns: %s", keys)
+        if len(keys)!=3:
+            return format_result_tables(query_result)
+        xlabels, ylabels, heatmap_data = pivot_heatmap(result)
+        return make_visualization("heatmap", "Here is your heatmap", heatmap_values(xlabels, ylabels, heatmap_data))
+    elif len(result) > 30:
+        return format_result_tables(query_result)
+    elif location == "Yes" and chartname =="GoogleMaps":
+        if not result or len(result) > MAP_MAX_POINTS:
+            return None
+        # One marker per location, the locations that could not be resolved are left out
+        locations = coordinate_resolver.resolve_all(result, keys)
+        coordinates=[{"lat":location[0] , "lng":location[1] } for location in locations if location is not None]
+        if not coordinates:
+            return None
+        if len(result) == 1:
+            caption = f"Here is the map to {format_address(result[0])}"
         else:
-            formatted_response = format_response_with_gpt(user_question, result, chat_id)
-
-       # Store the conversation
-        conversation = Conversation(
-            chat_id=chat_id,
-            user_query=user_question,
-            response=formatted_response,
-            sql_query=sql_query,
-            score=score,
-            executable=executable,
-            location=location,
-            chartname=chartname
-        )
-        db.session.add(conversation)
-        db.session.commit()
-
-        return jsonify({"message": formatted_response}), 201
-    except Exception as e:
-        print(f"Error: {e}")
-        return jsonify({"message": str(e)}), 500
-    finally:
-        session.close()
-
+            caption = f"Here is the map of {len(coordinates)} locations"
+        return make_visualization("map", caption, map_values(coordinates, chartname))
+    elif location == "Yes" and chartname == "TriangleMaps":
+        if not 3 <= len(result) <= MAP_MAX_POINTS:
+            return None
+        # Every vertex of the polygon is needed
+        locations = coordinate_resolver.resolve_all(result, keys)
+        if any(location is None for location in locations):
+            return None
+        coordinates=[{"lat":location[0] , "lng":location[1]} for location in locations]
+        return make_visualization("map", "Here is your requested area", map_values(coordinates, chartname))
+    return None
+
+
+def visualization_fields(visualization, response_mode):
+    """
+    In payload mode a chart, heatmap or map answer is sent as its caption and data payload,
+    which the client renders with the template served by /chat/templates/<template_id>.
+
+    Returns:
+    - dict: The fields that replace or complete the message of the response.
+    """
+    if response_mode != "payload" or visualization is None:
+        return {}
+    return {"message": visualization["caption"], "visualization": visualization}
+
+
+def save_conversation(chat_id, user_question, response, sql_query, score, executable, location, chartname, visualization=None, query_estimate=None):
+    # A visualization is stored as its payload and rendered when the conversation is read,
+    # the response only keeps a placeholder that is also what the model sees in the history
+    if visualization:
+        response = visualization_placeholder(visualization)
+    conversation = Conversation(
+        chat_id=chat_id,
+        user_query=user_question,
+        response=response,
+        sql_query=sql_query,
+        score=score,
+        executable=executable,
+        location=location,
+        chartname=chartname,
+        visualization=visualization,
+        estimated_cost=query_estimate["cost"] if query_estimate else None,
+        estimated_rows=query_estimate["rows"] if query_estimate else None
+    )
+    db.session.add(conversation)
+    db.session.commit()
+    return conversation
 
 
+def generate_sql_query(user_question, conversation_history,user_id,relevant_examples=None):
+    if relevant_examples is None:
+        relevant_examples = select_relevant_few_shots(user_question,user_id=user_id, top_n_main=5,top_n_user=2,distance_threshold=1.5)
 
-def generate_sql_query(user_question, conversation_history,user_id):
-    relevant_examples = select_relevant_few_shots(user_question,user_id=user_id, top_n_main=5,top_n_user=2,distance_threshold=1.5)
+    # Reuse the answer to the same or a nearly identical question asked in the same context
+    context_messages = conversation_history[1:-1]
+    cache_scope = sql_cache_scope(conversation_history[0]["content"], user_id, context_messages)
+    # Questions such as "show them on a map" and "show them in a table" are close but need different answers
+    follow_up = bool(context_messages) and is_follow_up_question(user_question)
+    cached = lookup_sql_cache(user_question, cache_scope, semantic=not follow_up)
+    if cached is not None:
+        logger.info("SQL cache hit: %s", cached)
+        return cached
 
     example_texts = "\n".join(
     [f"User Question: \"{ex['Question']}\"\n \"Score\": {ex['Score']}\n\"Executable\": \"{ex['Executable']}\"\n\"Answer\": \"{ex['Answer']}\"\n\"Location\": \"{ex['Location']}\"" for ex in relevant_examples]
     )
 
-    # Append examples and instructions to the system message
-    conversation_history[0]["content"] += f"\nThe following are examples of User questions and corresponding replies:\n{example_texts}"
-    
-    print(conversation_history)
-    response = client.chat.completions.create(
-        model='gpt-4o',
-        messages=conversation_history,
-        response_format= {"type":'json_object'},
-        max_tokens=700
-    )
-    gpt_response = response.choices[0].message.content.strip()
-    print(gpt_response)
+    # The examples depend on the question, they go right before it so that the messages before them stay the same
+    messages = conversation_history[:-1] + [
+        {"role": "system", "content": f"The following are examples of User questions and corresponding replies:\n{example_texts}"}
+    ] + conversation_history[-1:]
+
+    logger.debug("Routing messages: %s", messages)
+    gpt_response = llm.chat("route", messages, max_tokens=700, json_mode=True)
+    logger.debug("Routing answer: %s", gpt_response)
 
     try:
         response_json = json.loads(gpt_response)
@@ -729,13 +1093,185 @@ def generate_sql_query(user_question, conversation_history,user_id):
         sql_query = sql_query.replace("MONTH(", "EXTRACT(MONTH FROM ")
         sql_query = sql_query.replace("YEAR(", "EXTRACT(YEAR FROM ")
 
+    if score is not None:
+        store_sql_cache(user_question, cache_scope, user_id, (sql_query, score, executable, location, chartname))
+
     return sql_query, score, executable, location, chartname
 
 
 
 
 
-def format_response_with_gpt(user_question, data, chat_id):
+def load_chat_history(chat_id, after_id=None):
+    """
+    Loads the conversations of a chat in timestamp order with their negative feedback eager-loaded
+    in a single additional query, so the prompt builders of a request can share one result.
+    The feedbacks collection of the returned conversations only holds negative feedback.
+
+    Parameters:
+    - chat_id (int): The ID of the chat.
+    - after_id (int or None): Only load the conversations with a greater ID, e.g. those not yet folded into the summary.
+
+    Returns:
+    - list: The conversations of the chat.
+    """
+    query = Conversation.query.filter_by(chat_id=chat_id)
+    if after_id is not None:
+        query = query.filter(Conversation.id > after_id)
+    return query\
+        .options(selectinload(Conversation.feedbacks.and_(Feedback.feedback_type == 'negative')))\
+        .order_by(Conversation.timestamp)\
+        .all()
+
+
+def query_with_feedback(convo):
+    user_query_with_feedback = convo.user_query
+    for feedback in convo.feedbacks:
+        # load_chat_history only loads negative feedback, but the relationship may have been loaded some other way
+        if feedback.feedback_type == 'negative':
+            user_query_with_feedback += f" (Negative feedback on assistant response: {feedback.feedback_comment})"
+    return user_query_with_feedback
+
+
+def estimate_tokens(text):
+    # Roughly four characters per token for English text
+    return len(text) // 4 + 1
+
+
+def build_history_window(chat, history, token_budget=HISTORY_TOKEN_BUDGET):
+    """
+    Keeps the most recent conversations that fit the token budget verbatim and folds the older ones
+    that are not yet part of the chat's running summary into it. Conversations folded once are never
+    sent again, so the prompt cost of long chats stays constant.
+
+    Parameters:
+    - chat (Chat): The chat the history belongs to.
+    - history (list): The conversations of the chat not yet folded into its summary, in timestamp order.
+    - token_budget (int): The approximate number of tokens the verbatim conversations may use.
+
+    Returns:
+    - tuple: The running summary (str or None) and the conversations to send verbatim (list).
+    """
+    def recent_conversations(budget):
+        window = []
+        used_tokens = 0
+        for convo in reversed(history):
+            cost = estimate_tokens(query_with_feedback(convo)) + estimate_tokens(convo.response or "")
+            # The latest conversation is always kept so that follow-up questions can be understood
+            if window and used_tokens + cost > budget:
+                break
+            window.append(convo)
+            used_tokens += cost
+        window.reverse()
+        return window
+
+    window = recent_conversations(token_budget)
+    if len(window) < len(history):
+        # Fold down to half of the budget so the summary is not updated again on every request
+        window = recent_conversations(token_budget // 2)
+        to_fold = history[:len(history) - len(window)]
+        # Saved with the conversation of this request, committing here would expire the conversations of the window
+        chat.summary = summarize_conversations(chat.summary, to_fold)
+        chat.summarized_until = to_fold[-1].id
+
+    return chat.summary, window
+
+
+def load_conversation_context(chat_id):
+    chat = Chat.query.get(chat_id)
+    if not chat:
+        return None, load_chat_history(chat_id)
+    return build_history_window(chat, load_chat_history(chat_id, after_id=chat.summarized_until))
+
+
+def summarize_conversations(summary, conversations):
+    """
+    Updates a running chat summary with the given conversations.
+
+    Parameters:
+    - summary (str or None): The current summary of the chat.
+    - conversations (list): The conversations to fold into the summary, in timestamp order.
+
+    Returns:
+    - str: The updated summary.
+    """
+    message=[{"role":"system","content":
+                f'''
+                You maintain the running summary of a conversation between a user and a chatbot that answers questions about a restaurant database and about PDF documents.
+                The user will give you the current summary followed by new exchanges. Return an updated summary that keeps everything needed to understand follow-up questions:
+                the topics asked about, the entities, filters and values returned (names, addresses, numbers), the SQL queries or documents used, the visualizations produced and any negative feedback given by the user.
+                Drop greetings and formatting. The summary must stay under {HISTORY_SUMMARY_MAX_TOKENS // 2} words.
+                '''
+              }]
+    exchanges = ""
+    for convo in conversations:
+        exchanges += f"User: {query_with_feedback(convo)}\n"
+        if convo.executable in ("Yes", "PDF"):
+            exchanges += f"Query or document: {convo.sql_query}\n"
+        exchanges += f"Assistant: {(convo.response or '')[:1000]}\n\n"
+    message.append({"role": "user", "content": f"Current summary: {summary or 'None'}\n\nNew exchanges:\n{exchanges}"})
+
+    return llm.chat("summary", message, max_tokens=HISTORY_SUMMARY_MAX_TOKENS)
+
+
+def has_negative_feedback(chat_id, history, summary):
+    """
+    Tells whether the user gave negative feedback in a chat. The conversations of the window are checked first,
+    the database is only queried when older conversations were folded into the summary.
+
+    Parameters:
+    - chat_id (int): The ID of the chat.
+    - history (list): The conversations sent verbatim, as returned by load_conversation_context.
+    - summary (str or None): The running summary of the older conversations.
+
+    Returns:
+    - bool: True when a conversation of the chat has negative feedback.
+    """
+    if any(feedback.feedback_type == 'negative' for convo in history for feedback in convo.feedbacks):
+        return True
+    if summary is None:
+        return False
+    return db.session.query(
+        Feedback.query.join(Conversation).filter(Conversation.chat_id == chat_id, Feedback.feedback_type == 'negative').exists()
+    ).scalar()
+
+
+def format_without_llm(user_question, query_result, chat_id, history, summary=None):
+    """
+    Writes the answer to a database question without the formatting model when RESPONSE_FORMATTER allows it.
+    In auto mode the model still writes the answers of chats with negative feedback, since the templates
+    cannot take the feedback into account.
+
+    Parameters:
+    - user_question (str): The question asked by the user.
+    - query_result (QueryResult): The result of the generated query.
+    - chat_id (int): The ID of the chat.
+    - history (list): The conversations sent verbatim to the formatting model.
+    - summary (str or None): The running summary of the older conversations.
+
+    Returns:
+    - str or None: The answer, or None when the formatting model must write it.
+    """
+    if RESPONSE_FORMATTER == "rules" or (RESPONSE_FORMATTER == "auto" and not has_negative_feedback(chat_id, history, summary)):
+        response = format_result_with_rules(user_question, query_result)
+        if response is not None:
+            formatted_responses.inc(formatter="rules")
+            return response
+        if RESPONSE_FORMATTER == "rules":
+            formatted_responses.inc(formatter="table")
+            return format_result_tables(query_result)
+    formatted_responses.inc(formatter="llm")
+    return None
+
+
+def format_response_with_gpt(user_question, data, chat_id, history=None, summary=None):
+    if history is None:
+        summary, history = load_conversation_context(chat_id)
+    message = build_format_messages(user_question, data, history, summary)
+    return llm.chat("format", message, max_tokens=500)
+
+
+def build_format_messages(user_question, data, history, summary=None):
     message=[{"role":"system","content":
                 '''
                 Your goal is to format the final answer given by the user in a user-friendly way and a full brief sentence taking into consideration his feedback if he has any.
@@ -752,28 +1288,27 @@ def format_response_with_gpt(user_question, data, chat_id):
                 *Appropriate question asking the user to choose*   
                 '''
               }]
-    previous_conversations = Conversation.query.filter_by(chat_id=chat_id, executable="Yes").order_by(Conversation.timestamp).all()
+    if summary:
+        message.append({"role": "system", "content": f"Summary of the earlier conversation: {summary}"})
+    previous_conversations = [convo for convo in history if convo.executable == "Yes"]
     for convo in previous_conversations:
-        user_query_with_feedback = convo.user_query
-        feedbacks = Feedback.query.filter_by(conversation_id=convo.id, feedback_type='negative').all()
-        for feedback in feedbacks:
-            user_query_with_feedback += f" (Negative feedback on assistant response: {feedback.feedback_comment})"
-        message.append({"role": "user", "content": user_query_with_feedback})
+        message.append({"role": "user", "content": query_with_feedback(convo)})
         message.append({"role": "assistant", "content": convo.response})
 
         
     message.append({"role": "user", "content": f"{user_question}, Answer: {data}"})
-    print(message)
-    response = client.chat.completions.create(
-        model='gpt-4o',  
-        messages=message,
-        max_tokens=500
-    )
-    
-    return response.choices[0].message.content.strip()
+    logger.debug("Format messages: %s", message)
+    return message
 
 
-def get_pdf_answer(user_question,relevant_chunks,chat_id):
+def get_pdf_answer(user_question,relevant_chunks,chat_id,history=None,summary=None):
+    if history is None:
+        summary, history = load_conversation_context(chat_id)
+    message = build_pdf_messages(user_question, relevant_chunks, history, summary)
+    return llm.chat("pdf_answer", message, max_tokens=500)
+
+
+def build_pdf_messages(user_question, relevant_chunks, history, summary=None):
     message=[{"role":"system","content":
                 '''
                 You will be given chunks of a PDF that are labeled by chunk number.
@@ -784,14 +1319,12 @@ def get_pdf_answer(user_question,relevant_chunks,chat_id):
                 And at the end, ask a kind question similar to "Is there anything else I can assist you with?", but change this question often in order to avoid repitition.
                 '''
               }]
-    previous_conversations = Conversation.query.filter_by(chat_id=chat_id, executable="PDF").order_by(Conversation.timestamp).all()
+    if summary:
+        message.append({"role": "system", "content": f"Summary of the earlier conversation: {summary}"})
+    previous_conversations = [convo for convo in history if convo.executable == "PDF"]
 
     for convo in previous_conversations:
-        user_query_with_feedback = convo.user_query
-        feedbacks = Feedback.query.filter_by(conversation_id=convo.id, feedback_type='negative').all()
-        for feedback in feedbacks:
-            user_query_with_feedback += f" (Negative feedback on assistant response: {feedback.feedback_comment})"
-        message.append({"role": "user", "content": user_query_with_feedback})
+        message.append({"role": "user", "content": query_with_feedback(convo)})
         message.append({"role": "assistant", "content": convo.response})
     
     pdf_title=relevant_chunks[0]['pdf_title']
@@ -799,13 +1332,21 @@ def get_pdf_answer(user_question,relevant_chunks,chat_id):
     for chunk in relevant_chunks:
         prompt += f"(Chunk {chunk['chunk_number']}):\n{chunk['chunk_text']}\n\n"
     prompt += f"User Question: {user_question}\n\n"
-    print(prompt)
+    logger.debug("PDF prompt: %s", prompt)
     message.append({'role':'user','content':prompt})
-    
-    response = client.chat.completions.create(
-        model='gpt-4o',  
-        messages=message,
-        max_tokens=500
-    )
-    
-    return response.choices[0].message.content.strip()
+    return message
+
+
+def stream_completion(stage, message, max_tokens):
+    """
+    Streams a completion.
+
+    Parameters:
+    - stage (str): The stage making the call, it selects the model.
+    - message (list): The messages to send.
+    - max_tokens (int): The maximum number of tokens to generate.
+
+    Yields:
+    - str: The content of each chunk as it arrives.
+    """
+    yield from llm.stream_chat(stage, message, max_tokens)
@@ -1,24 +1,26 @@
 from flask import Blueprint, request, jsonify
 import chromadb
 from chromadb.config import Settings
-from extensions import get_embeddings
+from extensions import get_embeddings, bump_cache_version, invalidate_sql_cache
 import hashlib
-import chromadb.utils.embedding_functions as embedding_functions
-import os
+from providers import embedding_function
 
 fewshot_bp = Blueprint('fewshot_bp', __name__)
 
 client = chromadb.PersistentClient(path="chroma_data", settings=Settings())
 
-openai_ef = embedding_functions.OpenAIEmbeddingFunction(
-                api_key=str(os.getenv('OPENAI_API_KEY')),
-                model_name="text-embedding-3-large"
-            )
+openai_ef = embedding_function
 
 collection_name = "few_shot"
 collection = client.get_or_create_collection(name=collection_name,embedding_function=openai_ef)
 
 
+def examples_changed():
+    # Cached SQL answers may have been built from the previous examples
+    bump_cache_version(collection_name)
+    invalidate_sql_cache()
+
+
 @fewshot_bp.route('/fewshot', methods=['POST'])
 def add_few_shot():
     data = request.json
@@ -50,6 +52,7 @@ def add_few_shot():
             "ChartName": chartname
         }]
     )
+    examples_changed()
     return jsonify({"message": "Few-shot example added successfully.", "id": unique_id}), 201
 
 
@@ -80,6 +83,7 @@ def get_few_shots():
 def delete_few_shot(id):
     try:
         collection.delete(ids=[id])
+        examples_changed()
         return jsonify({"message": "Few-shot example deleted successfully."}), 204
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -94,6 +98,7 @@ def delete_all_few_shots():
             all_ids.append(id)
                 
         collection.delete(ids=all_ids)
+        examples_changed()
         return jsonify({"message": "All few-shot examples deleted successfully."}), 204
     except Exception as e:
         return jsonify({"error": str(e)}), 500
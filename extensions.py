@@ -2,14 +2,15 @@ from flask_sqlalchemy import SQLAlchemy
 from flask_marshmallow import Marshmallow
 from flask_bcrypt import Bcrypt
 from flask_migrate import Migrate
+from sqlalchemy import event, create_engine, text
+from sqlalchemy.orm import Session
 from datetime import datetime, timedelta
+from decimal import Decimal
 import jwt, re
 import os
 import pyotp
-from openai import OpenAI
 import numpy as np
 import chromadb
-import chromadb.utils.embedding_functions as embedding_functions
 from chromadb.config import Settings
 import googlemaps
 import json
@@ -22,7 +23,21 @@ from email.message import EmailMessage
 import smtplib
 from email.utils import formataddr
 from langchain.text_splitter import RecursiveCharacterTextSplitter
+from providers import llm, embedding_function
+from observability import logger, span, StageTimings, optional_stage, with_request_context
+import ast
 import hashlib
+import html
+import itertools
+import math
+import sqlparse
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
 
 
 
@@ -37,22 +52,95 @@ if not os.path.exists(UPLOAD_FOLDER):
 # Initialize ChromaDB client with a persistent local path
 client_chroma = chromadb.PersistentClient(path="chroma_data", settings=Settings())
 
-openai_ef = embedding_functions.OpenAIEmbeddingFunction(
-                api_key=str(os.getenv('OPENAI_API_KEY')),
-                model_name="text-embedding-3-large"
-            )
+openai_ef = embedding_function
 # Get or create the collection
 collection_name = "few_shot"
 collection = client_chroma.get_collection(name=collection_name,embedding_function=openai_ef)
 
+_chroma_collections_lock = threading.Lock()
+
+def get_or_create_collection(name):
+    """
+    Opens a Chroma collection of the client, creating it if needed. Concurrent get_or_create_collection
+    calls on a collection that does not exist yet can fail in Chroma, so they are serialized.
+    """
+    with _chroma_collections_lock:
+        return client_chroma.get_or_create_collection(name=name, embedding_function=openai_ef)
+
 
 SECRET_KEY= os.getenv('SECRET_KEY')
 EMAIL = os.getenv('EMAIL')
 PASS = os.getenv('PASS')
 
-client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
-
-gmaps = googlemaps.Client(key=os.getenv('GOOGLE_MAPS_API_KEY'))
+# Seconds a geocoding request, retries included, may take
+GEOCODE_TIMEOUT = float(os.getenv('GEOCODE_TIMEOUT', 5))
+
+gmaps = googlemaps.Client(key=os.getenv('GOOGLE_MAPS_API_KEY'), timeout=GEOCODE_TIMEOUT, retry_timeout=GEOCODE_TIMEOUT)
+
+# Embedding cache entries are keyed by the provider's namespace so that vectors of a stand-in never mix with real ones
+EMBEDDING_MODEL = llm.embedding_namespace
+# Local SQLite file shared by the on-disk caches; it survives restarts and is shared between workers
+CACHE_DB_PATH = os.getenv('CACHE_DB_PATH', 'cache/cache.sqlite3')
+EMBEDDING_CACHE_SIZE = int(os.getenv('EMBEDDING_CACHE_SIZE', 2048))
+# Geocoded addresses are kept for GEOCODE_CACHE_TTL seconds, addresses that could not be geocoded for GEOCODE_NEGATIVE_TTL
+GEOCODE_CACHE_TTL = int(os.getenv('GEOCODE_CACHE_TTL', 90 * 24 * 3600))
+GEOCODE_NEGATIVE_TTL = int(os.getenv('GEOCODE_NEGATIVE_TTL', 7 * 24 * 3600))
+# Addresses of a map are geocoded concurrently on GEOCODE_WORKERS threads, with at most GEOCODE_RATE requests
+# per second to the Geocoding API over all threads and bursts of up to GEOCODE_BURST requests
+GEOCODE_WORKERS = int(os.getenv('GEOCODE_WORKERS', 8))
+GEOCODE_RATE = float(os.getenv('GEOCODE_RATE', 25))
+GEOCODE_BURST = int(os.getenv('GEOCODE_BURST', 10))
+# Maximum number of locations drawn on a map
+MAP_MAX_POINTS = int(os.getenv('MAP_MAX_POINTS', 30))
+# Size in degrees of the cells of the spatial grid over the restaurants and consumers
+SPATIAL_CELL_DEGREES = float(os.getenv('SPATIAL_CELL_DEGREES', 0.05))
+
+SQL_CACHE_ENABLED = os.getenv('SQL_CACHE_ENABLED', 'true').lower() == 'true'
+# Maximum embedding distance between two questions for the cached answer of one to be reused for the other
+SQL_CACHE_DISTANCE_THRESHOLD = float(os.getenv('SQL_CACHE_DISTANCE_THRESHOLD', 0.1))
+SQL_CACHE_TTL = int(os.getenv('SQL_CACHE_TTL', 7 * 24 * 3600))
+SQL_CACHE_MAX_ENTRIES = int(os.getenv('SQL_CACHE_MAX_ENTRIES', 10000))
+
+# Results of executed TestingData queries are reused for QUERY_CACHE_TTL seconds unless a table they read is written
+QUERY_CACHE_TTL = int(os.getenv('QUERY_CACHE_TTL', 300))
+QUERY_CACHE_MAX_ROWS = int(os.getenv('QUERY_CACHE_MAX_ROWS', 100000))
+TESTING_DATA_TABLES = ('consumers', 'consumer_preferences', 'ratings', 'restaurants', 'restaurant_cuisines')
+
+# Pool of read-only connections used to run the generated queries against the TestingData database
+TESTING_DB_POOL_SIZE = int(os.getenv('TESTING_DB_POOL_SIZE', 10))
+TESTING_DB_MAX_OVERFLOW = int(os.getenv('TESTING_DB_MAX_OVERFLOW', 5))
+TESTING_DB_POOL_TIMEOUT = float(os.getenv('TESTING_DB_POOL_TIMEOUT', 5))
+SQL_STATEMENT_TIMEOUT_MS = int(os.getenv('SQL_STATEMENT_TIMEOUT_MS', 10000))
+
+# On PostgreSQL every generated statement is checked with EXPLAIN before it runs: a statement estimated to return more
+# than SQL_MAX_ESTIMATED_ROWS rows is limited, or rejected when SQL_COST_GUARD is reject, and a statement whose
+# estimated cost stays above SQL_MAX_ESTIMATED_COST is rejected. SQL_COST_GUARD=off disables the check
+SQL_COST_GUARD = os.getenv('SQL_COST_GUARD', 'limit')
+SQL_MAX_ESTIMATED_COST = float(os.getenv('SQL_MAX_ESTIMATED_COST', 1000000))
+SQL_MAX_ESTIMATED_ROWS = float(os.getenv('SQL_MAX_ESTIMATED_ROWS', 1000000))
+
+# Rows are streamed from a server-side cursor in batches and at most QUERY_ROW_CAP rows of a statement are kept,
+# the rest of the result is served page by page from the result endpoint
+QUERY_ROW_CAP = int(os.getenv('QUERY_ROW_CAP', 1000))
+QUERY_FETCH_BATCH = int(os.getenv('QUERY_FETCH_BATCH', 500))
+RESULT_PAGE_SIZE = int(os.getenv('RESULT_PAGE_SIZE', 100))
+# Number of rows of a table answer kept in the response and stored with the conversation
+TABLE_INLINE_ROWS = int(os.getenv('TABLE_INLINE_ROWS', 50))
+# Results of at most RULES_MAX_LIST_ROWS rows and RULES_MAX_COLUMNS columns can be answered without the formatting model
+RULES_MAX_LIST_ROWS = int(os.getenv('RULES_MAX_LIST_ROWS', 10))
+RULES_MAX_COLUMNS = int(os.getenv('RULES_MAX_COLUMNS', 4))
+
+# How the values of rows sharing the same (x, y) cell of a heatmap are combined: sum, avg or count
+HEATMAP_AGGREGATE = os.getenv('HEATMAP_AGGREGATE', 'sum')
+
+# Charts with more points than this are reduced before the code is generated:
+# line series with Largest-Triangle-Three-Buckets, bar and pie charts to their top categories plus "Other"
+LINE_CHART_MAX_POINTS = int(os.getenv('LINE_CHART_MAX_POINTS', 500))
+BAR_CHART_MAX_CATEGORIES = int(os.getenv('BAR_CHART_MAX_CATEGORIES', 25))
+PIE_CHART_MAX_CATEGORIES = int(os.getenv('PIE_CHART_MAX_CATEGORIES', 10))
+
+# Thread pool used to run the independent steps of a request concurrently
+executor = ThreadPoolExecutor(max_workers=int(os.getenv('WORKER_THREADS', 16)), thread_name_prefix='chatbot-worker')
 
 
 db = SQLAlchemy()
@@ -268,27 +356,144 @@ def change_password_email (recipient, user_name):
     smtp.sendmail(sender, recipient, email.as_string())
     smtp.quit()
 
+_cache_db = None
+_cache_db_lock = threading.Lock()
+
+def get_cache_db():
+    """
+    Returns the shared connection to the local cache database, creating the file on first use.
+
+    Returns:
+    - sqlite3.Connection: A connection that may be used from any thread while holding _cache_db_lock.
+    """
+    global _cache_db
+    with _cache_db_lock:
+        if _cache_db is None:
+            directory = os.path.dirname(CACHE_DB_PATH)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            _cache_db = sqlite3.connect(CACHE_DB_PATH, check_same_thread=False, timeout=10)
+            _cache_db.execute('PRAGMA journal_mode=WAL')
+            # Versions of the cached resources, read on every request
+            _cache_db.execute('CREATE TABLE IF NOT EXISTS versions (name TEXT PRIMARY KEY, version INTEGER NOT NULL)')
+            _cache_db.commit()
+        return _cache_db
+
+
+class EmbeddingCache:
+    """
+    Two-tier embedding cache: an in-process LRU in front of a SQLite table that survives restarts.
+    Entries are keyed by a hash of the embedding model and the input text.
+    """
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._table_ready = False
+
+    @staticmethod
+    def make_key(model, text):
+        return hashlib.sha256(f"{model}\x00{text}".encode('utf-8')).hexdigest()
+
+    def _db(self):
+        conn = get_cache_db()
+        if not self._table_ready:
+            with _cache_db_lock:
+                conn.execute('CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, model TEXT NOT NULL, vector BLOB NOT NULL, created_at REAL NOT NULL)')
+                conn.commit()
+            self._table_ready = True
+        return conn
+
+    def _remember(self, key, embedding):
+        with self.lock:
+            self.memory[key] = embedding
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.max_entries:
+                self.memory.popitem(last=False)
+
+    def get(self, model, text):
+        key = self.make_key(model, text)
+        with self.lock:
+            embedding = self.memory.get(key)
+            if embedding is not None:
+                self.memory.move_to_end(key)
+                self.memory_hits += 1
+                return embedding
+
+        conn = self._db()
+        with _cache_db_lock:
+            row = conn.execute('SELECT vector FROM embeddings WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            with self.lock:
+                self.misses += 1
+            return None
+
+        embedding = array('f', row[0]).tolist()
+        self._remember(key, embedding)
+        with self.lock:
+            self.disk_hits += 1
+        return embedding
+
+    def set(self, model, text, embedding):
+        key = self.make_key(model, text)
+        self._remember(key, embedding)
+        conn = self._db()
+        with _cache_db_lock:
+            conn.execute(
+                'INSERT OR REPLACE INTO embeddings (key, model, vector, created_at) VALUES (?, ?, ?, ?)',
+                (key, model, array('f', embedding).tobytes(), time.time())
+            )
+            conn.commit()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+                "memory_entries": len(self.memory)
+            }
+
+
+embedding_cache = EmbeddingCache(EMBEDDING_CACHE_SIZE)
+
 def get_embeddings(text):
-    response = client.embeddings.create(
-        model="text-embedding-3-large",
-        input=text,
-        encoding_format="float"
-    )
-    return response.data[0].embedding 
+    """
+    Returns the embedding of the given text, served from the embedding cache when possible.
+
+    Parameters:
+    - text (str): The text to embed.
+
+    Returns:
+    - list: The embedding vector.
+    """
+    with span("embedding"):
+        embedding = embedding_cache.get(EMBEDDING_MODEL, text)
+        if embedding is not None:
+            return embedding
 
+        embedding = llm.embed([text])[0]
+        embedding_cache.set(EMBEDDING_MODEL, text, embedding)
+    return embedding
 
-def select_relevant_few_shots(user_question, user_id, top_n_main=5, top_n_user=2, distance_threshold=1.5):
-    user_embedding = get_embeddings(user_question)
-    relevant_examples = []
 
-    # Query main collection
-    results_main = collection.query(
-        query_embeddings=[user_embedding],
-        n_results=top_n_main,
+def query_few_shots(few_shot_collection, embedding, n_results, distance_threshold):
+    """
+    Returns the examples of a few-shot collection that are closer than distance_threshold to an embedding.
+    """
+    results = few_shot_collection.query(
+        query_embeddings=[embedding],
+        n_results=n_results,
         include=['distances', 'metadatas']
     )
 
-    for distances, metadata_list in zip(results_main['distances'], results_main['metadatas']):
+    relevant_examples = []
+    for distances, metadata_list in zip(results['distances'], results['metadatas']):
         for distance, metadata in zip(distances, metadata_list):
             if distance < distance_threshold:
                 relevant_examples.append({
@@ -299,30 +504,616 @@ def select_relevant_few_shots(user_question, user_id, top_n_main=5, top_n_user=2
                     "Location": metadata.get('Location'),
                     "ChartName": metadata.get('ChartName')
                 })
+    return relevant_examples
 
-    # Query user-specific collection
-    user_collection_name = f"few_shot_user_{user_id}"
-    user_collection = client_chroma.get_or_create_collection(name=user_collection_name, embedding_function=openai_ef)
 
-    results_user = user_collection.query(
-        query_embeddings=[user_embedding],
-        n_results=top_n_user,
-        include=['distances', 'metadatas']
+def query_user_few_shots(user_id, embedding, n_results, distance_threshold):
+    user_collection = get_or_create_collection(f"few_shot_user_{user_id}")
+    return query_few_shots(user_collection, embedding, n_results, distance_threshold)
+
+
+def select_relevant_few_shots(user_question, user_id, top_n_main=5, top_n_user=2, distance_threshold=1.5, timings=None):
+    user_embedding = get_embeddings(user_question)
+
+    with optional_stage(timings, "few_shot_query"):
+        relevant_examples = query_few_shots(collection, user_embedding, top_n_main, distance_threshold)
+    with optional_stage(timings, "few_shot_user_query"):
+        relevant_examples += query_user_few_shots(user_id, user_embedding, top_n_user, distance_threshold)
+    return relevant_examples
+
+
+def submit_few_shot_queries(user_question, user_id, timings, top_n_main=5, top_n_user=2, distance_threshold=1.5):
+    """
+    Embeds the question once and submits the queries of the main and the user few-shot collections to the
+    worker pool as two tasks. It runs on the pool itself and returns the futures instead of waiting for them,
+    so that no task of the pool waits on another one.
+
+    Returns:
+    - list: The futures of the two queries, each resolving to a list of examples; the main collection first.
+    """
+    user_embedding = get_embeddings(user_question)
+    return [
+        executor.submit(timings.run, "few_shot_query", query_few_shots, collection, user_embedding, top_n_main, distance_threshold),
+        executor.submit(timings.run, "few_shot_user_query", query_user_few_shots, user_id, user_embedding, top_n_user, distance_threshold)
+    ]
+
+
+readonly_engine = None
+
+def init_readonly_engine(url):
+    """
+    Creates the pooled engine used for the generated TestingData queries.
+
+    Parameters:
+    - url (str): The TestingData database URL.
+
+    Returns:
+    - Engine: The engine.
+    """
+    global readonly_engine
+    options = {"pool_pre_ping": True}
+    if not url.startswith('sqlite'):
+        options.update(pool_size=TESTING_DB_POOL_SIZE, max_overflow=TESTING_DB_MAX_OVERFLOW, pool_timeout=TESTING_DB_POOL_TIMEOUT)
+    readonly_engine = create_engine(url, **options)
+
+    if readonly_engine.dialect.name == 'sqlite':
+        @event.listens_for(readonly_engine, 'connect')
+        def set_query_only(dbapi_connection, connection_record):
+            dbapi_connection.execute('PRAGMA query_only = ON')
+
+    return readonly_engine
+
+
+def get_readonly_engine():
+    if readonly_engine is None:
+        init_readonly_engine(os.getenv('DB_CONFIG_TEST'))
+    return readonly_engine
+
+
+class QueryMetrics:
+    """
+    Accumulates the time spent waiting for a pooled connection and running queries.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.checkouts = 0
+        self.checkout_wait_ms = 0.0
+        self.max_checkout_wait_ms = 0.0
+        self.queries = 0
+        self.query_ms = 0.0
+        self.max_query_ms = 0.0
+        self.errors = 0
+
+    def record_checkout(self, elapsed_ms):
+        with self.lock:
+            self.checkouts += 1
+            self.checkout_wait_ms += elapsed_ms
+            self.max_checkout_wait_ms = max(self.max_checkout_wait_ms, elapsed_ms)
+
+    def record_query(self, elapsed_ms, failed=False):
+        with self.lock:
+            self.queries += 1
+            self.query_ms += elapsed_ms
+            self.max_query_ms = max(self.max_query_ms, elapsed_ms)
+            if failed:
+                self.errors += 1
+
+    def stats(self):
+        with self.lock:
+            stats = {
+                "checkouts": self.checkouts,
+                "avg_checkout_wait_ms": round(self.checkout_wait_ms / self.checkouts, 2) if self.checkouts else 0.0,
+                "max_checkout_wait_ms": round(self.max_checkout_wait_ms, 2),
+                "queries": self.queries,
+                "avg_query_ms": round(self.query_ms / self.queries, 2) if self.queries else 0.0,
+                "max_query_ms": round(self.max_query_ms, 2),
+                "errors": self.errors
+            }
+        if readonly_engine is not None:
+            stats["pool"] = readonly_engine.pool.status()
+        return stats
+
+
+query_metrics = QueryMetrics()
+
+@contextmanager
+def readonly_connection():
+    """
+    Checks out a pooled TestingData connection inside a read-only transaction with a statement timeout.
+
+    Yields:
+    - Connection: The connection.
+    """
+    engine = get_readonly_engine()
+    start = time.perf_counter()
+    connection = engine.connect()
+    query_metrics.record_checkout((time.perf_counter() - start) * 1000)
+    try:
+        with connection.begin():
+            if engine.dialect.name == 'postgresql':
+                connection.exec_driver_sql('SET TRANSACTION READ ONLY')
+                connection.exec_driver_sql(f'SET LOCAL statement_timeout = {SQL_STATEMENT_TIMEOUT_MS}')
+            yield connection
+    finally:
+        connection.close()
+
+
+def run_readonly_query(sql_query, limit=QUERY_ROW_CAP, offset=0):
+    """
+    Runs a query on a read-only TestingData connection. Rows are streamed from a server-side cursor
+    so that only the requested window of the result is held in memory.
+
+    Parameters:
+    - sql_query (str): The query.
+    - limit (int): Maximum number of rows to return.
+    - offset (int): Number of leading rows to skip.
+
+    Returns:
+    - tuple: The column names (list), the fetched rows (list) and whether more rows are available (bool).
+    """
+    with span("sql_query"), readonly_connection() as connection:
+        start = time.perf_counter()
+        try:
+            data = connection.execution_options(stream_results=True, yield_per=QUERY_FETCH_BATCH).execute(text(sql_query))
+            keys = list(data.keys())
+            # One row past the window tells whether the result goes on
+            result = list(itertools.islice(data, offset, offset + limit + 1))
+            data.close()
+            has_more = len(result) > limit
+            result = result[:limit]
+        except Exception:
+            query_metrics.record_query((time.perf_counter() - start) * 1000, failed=True)
+            raise
+        query_metrics.record_query((time.perf_counter() - start) * 1000)
+    return keys, result, has_more
+
+
+class QueryResult:
+    """
+    Combined result of the statements of a generated query.
+
+    keys and rows hold the rows of every statement when all statements return the same columns,
+    e.g. one query per address for a map, and those of the last statement otherwise.
+    statements holds the (sql, keys, rows, has_more) of each statement in order, has_more telling
+    whether the rows of the statement were cut at QUERY_ROW_CAP.
+    estimate holds the cost and rows estimated by EXPLAIN summed over the statements that were
+    checked, None when none was.
+    """
+    def __init__(self, statements, estimates=()):
+        self.statements = statements
+        estimates = [estimate for estimate in estimates if estimate is not None]
+        self.estimate = None
+        if estimates:
+            self.estimate = {
+                "cost": sum(estimate["cost"] for estimate in estimates),
+                "rows": sum(estimate["rows"] for estimate in estimates),
+            }
+        last_keys = statements[-1][1]
+        self.uniform = all(keys == last_keys for _, keys, _, _ in statements)
+        self.keys = last_keys
+        if self.uniform:
+            self.rows = [row for _, _, rows, _ in statements for row in rows]
+        else:
+            self.rows = statements[-1][2]
+        self.truncated = [index for index, (_, _, _, has_more) in enumerate(statements) if has_more]
+        # Set when the result is shown as tables cut at that many rows
+        self.inline_rows = None
+
+    def tables(self):
+        # (keys, rows) of each table to show: one when the columns match, one per statement otherwise
+        if self.uniform:
+            return [(self.keys, self.rows)]
+        return [(keys, rows) for _, keys, rows, _ in self.statements]
+
+    def incomplete_statements(self):
+        """
+        Returns:
+        - list: The indexes of the statements whose rows are not all in the answer.
+        """
+        if self.inline_rows is None:
+            return self.truncated
+        if self.uniform and len(self.rows) > self.inline_rows:
+            return list(range(len(self.statements)))
+        return [index for index, (_, _, rows, has_more) in enumerate(self.statements) if has_more or len(rows) > self.inline_rows]
+
+    def for_prompt(self):
+        # The data given to the formatting model
+        if self.uniform:
+            return self.rows
+        return [rows for _, _, rows, _ in self.statements]
+
+
+def split_sql_statements(sql_query):
+    statements = []
+    for statement in sqlparse.split(sql_query):
+        # Without comments, a trailing "--" would otherwise comment out whatever the statement is wrapped in
+        statement = sqlparse.format(statement, strip_comments=True).strip().rstrip(';').strip()
+        if statement:
+            statements.append(statement)
+    return statements
+
+
+class QueryCostError(ValueError):
+    """Raised when the estimated cost of a generated statement is over the configured thresholds."""
+
+
+def explain_query(sql_query):
+    """
+    Asks PostgreSQL for the plan of a statement without running it.
+
+    Returns:
+    - dict: The estimated total cost ("cost") and number of rows ("rows") of the statement.
+    """
+    with span("sql_explain"), readonly_connection() as connection:
+        plan = connection.execute(text(f"EXPLAIN (FORMAT JSON) {sql_query}")).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    plan = plan[0]["Plan"]
+    return {"cost": float(plan["Total Cost"]), "rows": float(plan["Plan Rows"])}
+
+
+def guard_query_cost(sql_query, row_limit=QUERY_ROW_CAP):
+    """
+    Checks the plan of a statement against SQL_MAX_ESTIMATED_COST and SQL_MAX_ESTIMATED_ROWS before it runs.
+    A statement returning too many rows is wrapped in a LIMIT and checked again. The LIMIT keeps one row past
+    row_limit so that the caller can still tell that the result goes on.
+    Only PostgreSQL statements are checked.
+
+    Parameters:
+    - sql_query (str): The statement.
+    - row_limit (int): The number of rows the caller reads, QUERY_ROW_CAP or the end of the requested page.
+
+    Returns:
+    - tuple: The statement to run (str) and its estimate (dict), None when it was not checked.
+    """
+    if SQL_COST_GUARD == 'off' or get_readonly_engine().dialect.name != 'postgresql':
+        return sql_query, None
+    estimate = explain_query(sql_query)
+    if estimate["rows"] > SQL_MAX_ESTIMATED_ROWS:
+        if SQL_COST_GUARD == 'reject':
+            raise QueryCostError(f"This question would return about {int(estimate['rows'])} rows, please narrow it down.")
+        sql_query = f"SELECT * FROM ({sql_query}\n) AS limited_query LIMIT {row_limit + 1}"
+        estimate = explain_query(sql_query)
+    if estimate["cost"] > SQL_MAX_ESTIMATED_COST:
+        raise QueryCostError("This question would take too long to answer, please narrow it down.")
+    return sql_query, estimate
+
+
+def run_cached_query(sql_query):
+    """
+    Runs one statement on a read-only connection after checking its cost, or serves it from the query result cache.
+
+    Returns:
+    - tuple: The column names (list), the first QUERY_ROW_CAP rows (list), whether more rows are available (bool)
+      and the cost estimate of the statement (dict), None when it was not checked.
+    """
+    spatial = run_spatial_query(sql_query)
+    if spatial is not None:
+        return (*spatial, None)
+
+    cached = query_result_cache.get(sql_query)
+    if cached is not None:
+        return (*cached, None)
+
+    # Read before running the query so that a concurrent write invalidates the stored result
+    versions = query_result_cache.versions_of(sql_query)
+    guarded_query, estimate = guard_query_cost(sql_query)
+    keys, result, has_more = run_readonly_query(guarded_query)
+    query_result_cache.set(sql_query, keys, result, versions, has_more)
+    return keys, result, has_more, estimate
+
+
+def execute_sql_statements(sql_query):
+    """
+    Splits a generated query into its statements and runs them concurrently, each on its own pooled
+    read-only connection.
+
+    Parameters:
+    - sql_query (str): One or more SQL statements separated by semicolons.
+
+    Returns:
+    - QueryResult: The combined result.
+    """
+    statements = split_sql_statements(sql_query)
+    if not statements:
+        raise ValueError("The generated query does not contain any statement.")
+    if len(statements) == 1:
+        results = [run_cached_query(statements[0])]
+    else:
+        results = list(executor.map(with_request_context(run_cached_query), statements))
+    return QueryResult(
+        [(statement, keys, rows, has_more) for statement, (keys, rows, has_more, _) in zip(statements, results)],
+        [estimate for _, _, _, estimate in results]
     )
 
-    for distances, metadata_list in zip(results_user['distances'], results_user['metadatas']):
+
+def get_cache_version(name):
+    """
+    Returns the version of a cached resource, such as a few-shot collection. Versions start at 0.
+    """
+    conn = get_cache_db()
+    with _cache_db_lock:
+        row = conn.execute('SELECT version FROM versions WHERE name = ?', (name,)).fetchone()
+    return row[0] if row else 0
+
+
+def bump_cache_version(name):
+    conn = get_cache_db()
+    with _cache_db_lock:
+        conn.execute('INSERT INTO versions (name, version) VALUES (?, 1) ON CONFLICT(name) DO UPDATE SET version = version + 1', (name,))
+        conn.commit()
+
+
+def get_cache_versions(names):
+    conn = get_cache_db()
+    with _cache_db_lock:
+        rows = conn.execute(f'SELECT name, version FROM versions WHERE name IN ({", ".join("?" for _ in names)})', list(names)).fetchall()
+    versions = dict(rows)
+    return tuple(versions.get(name, 0) for name in names)
+
+
+class QueryResultCache:
+    """
+    In-process cache of TestingData query results keyed by the normalized SQL text.
+    Entries expire after a TTL, the total number of cached rows is bounded, and an entry is discarded
+    as soon as one of the tables it reads has been written, which is tracked through table versions
+    in the shared cache database so that writes from other processes are seen too.
+    """
+    def __init__(self, ttl, max_rows):
+        self.ttl = ttl
+        self.max_rows = max_rows
+        self.entries = OrderedDict()
+        self.cached_rows = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize(sql_query):
+        # Collapse whitespace outside of string literals
+        parts = re.split(r"('(?:[^']|'')*')", sql_query.strip().rstrip(';').strip())
+        return "".join(part if i % 2 else re.sub(r'\s+', ' ', part) for i, part in enumerate(parts))
+
+    @staticmethod
+    def tables_of(sql_query):
+        pattern = r'\b"?(' + '|'.join(TESTING_DATA_TABLES) + r')"?\b'
+        return tuple(sorted(set(name.lower() for name in re.findall(pattern, sql_query, re.IGNORECASE))))
+
+    def _drop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.cached_rows -= len(entry[4])
+
+    def get(self, sql_query):
+        key = self.normalize(sql_query)
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is not None:
+            expires_at, tables, versions, keys, rows, has_more = entry
+            if expires_at > time.time() and (not tables or get_cache_versions([f"table:{table}" for table in tables]) == versions):
+                with self.lock:
+                    if key in self.entries:
+                        self.entries.move_to_end(key)
+                    self.hits += 1
+                return keys, rows, has_more
+            with self.lock:
+                self._drop(key)
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def set(self, sql_query, keys, rows, versions=None, has_more=False):
+        """
+        Stores a result. versions should be read before the query ran so that a write that happens
+        while the query runs invalidates the entry.
+        """
+        if len(rows) > self.max_rows:
+            return
+        key = self.normalize(sql_query)
+        tables = self.tables_of(sql_query)
+        if versions is None:
+            versions = self.versions_of(sql_query)
+        with self.lock:
+            self._drop(key)
+            self.entries[key] = (time.time() + self.ttl, tables, versions, keys, rows, has_more)
+            self.cached_rows += len(rows)
+            while self.cached_rows > self.max_rows:
+                self._drop(next(iter(self.entries)))
+
+    def versions_of(self, sql_query):
+        tables = self.tables_of(sql_query)
+        return get_cache_versions([f"table:{table}" for table in tables]) if tables else ()
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self.entries), "cached_rows": self.cached_rows}
+
+
+query_result_cache = QueryResultCache(QUERY_CACHE_TTL, QUERY_CACHE_MAX_ROWS)
+
+def invalidate_query_cache(tables):
+    """
+    Marks TestingData tables as written so that cached query results that read them are discarded,
+    in this process and in every other process sharing the cache database.
+
+    Parameters:
+    - tables (iterable): The names of the written tables.
+    """
+    for table in set(tables):
+        bump_cache_version(f"table:{table}")
+
+
+@event.listens_for(Session, 'after_flush')
+def collect_flushed_tables(session, flush_context):
+    # Any ORM write to the TestingData tables, e.g. from load_data.py, invalidates the cached results that read them.
+    # The tables are only invalidated once the write is committed, a concurrent reader could otherwise cache the old
+    # rows under the new version
+    tables = session.info.setdefault('flushed_tables', set())
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        table = getattr(obj, '__tablename__', None)
+        if table in TESTING_DATA_TABLES:
+            tables.add(table)
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def collect_bulk_written_tables(orm_execute_state):
+    # Bulk statements such as Query.delete() bypass the flush
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        mapper = orm_execute_state.bind_mapper
+        table = mapper.local_table.name if mapper is not None else None
+        if table in TESTING_DATA_TABLES:
+            orm_execute_state.session.info.setdefault('flushed_tables', set()).add(table)
+
+
+@event.listens_for(Session, 'after_commit')
+def invalidate_flushed_tables(session):
+    tables = session.info.pop('flushed_tables', None)
+    if tables:
+        invalidate_query_cache(tables)
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_flushed_tables(session):
+    session.info.pop('flushed_tables', None)
+
+
+def normalize_question(question):
+    return re.sub(r'\s+', ' ', question.strip().lower()).rstrip('?.! ')
+
+
+# Words that usually refer back to an earlier answer
+FOLLOW_UP_PATTERN = re.compile(r'^(and|but|also|only|now|what about|how about)\b|\b(it|its|that|those|these|them|they|their|this|same|above|previous|instead|again|another|other|else|more|first|second|third|last|one|ones|there|he|she|his|her)\b', re.IGNORECASE)
+
+def is_follow_up_question(question):
+    """
+    Guesses whether a question depends on the earlier messages of the chat, e.g. "2" or "show them on a map".
+    """
+    normalized = normalize_question(question)
+    return len(normalized.split()) <= 2 or FOLLOW_UP_PATTERN.search(normalized) is not None
+
+
+def sql_cache_scope(system_prompt, user_id, context_messages):
+    """
+    Builds the part of the SQL cache key that is not the question itself.
+
+    Parameters:
+    - system_prompt (str): The routing system message before the few-shot examples are added; it covers the schema prompt and the user's PDFs.
+    - user_id (int): The ID of the user.
+    - context_messages (list): The chat messages that precede the question. When there are any, the latest exchange is
+      part of the key, so only the first question of a chat shares answers with other chats.
+
+    Returns:
+    - str: The scope hash.
+    """
+    parts = [
+        hashlib.sha256(system_prompt.encode('utf-8')).hexdigest(),
+        f"few_shot:{get_cache_version('few_shot')}"
+    ]
+    # Answers only depend on a user when that user has personal few-shot examples
+    user_collection = get_or_create_collection(f"few_shot_user_{user_id}")
+    if user_collection.count() > 0:
+        parts.append(f"user:{user_id}:{get_cache_version(f'few_shot_user_{user_id}')}")
+    if context_messages:
+        parts.append(json.dumps(context_messages[-2:], sort_keys=True))
+    return hashlib.sha256("\x00".join(parts).encode('utf-8')).hexdigest()
+
+
+def get_sql_cache_collection():
+    return get_or_create_collection("sql_cache")
+
+
+def lookup_sql_cache(user_question, scope, semantic=True):
+    """
+    Looks up a previous answer of the routing model, first by exact normalized question and then,
+    if semantic is True, by embedding distance to questions cached under the same scope.
+
+    Returns:
+    - tuple or None: The cached (sql_query, score, executable, location, chartname), or None on a miss.
+    """
+    if not SQL_CACHE_ENABLED:
+        return None
+    sql_cache = get_sql_cache_collection()
+    normalized = normalize_question(user_question)
+    entry_id = hashlib.sha256(f"{scope}\x00{normalized}".encode('utf-8')).hexdigest()
+
+    now = time.time()
+    exact = sql_cache.get(ids=[entry_id], include=['metadatas'])
+    if exact['ids']:
+        if exact['metadatas'][0].get('expires_at', 0) > now:
+            return tuple(json.loads(exact['metadatas'][0]['Result']))
+        sql_cache.delete(ids=[entry_id])
+    if not semantic or sql_cache.count() == 0:
+        return None
+
+    # Numbers must match exactly, e.g. "top 5" and "top 10" are close in embedding space
+    numbers = " ".join(re.findall(r'\d+(?:\.\d+)?', normalized))
+    embedding = get_embeddings(user_question)
+    with span("chroma_query"):
+        results = sql_cache.query(
+            query_embeddings=[embedding],
+            n_results=1,
+            where={"$and": [{"scope": scope}, {"numbers": numbers}, {"expires_at": {"$gt": now}}]},
+            include=['distances', 'metadatas']
+        )
+    for distances, metadata_list in zip(results['distances'], results['metadatas']):
         for distance, metadata in zip(distances, metadata_list):
-            if distance < distance_threshold:
-                relevant_examples.append({
-                    "Question": metadata.get('Question'),
-                    "Score": metadata.get('Score'),
-                    "Executable": metadata.get('Executable'),
-                    "Answer": metadata.get('Answer'),
-                    "Location": metadata.get('Location'),
-                    "ChartName": metadata.get('ChartName')
-                })
+            if distance < SQL_CACHE_DISTANCE_THRESHOLD:
+                return tuple(json.loads(metadata['Result']))
+    return None
 
-    return relevant_examples
+
+def store_sql_cache(user_question, scope, user_id, result):
+    """
+    Caches an answer of the routing model for SQL_CACHE_TTL seconds. Once the cache holds more than
+    SQL_CACHE_MAX_ENTRIES answers, the oldest tenth is removed.
+    """
+    if not SQL_CACHE_ENABLED:
+        return
+    sql_cache = get_sql_cache_collection()
+    normalized = normalize_question(user_question)
+    entry_id = hashlib.sha256(f"{scope}\x00{normalized}".encode('utf-8')).hexdigest()
+    sql_cache.upsert(
+        ids=[entry_id],
+        embeddings=[get_embeddings(user_question)],
+        metadatas=[{
+            "Question": normalized,
+            "scope": scope,
+            "numbers": " ".join(re.findall(r'\d+(?:\.\d+)?', normalized)),
+            "user_id": str(user_id),
+            "sql_query": str(result[0]),
+            "expires_at": time.time() + SQL_CACHE_TTL,
+            "Result": json.dumps(list(result))
+        }]
+    )
+    if sql_cache.count() > SQL_CACHE_MAX_ENTRIES:
+        entries = sql_cache.get(include=['metadatas'])
+        by_age = sorted(zip(entries['ids'], entries['metadatas']), key=lambda entry: entry[1].get('expires_at', 0))
+        excess = len(by_age) - SQL_CACHE_MAX_ENTRIES + SQL_CACHE_MAX_ENTRIES // 10
+        sql_cache.delete(ids=[entry_id for entry_id, _ in by_age[:excess]])
+
+
+def invalidate_sql_cache(user_id=None):
+    """
+    Removes cached routing answers after few-shot examples change: all of them, or only those of one user.
+    """
+    sql_cache = get_sql_cache_collection()
+    if user_id is None:
+        ids = sql_cache.get(include=[])['ids']
+    else:
+        ids = sql_cache.get(where={"user_id": str(user_id)}, include=[])['ids']
+    if ids:
+        sql_cache.delete(ids=ids)
+
+
+def evict_sql_cache_answer(sql_query):
+    """
+    Removes the cached routing answers that generated a query, e.g. after negative feedback on it,
+    so that the question is sent to the routing model again.
+    """
+    sql_cache = get_sql_cache_collection()
+    ids = sql_cache.get(where={"sql_query": str(sql_query)}, include=[])['ids']
+    if ids:
+        sql_cache.delete(ids=ids)
 
 
 # Function to detect sensitive info
@@ -347,85 +1138,969 @@ def format_address(result):
         return None
     address_data = result
     address_parts = [str(part) for part in address_data if part]
-    print(", ".join(address_parts))
+    logger.debug("Address: %s", ", ".join(address_parts))
     return ", ".join(address_parts)
 
+class GeocodeCache:
+    """
+    Persistent cache of geocoded addresses in the shared cache database, keyed by the normalized address.
+    Addresses that could not be geocoded are cached too, with a shorter TTL, and for every address the
+    suffix that was finally geocoded is recorded.
+    """
+    def __init__(self, ttl, negative_ttl):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self._table_ready = False
+
+    @staticmethod
+    def normalize(address):
+        parts = [re.sub(r'\s+', ' ', part).strip().lower() for part in address.split(',')]
+        return ', '.join(part for part in parts if part)
+
+    def _db(self):
+        conn = get_cache_db()
+        if not self._table_ready:
+            with _cache_db_lock:
+                conn.execute('CREATE TABLE IF NOT EXISTS geocodes (address TEXT PRIMARY KEY, lat REAL, lng REAL, resolved_address TEXT, created_at REAL NOT NULL)')
+                conn.commit()
+            self._table_ready = True
+        return conn
+
+    def get(self, address):
+        """
+        Returns:
+        - tuple or None: None when the address is not cached, otherwise (found, lat, lng, resolved_address)
+          where found is False for an address that could not be geocoded.
+        """
+        conn = self._db()
+        with _cache_db_lock:
+            row = conn.execute('SELECT lat, lng, resolved_address, created_at FROM geocodes WHERE address = ?', (self.normalize(address),)).fetchone()
+        if row is not None:
+            lat, lng, resolved_address, created_at = row
+            found = lat is not None
+            if time.time() - created_at < (self.ttl if found else self.negative_ttl):
+                with self.lock:
+                    if found:
+                        self.hits += 1
+                    else:
+                        self.negative_hits += 1
+                return found, lat, lng, resolved_address
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def set(self, address, location, resolved_address=None):
+        """
+        Stores the coordinates of an address, or records that it could not be geocoded when location is None.
+        """
+        lat, lng = location if location is not None else (None, None)
+        conn = self._db()
+        with _cache_db_lock:
+            conn.execute(
+                'INSERT OR REPLACE INTO geocodes (address, lat, lng, resolved_address, created_at) VALUES (?, ?, ?, ?, ?)',
+                (self.normalize(address), lat, lng, resolved_address, time.time())
+            )
+            conn.commit()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.negative_hits + self.misses
+            return {
+                "hits": self.hits,
+                "negative_hits": self.negative_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.negative_hits) / lookups if lookups else 0.0
+            }
+
+
+geocode_cache = GeocodeCache(GEOCODE_CACHE_TTL, GEOCODE_NEGATIVE_TTL)
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter shared by threads: tokens are added at rate per second up to capacity,
+    and every request takes one.
+    """
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, timeout=None):
+        """
+        Waits for a token.
+
+        Returns:
+        - bool: True when a token was taken, False when none was available before the timeout.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                wait_time = (1 - self.tokens) / self.rate
+            if deadline is not None and now + wait_time > deadline:
+                return False
+            time.sleep(wait_time)
+
+
+geocode_rate_limiter = TokenBucket(GEOCODE_RATE, GEOCODE_BURST)
+geocode_executor = ThreadPoolExecutor(max_workers=GEOCODE_WORKERS, thread_name_prefix='chatbot-geocoder')
+
 # Helper function to get Google Maps coordinates
 def get_google_maps_loc(address):
+    """
+    Geocodes an address, dropping its leading parts one at a time until a suffix is found.
+    Every address and suffix looked up is cached, including the ones that were not found.
+
+    Returns:
+    - tuple or None: The (lat, lng) of the address, or None when no suffix could be geocoded.
+    """
     if not address:
         return None
-    
-    def attempt_geocode(addr_parts):
-        addr = ", ".join(addr_parts)
-        try:
+
+    cached = geocode_cache.get(address)
+    if cached is not None:
+        found, lat, lng, resolved_address = cached
+        return (lat, lng) if found else None
+
+    def attempt_geocode(addr, use_cache):
+        # Returns the location, None when the address is unknown, or raises when the lookup failed
+        cached = geocode_cache.get(addr) if use_cache else None
+        if cached is not None:
+            found, lat, lng, _ = cached
+            return (lat, lng) if found else None
+        if not geocode_rate_limiter.acquire(timeout=GEOCODE_TIMEOUT):
+            raise TimeoutError("Geocoding rate limit reached")
+        with span("geocode"):
             geocode_result = gmaps.geocode(addr)
-            if geocode_result:
-                location = geocode_result[0]['geometry']['location']
-                print(location)
-                return location['lat'], location['lng']
-        except Exception as e:
-            print(f"Error geocoding address {addr}: {e}")
-        return None
+        location = None
+        if geocode_result:
+            location = geocode_result[0]['geometry']['location']
+            logger.debug("Geocoded %s: %s", addr, location)
+            location = (location['lat'], location['lng'])
+        geocode_cache.set(addr, location, addr if location else None)
+        return location
 
     address_parts = address.split(", ")
+    failed = False
     for i in range(len(address_parts)):
-        result = attempt_geocode(address_parts[i:])
+        addr = ", ".join(address_parts[i:])
+        try:
+            # The full address was already looked up in the cache
+            result = attempt_geocode(addr, use_cache=i > 0)
+        except Exception as e:
+            logger.warning("Error geocoding address %s: %s", addr, e)
+            failed = True
+            continue
         if result is not None:
+            if i > 0:
+                geocode_cache.set(address, result, addr)
             return result
-    
-    print("Could not geocode address with any combination.")
+
+    logger.info("Could not geocode address with any combination.")
+    # A lookup that failed may succeed later, only addresses that are not known are cached as misses
+    if not failed:
+        geocode_cache.set(address, None)
     return None
 
 
+def geocode_batch(addresses, timeout=GEOCODE_TIMEOUT):
+    """
+    Geocodes addresses concurrently on the geocoding pool. Each distinct address is looked up once and
+    the whole batch waits at most timeout seconds, so the latency does not grow with the number of addresses.
 
+    Parameters:
+    - addresses (list): The addresses.
+    - timeout (float): Seconds to wait for the batch.
 
-def format_as_table(results, keys):
-    table = '<table border="1">\n<tr>'
-    # Create table header
-    for key in keys:
-        table += f'<th>{key}</th>'
-    table += '</tr>\n'
-    # Create table rows
-    for row in results:
-        table += '<tr>'
-        for value in row:
-            table += f'<td>{value}</td>'
-        table += '</tr>\n'
-    table += '</table>'
-    return table
+    Returns:
+    - dict: The (lat, lng) of each address, None for the ones that could not be geocoded in time.
+    """
+    futures = {address: geocode_executor.submit(with_request_context(get_google_maps_loc), address) for address in set(addresses) if address}
+    done, _ = wait(futures.values(), timeout=timeout)
+    locations = {}
+    for address, future in futures.items():
+        if future in done and future.exception() is None:
+            locations[address] = future.result()
+        else:
+            logger.warning("Geocoding of %s did not finish in time", address)
+            locations[address] = None
+    return locations
+
+
+class Gazetteer:
+    """
+    Offline index of known places built from the TestingData tables: restaurants by name, city centroids
+    averaged over the restaurants and consumers of each city, and the known states and countries. It is rebuilt
+    when one of these tables is written.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.versions = None
+        self.restaurants = {}
+        self.cities = {}
+        self.regions = set()
+
+    @staticmethod
+    def normalize(value):
+        return re.sub(r'\s+', ' ', str(value)).strip().lower()
+
+    @staticmethod
+    def is_number(value):
+        try:
+            float(value)
+            return True
+        except ValueError:
+            return False
+
+    def _build(self):
+        restaurants = {}
+        city_points = {}
+        regions = set()
+        with readonly_connection() as connection:
+            rows = connection.execute(text('SELECT "Name", "City", "State", "Country", "Latitude", "Longitude" FROM restaurants WHERE "Latitude" IS NOT NULL AND "Longitude" IS NOT NULL'))
+            for name, city, state, country, lat, lng in rows:
+                if name:
+                    restaurants.setdefault(self.normalize(name), {})[self.normalize(city) if city else None] = (lat, lng)
+                if city:
+                    city_points.setdefault(self.normalize(city), []).append((lat, lng))
+                regions.update(self.normalize(region) for region in (state, country) if region)
+            rows = connection.execute(text('SELECT "City", "State", "Country", "Latitude", "Longitude" FROM consumers WHERE "City" IS NOT NULL AND "Latitude" IS NOT NULL AND "Longitude" IS NOT NULL'))
+            for city, state, country, lat, lng in rows:
+                city_points.setdefault(self.normalize(city), []).append((lat, lng))
+                regions.update(self.normalize(region) for region in (state, country) if region)
+        cities = {city: (sum(p[0] for p in points) / len(points), sum(p[1] for p in points) / len(points)) for city, points in city_points.items()}
+        return restaurants, cities, regions
+
+    def _refresh(self):
+        versions = get_cache_versions(["table:restaurants", "table:consumers"])
+        with self.lock:
+            if versions == self.versions:
+                return
+            self.restaurants, self.cities, self.regions = self._build()
+            self.versions = versions
+
+    def lookup(self, values):
+        """
+        Looks the values of a result row up: a restaurant name, preferably together with its city, or else a city.
+        A city centroid is only returned for a row that describes places, whose other values are known cities,
+        states, countries or numbers; a row naming something unknown, e.g. a restaurant missing from the table,
+        would otherwise be shown with confidence in the middle of its city.
+
+        Returns:
+        - tuple or None: The (lat, lng) of the place, or None when no value is known.
+        """
+        self._refresh()
+        normalized = [self.normalize(value) for value in values if value is not None and str(value).strip()]
+        for value in normalized:
+            by_city = self.restaurants.get(value)
+            if by_city:
+                for city in normalized:
+                    if city in by_city:
+                        return by_city[city]
+                return next(iter(by_city.values()))
+        places = [value for value in normalized if not self.is_number(value)]
+        if not all(value in self.cities or value in self.regions for value in places):
+            return None
+        for value in places:
+            if value in self.cities:
+                return self.cities[value]
+        return None
 
 
+gazetteer = Gazetteer()
 
-def generate_chart_code(data, xlabel, ylabel, chart_name, base_code):
-    chart_data = json.dumps(data, indent=2)
-    chart_component_name = chart_name
-    chart_component = chart_name[:-5]
+class CoordinateResolver:
+    """
+    Resolves the coordinates of a result row without an external call when possible: from latitude and
+    longitude columns of the row, then from the gazetteer, and only then by geocoding its address.
+    """
+    LATITUDE_COLUMNS = ('latitude', 'lat')
+    LONGITUDE_COLUMNS = ('longitude', 'lng', 'lon', 'long')
+
+    def __init__(self, gazetteer):
+        self.gazetteer = gazetteer
+        self.lock = threading.Lock()
+        self.sources = {"row": 0, "gazetteer": 0, "geocoder": 0, "unresolved": 0}
+
+    def _count(self, source):
+        with self.lock:
+            self.sources[source] += 1
+
+    @classmethod
+    def from_row(cls, row, keys):
+        columns = {str(key).lower(): value for key, value in zip(keys, row)}
+        lat = next((columns[name] for name in cls.LATITUDE_COLUMNS if columns.get(name) is not None), None)
+        lng = next((columns[name] for name in cls.LONGITUDE_COLUMNS if columns.get(name) is not None), None)
+        if lat is None or lng is None:
+            return None
+        try:
+            return float(lat), float(lng)
+        except (TypeError, ValueError):
+            return None
+
+    def resolve_offline(self, row, keys):
+        """
+        Resolves a row from its coordinate columns or the gazetteer.
+
+        Returns:
+        - tuple: The (lat, lng) of the row, or None, and the address to geocode otherwise (str).
+        """
+        location = self.from_row(row, keys)
+        if location is not None:
+            self._count("row")
+            return location, None
+
+        # Coordinate columns are not part of the address
+        names = self.LATITUDE_COLUMNS + self.LONGITUDE_COLUMNS
+        values = [value for key, value in zip(keys, row) if str(key).lower() not in names]
+        try:
+            location = self.gazetteer.lookup(values)
+        except Exception as e:
+            logger.warning("Error looking up the gazetteer: %s", e)
+            location = None
+        if location is not None:
+            self._count("gazetteer")
+            return location, None
+        return None, format_address(values)
+
+    def resolve(self, row, keys):
+        """
+        Parameters:
+        - row (tuple): The result row.
+        - keys (list): The column names of the row.
+
+        Returns:
+        - tuple or None: The (lat, lng) of the row, or None when it could not be resolved.
+        """
+        return self.resolve_all([row], keys)[0]
+
+    def resolve_all(self, rows, keys):
+        """
+        Resolves the rows of a map, geocoding the ones that could not be resolved offline in one batch.
+
+        Returns:
+        - list: The (lat, lng) of each row, None for the rows that could not be resolved.
+        """
+        resolved = [self.resolve_offline(row, keys) for row in rows]
+        addresses = [address for location, address in resolved if location is None]
+        geocoded = geocode_batch(addresses) if addresses else {}
+        locations = []
+        for location, address in resolved:
+            if location is None:
+                location = geocoded.get(address)
+                self._count("geocoder" if location is not None else "unresolved")
+            locations.append(location)
+        return locations
+
+    def stats(self):
+        with self.lock:
+            return dict(self.sources)
+
+
+coordinate_resolver = CoordinateResolver(gazetteer)
+
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+def haversine_km(lat, lng, lats, lngs):
+    lat, lng, lats, lngs = np.radians(lat), np.radians(lng), np.radians(lats), np.radians(lngs)
+    a = np.sin((lats - lat) / 2) ** 2 + np.cos(lat) * np.cos(lats) * np.sin((lngs - lng) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+class SpatialGrid:
+    """
+    Uniform latitude/longitude grid over a set of points. Radius queries only look at the cells overlapping
+    the bounding box of the circle, nearest neighbour queries at rings of cells growing around the center
+    until no closer point can lie further out. Centers outside the bounding box of the points are answered
+    by scanning every point.
+    """
+    def __init__(self, keys, rows, cell_degrees):
+        self.keys = keys
+        self.rows = rows
+        self.cell_degrees = cell_degrees
+        self.lats = np.array([row[keys.index('Latitude')] for row in rows], dtype=np.float64)
+        self.lngs = np.array([row[keys.index('Longitude')] for row in rows], dtype=np.float64)
+        self.cells = {}
+        for i, cell in enumerate(zip(np.floor(self.lats / cell_degrees).astype(int).tolist(), np.floor(self.lngs / cell_degrees).astype(int).tolist())):
+            self.cells.setdefault(cell, []).append(i)
+        cell_rows = [cell[0] for cell in self.cells] or [0]
+        cell_columns = [cell[1] for cell in self.cells] or [0]
+        self.bounds = (min(cell_rows), max(cell_rows), min(cell_columns), max(cell_columns))
+
+    def _cell(self, lat, lng):
+        return math.floor(lat / self.cell_degrees), math.floor(lng / self.cell_degrees)
+
+    def _result(self, indexes, distances):
+        order = np.argsort(distances, kind='stable')
+        return [tuple(self.rows[indexes[i]]) + (round(float(distances[i]), 3),) for i in order]
+
+    def within(self, lat, lng, radius_km):
+        """
+        Returns:
+        - list: The rows within radius_km of the center, closest first, each followed by its distance in km.
+        """
+        delta_lat = radius_km / KM_PER_DEGREE
+        delta_lng = radius_km / (KM_PER_DEGREE * max(math.cos(math.radians(min(abs(lat) + delta_lat, 90))), 1e-6))
+        low_row, low_column = self._cell(lat - delta_lat, lng - delta_lng)
+        high_row, high_column = self._cell(lat + delta_lat, lng + delta_lng)
+        indexes = []
+        for cell_row in range(max(low_row, self.bounds[0]), min(high_row, self.bounds[1]) + 1):
+            for cell_column in range(max(low_column, self.bounds[2]), min(high_column, self.bounds[3]) + 1):
+                indexes.extend(self.cells.get((cell_row, cell_column), ()))
+        if not indexes:
+            return []
+        indexes = np.array(indexes)
+        distances = haversine_km(lat, lng, self.lats[indexes], self.lngs[indexes])
+        inside = distances <= radius_km
+        return self._result(indexes[inside], distances[inside])
+
+    def _ring_cells(self, center_row, center_column, ring):
+        # The cells at Chebyshev distance ring from the center cell, clipped to the cells holding points
+        low_row, high_row = max(center_row - ring, self.bounds[0]), min(center_row + ring, self.bounds[1])
+        low_column, high_column = max(center_column - ring, self.bounds[2]), min(center_column + ring, self.bounds[3])
+        for cell_row in (center_row - ring, center_row + ring) if ring else (center_row,):
+            if low_row <= cell_row <= high_row:
+                for cell_column in range(low_column, high_column + 1):
+                    yield cell_row, cell_column
+        if ring:
+            for cell_column in (center_column - ring, center_column + ring):
+                if low_column <= cell_column <= high_column:
+                    for cell_row in range(max(low_row, center_row - ring + 1), min(high_row, center_row + ring - 1) + 1):
+                        yield cell_row, cell_column
+
+    def nearest(self, lat, lng, k):
+        """
+        Returns:
+        - list: The k rows closest to the center, closest first, each followed by its distance in km.
+        """
+        k = min(k, len(self.rows))
+        if k <= 0:
+            return []
+        if not (self.lats.min() <= lat <= self.lats.max() and self.lngs.min() <= lng <= self.lngs.max()):
+            # Far from the data the rings would be mostly empty, scanning every point is cheaper
+            indexes = np.arange(len(self.rows))
+            distances = haversine_km(lat, lng, self.lats, self.lngs)
+        else:
+            center_row, center_column = self._cell(lat, lng)
+            max_ring = max(abs(center_row - self.bounds[0]), abs(center_row - self.bounds[1]), abs(center_column - self.bounds[2]), abs(center_column - self.bounds[3]))
+            indexes = []
+            distances = np.empty(0)
+            for ring in range(max_ring + 1):
+                found = [i for cell in self._ring_cells(center_row, center_column, ring) for i in self.cells.get(cell, ())]
+                if found:
+                    indexes.extend(found)
+                    distances = np.concatenate((distances, haversine_km(lat, lng, self.lats[found], self.lngs[found])))
+                if len(indexes) >= k:
+                    # Any point outside the rings visited so far is at least this far from the center
+                    reach_lat = min(abs(lat) + (ring + 1) * self.cell_degrees, 90)
+                    covered_km = ring * self.cell_degrees * KM_PER_DEGREE * math.cos(math.radians(reach_lat))
+                    if np.partition(distances, k - 1)[k - 1] <= covered_km:
+                        break
+            indexes = np.array(indexes)
+        closest = np.argsort(distances, kind='stable')[:k]
+        return self._result(indexes[closest], distances[closest])
+
+
+class SpatialIndex:
+    """
+    Spatial grids over the restaurants and consumers of the TestingData database, rebuilt when one of
+    these tables is written. Served to the generated queries through the spatial functions.
+    """
+    TABLES = {
+        "restaurants": ["Name", "City", "State", "Country", "Latitude", "Longitude"],
+        "consumers": ["Consumer_ID", "City", "State", "Country", "Latitude", "Longitude"],
+    }
 
-    return base_code\
-        .replace("{chartName}", chart_component_name)\
-        .replace("{chartComponent}", chart_component)\
-        .replace("{data}", chart_data)\
-        .replace("{labelX}", xlabel)\
-        .replace("{labelY}", ylabel)
+    def __init__(self, cell_degrees):
+        self.cell_degrees = cell_degrees
+        self.lock = threading.Lock()
+        self.versions = None
+        self.grids = {}
+        self.consumer_locations = {}
+
+    def refresh(self):
+        versions = get_cache_versions([f"table:{table}" for table in self.TABLES])
+        with self.lock:
+            if versions == self.versions:
+                return
+            grids = {}
+            with readonly_connection() as connection:
+                for table, columns in self.TABLES.items():
+                    column_list = ", ".join(f'"{column}"' for column in columns)
+                    rows = connection.execute(text(f'SELECT {column_list} FROM {table} WHERE "Latitude" IS NOT NULL AND "Longitude" IS NOT NULL')).fetchall()
+                    grids[table] = SpatialGrid(columns, [tuple(row) for row in rows], self.cell_degrees)
+            self.grids = grids
+            self.consumer_locations = {str(row[0]): (row[4], row[5]) for row in grids["consumers"].rows}
+            self.versions = versions
+
+    def locate(self, reference):
+        # The center of a query given as a consumer ID, a restaurant name or a city
+        location = self.consumer_locations.get(str(reference))
+        if location is None:
+            location = gazetteer.lookup([reference])
+        if location is None:
+            raise ValueError(f"Unknown location: {reference}")
+        return location
+
+    def query(self, table, kind, arguments):
+        """
+        Parameters:
+        - table (str): restaurants or consumers.
+        - kind (str): "nearest" with arguments (lat, lng, k) or (reference, k),
+          or "within" with arguments (lat, lng, radius_km) or (reference, radius_km).
+
+        Returns:
+        - tuple: The column names (list) and the rows, closest first (list).
+        """
+        self.refresh()
+        if len(arguments) == 2 and isinstance(arguments[0], str):
+            (lat, lng), amount = self.locate(arguments[0]), arguments[1]
+        elif len(arguments) == 3:
+            lat, lng, amount = arguments
+        else:
+            raise ValueError("Spatial functions take (latitude, longitude, amount) or ('location', amount)")
+        grid = self.grids[table]
+        if kind == "nearest":
+            rows = grid.nearest(float(lat), float(lng), int(amount))
+        else:
+            rows = grid.within(float(lat), float(lng), float(amount))
+        return grid.keys + ["Distance_km"], rows
+
+
+spatial_index = SpatialIndex(SPATIAL_CELL_DEGREES)
+
+SPATIAL_FUNCTIONS = {
+    "nearest_restaurants": ("restaurants", "nearest"),
+    "restaurants_within": ("restaurants", "within"),
+    "nearest_consumers": ("consumers", "nearest"),
+    "consumers_within": ("consumers", "within"),
+}
+SPATIAL_QUERY_PATTERN = re.compile(r'^\s*(?:SELECT\s+\*\s+FROM\s+)?(' + '|'.join(SPATIAL_FUNCTIONS) + r')\s*\((.*)\)\s*;?\s*$', re.IGNORECASE | re.DOTALL)
+
+def run_spatial_query(sql_query, limit=QUERY_ROW_CAP, offset=0):
+    """
+    Serves a statement calling one of the spatial functions from the spatial index instead of the database, e.g.
+    SELECT * FROM nearest_restaurants(22.15, -100.98, 5) or SELECT * FROM restaurants_within('U1001', 2).
 
+    Returns:
+    - tuple or None: The column names (list), the rows (list) and whether more rows are available (bool),
+      or None when the statement is not a spatial function call.
+    """
+    match = SPATIAL_QUERY_PATTERN.match(sql_query)
+    if not match:
+        return None
+    table, kind = SPATIAL_FUNCTIONS[match.group(1).lower()]
+    try:
+        arguments = ast.literal_eval(f"({match.group(2)},)")
+    except (ValueError, SyntaxError):
+        raise ValueError(f"Invalid arguments for {match.group(1)}: {match.group(2)}")
+    keys, rows = spatial_index.query(table, kind, arguments)
+    return keys, rows[offset:offset + limit], len(rows) > offset + limit
+
+
+
+
+def iter_table_html(rows, keys, max_rows=None):
+    """
+    Renders rows as an HTML table, one chunk per row, escaping every header and value.
+
+    Parameters:
+    - rows (iterable): The rows, which can be a generator that is consumed as the table is rendered.
+    - keys (list): The column names.
+    - max_rows (int): Number of rows after which rendering stops, None to render them all.
+
+    Yields:
+    - str: The next chunk of the table.
+    """
+    yield '<table border="1">\n<tr>' + ''.join(f'<th>{html.escape(str(key))}</th>' for key in keys) + '</tr>\n'
+    for row in itertools.islice(rows, max_rows):
+        yield '<tr>' + ''.join(f'<td>{html.escape(str(value))}</td>' for value in row) + '</tr>\n'
+    yield '</table>'
 
-def generate_map_code(coordinates, map_type, base_code):
+
+def format_as_table(results, keys, max_rows=None):
+    return ''.join(iter_table_html(results, keys, max_rows))
+
+
+# Closing questions of the rule-based answers, picked by the question so that they vary between questions
+FOLLOW_UP_QUESTIONS = [
+    "Is there anything else I can assist you with?",
+    "Is there anything else you would like to know?",
+    "Can I help you with anything else?",
+    "Would you like to explore anything else?"
+]
+CHOICE_QUESTIONS = [
+    "Would you like more details about any of them?",
+    "Which one would you like to know more about?",
+    "Is there one of them you would like to explore further?"
+]
+# Label of an aggregate column, without and with the label of its argument
+AGGREGATE_LABELS = {
+    "count": ("count", "number of {}"),
+    "avg": ("average", "average {}"),
+    "sum": ("total", "total {}"),
+    "max": ("maximum", "maximum {}"),
+    "min": ("minimum", "minimum {}")
+}
+
+
+# Abbreviations often used in column aliases
+WORD_LABELS = {"avg": "average", "num": "number of", "cnt": "count", "qty": "quantity"}
+
+
+def pick_phrase(phrases, user_question):
+    return phrases[int(hashlib.md5(user_question.encode('utf-8')).hexdigest(), 16) % len(phrases)]
+
+
+def column_label(key):
+    """
+    Turns a column name into words, e.g. "AVG(\"Food_Rating\")" into "average food rating".
+
+    Returns:
+    - str or None: The label, None when the name says nothing about the value, e.g. "?column?".
+    """
+    key = str(key).strip()
+    match = re.fullmatch(r'(\w+)\s*\(\s*(?:DISTINCT\s+)?(.*?)\s*\)', key, re.IGNORECASE)
+    if match and match.group(1).lower() in AGGREGATE_LABELS:
+        alone, with_argument = AGGREGATE_LABELS[match.group(1).lower()]
+        argument = column_label(match.group(2).split('.')[-1]) if match.group(2) not in ('', '*') else None
+        return with_argument.format(argument) if argument else alone
+    # Expressions without an alias, e.g. "?column?" in PostgreSQL or "\"Price\" * 2" in SQLite
+    if not re.fullmatch(r'[\w\s"`.]*[A-Za-z][\w\s"`.]*', key):
+        return None
+    words = re.sub(r'[_"`]+', ' ', key.split('.')[-1])
+    # camelCase and PascalCase names
+    words = re.sub(r'(?<=[a-z])(?=[A-Z])', ' ', words)
+    return ' '.join(WORD_LABELS.get(word, word) for word in words.lower().split())
+
+
+def format_value(value):
+    if value is None:
+        return "unknown"
+    if isinstance(value, Decimal):
+        value = float(value)
+    if isinstance(value, float):
+        if value.is_integer():
+            return str(int(value))
+        return f"{value:.2f}".rstrip('0').rstrip('.')
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return str(value)
+
+
+def format_result_with_rules(user_question, query_result):
+    """
+    Answers with a sentence or a numbered list built from templates when the result is simple enough:
+    no rows, a single value, a single row or a short list. The formatting model is not called.
+
+    Parameters:
+    - user_question (str): The question asked by the user.
+    - query_result (QueryResult): The result of the generated query.
+
+    Returns:
+    - str or None: The answer, or None when the result needs the formatting model.
+    """
+    if not query_result.uniform or query_result.truncated:
+        return None
+    keys, rows = query_result.keys, query_result.rows
+    if len(keys) > RULES_MAX_COLUMNS or len(rows) > RULES_MAX_LIST_ROWS:
+        return None
+
+    follow_up = pick_phrase(FOLLOW_UP_QUESTIONS, user_question)
+    if not rows:
+        return f"I could not find any results matching your question. {follow_up}"
+
+    labels = [column_label(key) for key in keys]
+    if len(rows) == 1 and len(keys) == 1:
+        value = format_value(rows[0][0])
+        if labels[0] is None:
+            return f"The answer is {value}. {follow_up}"
+        return f"The {labels[0]} is {value}. {follow_up}"
+
+    if len(rows) == 1:
+        if None in labels:
+            return None
+        details = ", ".join(f"{label.capitalize()}: {format_value(value)}" for label, value in zip(labels, rows[0]))
+        return f"Here is what I found: {details}. {follow_up}"
+
+    # The first column names the item, the others describe it
+    if None in labels[1:]:
+        return None
+    items = []
+    for number, row in enumerate(rows, start=1):
+        item = format_value(row[0])
+        if len(row) > 1:
+            item += " (" + ", ".join(f"{label.capitalize()}: {format_value(value)}" for label, value in zip(labels[1:], row[1:])) + ")"
+        items.append(f"{number}) {item}")
+    listing = "\n".join(items)
+    return f"I found {len(rows)} results:\n{listing}\n{pick_phrase(CHOICE_QUESTIONS, user_question)}"
+
+
+
+def json_default(value):
+    # Database values that json cannot encode by itself
+    if isinstance(value, Decimal):
+        return float(value)
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return str(value)
+
+
+def compact_json(value):
+    return json.dumps(value, separators=(',', ':'), default=json_default)
+
+
+class CodeTemplate:
+    """
+    Frontend code template compiled once into a list of literal segments and placeholder names,
+    so that rendering is a single join instead of one str.replace pass over the source per placeholder.
+
+    placeholders maps each placeholder name to how its value is written into the code:
+    "text" inserts it as is and "json" inserts it as compact JSON.
+    version is a hash of the source that lets clients cache the template.
+    """
+    def __init__(self, template_id, path, placeholders):
+        self.template_id = template_id
+        self.placeholders = placeholders
+        with open(path, 'r') as file:
+            self.source = file.read()
+        self.version = hashlib.sha256(self.source.encode('utf-8')).hexdigest()[:12]
+        pattern = '|'.join(re.escape('{' + name + '}') for name in placeholders)
+        self.segments = []
+        position = 0
+        for match in re.finditer(pattern, self.source):
+            self.segments.append(self.source[position:match.start()])
+            self.segments.append(match.group()[1:-1])
+            position = match.end()
+        self.segments.append(self.source[position:])
+
+    def render(self, values):
+        parts = []
+        for i, segment in enumerate(self.segments):
+            if i % 2 == 0:
+                parts.append(segment)
+            elif self.placeholders[segment] == 'json':
+                parts.append(compact_json(values[segment]))
+            else:
+                parts.append(str(values[segment]))
+        return ''.join(parts)
+
+    def describe(self):
+        return {"id": self.template_id, "version": self.version, "placeholders": self.placeholders, "source": self.source}
+
+
+CODE_TEMPLATES = {
+    "chart": CodeTemplate("chart", 'chart_code.txt', {"chartName": "text", "chartComponent": "text", "data": "json", "labelX": "text", "labelY": "text"}),
+    "map": CodeTemplate("map", 'map_code.txt', {"coordinates": "json", "type": "json"}),
+    "heatmap": CodeTemplate("heatmap", 'heat_code.txt', {"xLabels": "json", "yLabels": "json", "heatMapData": "json"}),
+}
+
+
+def chart_number(value):
+    if value is None:
+        return 0.0
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def lttb_indexes(values, threshold):
+    """
+    Picks the points of a series kept by Largest-Triangle-Three-Buckets: the first and last points, and in each
+    bucket in between the point forming the largest triangle with the previously kept point and the average of
+    the next bucket. Points are spaced evenly on the x axis, as the rows of a line chart are.
+
+    Parameters:
+    - values (numpy.ndarray): The y values.
+    - threshold (int): Number of points to keep, at least 3.
+
+    Returns:
+    - list: The indexes of the kept points in order.
+    """
+    count = len(values)
+    bucket_size = (count - 2) / (threshold - 2)
+    kept = [0]
+    previous = 0
+    for bucket in range(threshold - 2):
+        start = int(bucket * bucket_size) + 1
+        end = int((bucket + 1) * bucket_size) + 1
+        next_start, next_end = end, min(int((bucket + 2) * bucket_size) + 1, count)
+        if next_start >= next_end:
+            next_start, next_end = count - 1, count
+        average_x = (next_start + next_end - 1) / 2
+        average_y = values[next_start:next_end].mean()
+        x = np.arange(start, end)
+        areas = np.abs((previous - average_x) * (values[start:end] - values[previous]) - (previous - x) * (average_y - values[previous]))
+        previous = start + int(np.argmax(areas))
+        kept.append(previous)
+    kept.append(count - 1)
+    return kept
+
+
+def downsample_chart_data(data, chart_name):
+    """
+    Reduces the points of a chart above its configured maximum. Line series keep their shape through LTTB,
+    bar and pie charts keep their largest categories and sum the others into an "Other" category.
+
+    Parameters:
+    - data (list): The {"labelX", "labelY"} points.
+    - chart_name (str): LineChart, BarChart or PieChart.
+
+    Returns:
+    - tuple: The points to draw (list) and a description of the reduction (dict), None when the data was kept as is.
+    """
+    if chart_name == "LineChart":
+        if len(data) <= max(LINE_CHART_MAX_POINTS, 3):
+            return data, None
+        values = np.array([chart_number(point["labelY"]) for point in data])
+        reduced = [data[i] for i in lttb_indexes(values, max(LINE_CHART_MAX_POINTS, 3))]
+        return reduced, {"method": "lttb", "original_points": len(data), "points": len(reduced)}
+
+    max_categories = BAR_CHART_MAX_CATEGORIES if chart_name == "BarChart" else PIE_CHART_MAX_CATEGORIES
+    if len(data) <= max(max_categories, 2):
+        return data, None
+    order = sorted(range(len(data)), key=lambda i: chart_number(data[i]["labelY"]), reverse=True)
+    top = set(order[:max_categories - 1])
+    # The kept categories stay in the order of the query
+    reduced = [point for i, point in enumerate(data) if i in top]
+    other = sum(chart_number(data[i]["labelY"]) for i in order[max_categories - 1:])
+    reduced.append({"labelX": "Other", "labelY": int(other) if other == int(other) else other})
+    return reduced, {"method": "top_n", "original_points": len(data), "points": len(reduced)}
+
+
+def make_visualization(template_id, caption, values):
+    """
+    Builds the data payload of a chart, map or heatmap answer.
+
+    Parameters:
+    - template_id (str): The id of the code template in CODE_TEMPLATES.
+    - caption (str): The sentence introducing the visualization.
+    - values (dict): The values of the template placeholders.
+
+    Returns:
+    - dict: The template id and version, the caption and the values.
+    """
+    return {"template": template_id, "version": CODE_TEMPLATES[template_id].version, "caption": caption, "values": values}
+
+
+def render_visualization(visualization):
+    with span("render_template"):
+        code = CODE_TEMPLATES[visualization["template"]].render(visualization["values"])
+    return f"{visualization['caption']}: {code}"
+
+
+def visualization_placeholder(visualization):
+    """
+    Short text standing for a visualization in the stored response and in the conversation history
+    sent to the model, instead of the rendered code.
+
+    Returns:
+    - str: The caption followed by what was drawn.
+    """
+    values = visualization["values"]
+    if visualization["template"] == "chart":
+        drawn = f"{values['chartName']} of {len(values['data'])} points"
+    elif visualization["template"] == "heatmap":
+        drawn = f"heatmap of {len(values['xLabels'])}x{len(values['yLabels'])} cells"
+    else:
+        drawn = f"{values['type']} map of {len(values['coordinates'])} points"
+    return f"{visualization['caption']}: [{drawn} shown to the user]"
+
+
+def chart_values(data, xlabel, ylabel, chart_name):
+    return {"chartName": chart_name, "chartComponent": chart_name[:-5], "data": data, "labelX": xlabel, "labelY": ylabel}
+
+
+def map_values(coordinates, map_type):
     if map_type=="GoogleMaps":
         map_type="normal"
     elif map_type=="TriangleMaps":
         map_type="triangle"
-    coordinates_str = json.dumps(coordinates)
-    return base_code\
-        .replace("{coordinates}", coordinates_str)\
-        .replace("{type}", f"'{map_type}'")
+    return {"coordinates": coordinates, "type": map_type}
+
+
+def heatmap_values(xlabels, ylabels, heatmapdata):
+    return {"xLabels": xlabels, "yLabels": ylabels, "heatMapData": heatmapdata}
 
 
-def generate_heatmap_code(xlabels, ylabels, heatmapdata, base_code):
+def generate_chart_code(data, xlabel, ylabel, chart_name):
+    return CODE_TEMPLATES["chart"].render(chart_values(data, xlabel, ylabel, chart_name))
 
-    return base_code\
-        .replace("{xLabels}", f'{xlabels}')\
-        .replace("{yLabels}", f'{ylabels}')\
-        .replace("{heatMapData}", f'{heatmapdata}')
+
+def generate_map_code(coordinates, map_type):
+    return CODE_TEMPLATES["map"].render(map_values(coordinates, map_type))
+
+
+def sort_labels(labels):
+    try:
+        return sorted(labels)
+    except TypeError:
+        # Mixed types, e.g. numbers and NULLs
+        return sorted(labels, key=lambda label: (label is None, str(label)))
+
+
+def chart_label(label):
+    if isinstance(label, (int, float)) and not isinstance(label, bool):
+        return label
+    return str(label)
+
+
+def pivot_heatmap(rows, aggregate=HEATMAP_AGGREGATE):
+    """
+    Pivots (x, y, value) rows into a heatmap grid. Labels are indexed through dictionaries and the cells
+    are filled with one bincount over the flattened grid, so the cost is linear in the number of rows.
+
+    Parameters:
+    - rows (list): The (x, y, value) rows.
+    - aggregate (str): How rows sharing a cell are combined: "sum", "avg" or "count".
+
+    Returns:
+    - tuple: The sorted x labels (list), the sorted y labels (list) and the grid (list of lists, one per y label).
+      Cells without rows are 0.
+    """
+    if aggregate not in ('sum', 'avg', 'count'):
+        raise ValueError(f"Unknown heatmap aggregation: {aggregate}")
+
+    xs = [row[0] for row in rows]
+    ys = [row[1] for row in rows]
+    x_index = {label: i for i, label in enumerate(sort_labels(set(xs)))}
+    y_index = {label: i for i, label in enumerate(sort_labels(set(ys)))}
+    size = len(x_index) * len(y_index)
+
+    cells = np.fromiter(map(y_index.__getitem__, ys), dtype=np.int64, count=len(rows)) * len(x_index)
+    cells += np.fromiter(map(x_index.__getitem__, xs), dtype=np.int64, count=len(rows))
+    counts = np.bincount(cells, minlength=size)
+    if aggregate == 'count':
+        grid = counts
+    else:
+        weights = np.array([row[2] if row[2] is not None else 0 for row in rows], dtype=np.float64)
+        grid = np.bincount(cells, weights=weights, minlength=size)
+        if aggregate == 'avg':
+            grid = np.divide(grid, counts, out=np.zeros(size), where=counts > 0)
+        if np.all(grid == np.round(grid)):
+            grid = grid.astype(np.int64)
+
+    grid = grid.reshape(len(y_index), len(x_index))
+    return [chart_label(label) for label in x_index], [chart_label(label) for label in y_index], grid.tolist()
+
+
+def generate_heatmap_code(xlabels, ylabels, heatmapdata):
+    return CODE_TEMPLATES["heatmap"].render(heatmap_values(xlabels, ylabels, heatmapdata))
 
 
 
@@ -444,6 +2119,8 @@ def process_pdf(filename, user_id):
 
     collection_name = f"user_{user_id}_pdfs"
     result_message = chunk_pdf_to_chroma(filename,file_path, collection_name)
+    # The PDF titles and descriptions are part of the user's cached system prompt
+    bump_cache_version(collection_name)
 
     return {"message": result_message}, 200
 def extract_text_with_ocr(page):
@@ -509,13 +2186,7 @@ def get_title_and_description(text):
               }
               '''}]
     message.append({'role':'user','content':f'{text}'})
-    response = client.chat.completions.create(
-        model='gpt-4o',  
-        messages=message,
-        response_format={ "type": "json_object" }, 
-        max_tokens=500
-    )
-    result=response.choices[0].message.content.strip()
+    result = llm.chat("pdf_metadata", message, max_tokens=500, json_mode=True)
     try:
         response_json = json.loads(result)
         title = response_json["Title"]
@@ -538,16 +2209,17 @@ def select_relevant_pdf_chunks(user_question, user_id,doc_id, top_n=5, distance_
         return "No PDFs found for this user."
 
     # Query the collection for the most relevant chunks
-    results = collection.query(
-        query_embeddings=[user_embedding],
-        n_results=top_n,
-        where={'doc_id':doc_id},
-        include=['distances', 'metadatas']
-    )
+    with span("chroma_query"):
+        results = collection.query(
+            query_embeddings=[user_embedding],
+            n_results=top_n,
+            where={'doc_id':doc_id},
+            include=['distances', 'metadatas']
+        )
 
     for distances, metadata_list in zip(results['distances'], results['metadatas']):
         for distance, metadata in zip(distances, metadata_list):
-            print(distance)
+            logger.debug("PDF chunk distance: %s", distance)
             if distance < distance_threshold:
                 relevant_chunks.append({
                     "ids": metadata.get('ids'),
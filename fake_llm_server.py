@@ -0,0 +1,129 @@
+"""
+Local stand-in for the OpenAI API, answering chat completions and embeddings with the deterministic FakeProvider.
+
+Point the application at it to run or load-test the whole pipeline offline:
+
+    python fake_llm_server.py --port 8001 --latency 0.8 --jitter 0.4 --responses fake_responses.json
+    LLM_BASE_URL=http://127.0.0.1:8001/v1 OPENAI_API_KEY=fake python app.py
+
+The responses file is a JSON list of rules, see FakeProvider for their format.
+"""
+import argparse
+import json
+import os
+import time
+import uuid
+
+from flask import Flask, Response, jsonify, request
+
+# The server itself never calls OpenAI, importing providers must not require an API key
+os.environ.setdefault('LLM_PROVIDER', 'fake')
+
+from providers import FakeProvider, FAKE_LLM_LATENCY, FAKE_LLM_JITTER, FAKE_LLM_TOKEN_LATENCY, FAKE_EMBEDDING_LATENCY, FAKE_EMBEDDING_DIM
+
+
+def create_app(provider):
+    """
+    Creates the Flask application serving the OpenAI-compatible endpoints.
+
+    Parameters:
+    - provider (FakeProvider): The provider answering the requests.
+
+    Returns:
+    - Flask: The application.
+    """
+    app = Flask(__name__)
+
+    def usage(messages, content):
+        prompt_tokens = sum(provider.count_tokens(message.get("content") or "") for message in messages)
+        completion_tokens = provider.count_tokens(content)
+        return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+
+    @app.route('/v1/chat/completions', methods=['POST'])
+    def chat_completions():
+        data = request.json
+        model = data.get('model', 'fake')
+        messages = data.get('messages', [])
+        max_tokens = data.get('max_tokens')
+        json_mode = (data.get('response_format') or {}).get('type') == 'json_object'
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+
+        if not data.get('stream'):
+            content = provider.chat(model, messages, max_tokens, json_mode=json_mode)
+            return jsonify({
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                "usage": usage(messages, content)
+            })
+
+        include_usage = (data.get('stream_options') or {}).get('include_usage')
+
+        def chunk(delta, finish_reason=None, usage=None):
+            payload = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}] if usage is None else [],
+                "usage": usage
+            }
+            return f"data: {json.dumps(payload)}\n\n"
+
+        def generate():
+            yield chunk({"role": "assistant", "content": ""})
+            content = ""
+            for token in provider.stream_chat(model, messages, max_tokens):
+                content += token
+                yield chunk({"content": token})
+            yield chunk({}, "stop")
+            if include_usage:
+                yield chunk(None, usage=usage(messages, content))
+            yield "data: [DONE]\n\n"
+
+        return Response(generate(), mimetype='text/event-stream')
+
+    @app.route('/v1/embeddings', methods=['POST'])
+    def embeddings():
+        data = request.json
+        texts = data.get('input', [])
+        if isinstance(texts, str):
+            texts = [texts]
+        vectors = provider.embed(texts)
+        return jsonify({
+            "object": "list",
+            "model": data.get('model', provider.embedding_model),
+            "data": [{"object": "embedding", "index": index, "embedding": vector} for index, vector in enumerate(vectors)],
+            "usage": {"prompt_tokens": sum(provider.count_tokens(text) for text in texts), "total_tokens": sum(provider.count_tokens(text) for text in texts)}
+        })
+
+    @app.route('/v1/stats', methods=['GET'])
+    def stats():
+        return jsonify(provider.stats())
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--latency', type=float, default=FAKE_LLM_LATENCY, help='Seconds before each completion starts')
+    parser.add_argument('--jitter', type=float, default=FAKE_LLM_JITTER, help='Maximum extra seconds added to the latency')
+    parser.add_argument('--token-latency', type=float, default=FAKE_LLM_TOKEN_LATENCY, help='Seconds between streamed tokens')
+    parser.add_argument('--embedding-latency', type=float, default=FAKE_EMBEDDING_LATENCY, help='Seconds per embedding request')
+    parser.add_argument('--embedding-dim', type=int, default=FAKE_EMBEDDING_DIM, help='Size of the embedding vectors')
+    parser.add_argument('--responses', help='JSON file with the canned responses')
+    args = parser.parse_args()
+
+    settings = dict(latency=args.latency, jitter=args.jitter, token_latency=args.token_latency,
+                    embedding_latency=args.embedding_latency, embedding_dim=args.embedding_dim)
+    provider = FakeProvider.from_file(args.responses, **settings) if args.responses else FakeProvider(**settings)
+    create_app(provider).run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,13 +3,9 @@ import pandas as pd
 from extensions import db
 from model.test import Consumer, ConsumerPreference, Rating, Restaurant, RestaurantCuisine
 from dotenv import load_dotenv
-from openai import OpenAI
 load_dotenv()
 
 
-# Ensure OPENAI_API_KEY is set
-client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
-
 from app import app
 
 def load_consumers():
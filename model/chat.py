@@ -1,4 +1,5 @@
-from extensions import db, ma
+from extensions import db, ma, render_visualization
+from sqlalchemy.dialects.postgresql import JSONB
 from datetime import datetime
 
 class Feedback(db.Model):
@@ -30,10 +31,13 @@ class Conversation(db.Model):
     executable = db.Column(db.String(3), nullable=True)  # Executable field
     location = db.Column(db.String(3), nullable=True)  # Location field
     chartname= db.Column(db.String(100),nullable=True)
+    visualization = db.Column(db.JSON().with_variant(JSONB(), 'postgresql'), nullable=True)  # Template id, version and data of a chart, map or heatmap answer
+    estimated_cost = db.Column(db.Float, nullable=True)  # Total cost of the generated statements estimated by EXPLAIN
+    estimated_rows = db.Column(db.Float, nullable=True)  # Number of rows of the generated statements estimated by EXPLAIN
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
     feedbacks= db.relationship('Feedback', backref= 'conversation', lazy=True, cascade='all, delete-orphan')
 
-    def __init__(self, chat_id, user_query, response, sql_query, score=None, executable=None, location=None,chartname=None):
+    def __init__(self, chat_id, user_query, response, sql_query, score=None, executable=None, location=None,chartname=None,visualization=None,estimated_cost=None,estimated_rows=None):
         self.chat_id = chat_id
         self.user_query = user_query
         self.response = response
@@ -42,14 +46,26 @@ class Conversation(db.Model):
         self.executable = executable
         self.location = location
         self.chartname =chartname
+        self.visualization = visualization
+        self.estimated_cost = estimated_cost
+        self.estimated_rows = estimated_rows
+
+    @property
+    def rendered_response(self):
+        # The code of a visualization is only rendered when the conversation is read
+        if self.visualization:
+            return render_visualization(self.visualization)
+        return self.response
 
 
 
 
 class ConversationSchema(ma.SQLAlchemyAutoSchema):
+    response = ma.Function(lambda conversation: conversation.rendered_response)
+
     class Meta:
         model = Conversation
-        fields = ("id", "chat_id", "user_query", "response", "sql_query","score","executable","location","chartname", "timestamp")
+        fields = ("id", "chat_id", "user_query", "response", "sql_query","score","executable","location","chartname", "visualization", "timestamp")
 
 
 class Chat(db.Model):
@@ -57,6 +73,8 @@ class Chat(db.Model):
     title = db.Column(db.String(100), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)  
+    summary = db.Column(db.Text, nullable=True)  # Running summary of the conversations folded out of the prompt window
+    summarized_until = db.Column(db.Integer, nullable=True)  # ID of the last conversation folded into the summary
     conversations = db.relationship('Conversation', backref='chat', lazy=True, cascade='all, delete-orphan')
 
     def __init__(self, title, user_id):
@@ -0,0 +1,301 @@
+"""
+Request tracing, Prometheus metrics and logging.
+
+Each request gets an ID, taken from the X-Request-ID header or generated, that is attached to its log lines. The
+stages of a request are timed with span(), which adds them to the request's StageTimings (returned in the
+Server-Timing header) and to the latency histograms served by /metrics.
+
+Logging is configured with LOG_LEVEL (default INFO). The DEBUG lines, which dump prompts and query results, are only
+written for a sample of the requests, LOG_DEBUG_SAMPLE_RATE, so that enabling them under load stays affordable.
+"""
+import bisect
+import contextvars
+import hashlib
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from dotenv import load_dotenv
+
+
+load_dotenv()
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_DEBUG_SAMPLE_RATE = float(os.getenv('LOG_DEBUG_SAMPLE_RATE', 0.1))
+
+request_id_var = contextvars.ContextVar('request_id', default=None)
+trace_var = contextvars.ContextVar('trace', default=None)
+
+
+def new_request_id():
+    return uuid.uuid4().hex
+
+
+def is_sampled(request_id):
+    """
+    Returns whether the DEBUG lines of a request are written. The decision only depends on the request ID
+    so that the lines of a sampled request are written together.
+    """
+    if LOG_DEBUG_SAMPLE_RATE >= 1:
+        return True
+    if request_id is None:
+        return random.random() < LOG_DEBUG_SAMPLE_RATE
+    return int(hashlib.sha1(request_id.encode('utf-8')).hexdigest()[:8], 16) / 0x100000000 < LOG_DEBUG_SAMPLE_RATE
+
+
+class RequestContextFilter(logging.Filter):
+    # Adds the request ID to the records and drops the DEBUG records of the requests that are not sampled
+    def filter(self, record):
+        request_id = request_id_var.get()
+        record.request_id = request_id or '-'
+        return record.levelno > logging.DEBUG or is_sampled(request_id)
+
+
+logger = logging.getLogger('chatbot')
+if not logger.handlers:
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(request_id)s] %(message)s'))
+    handler.addFilter(RequestContextFilter())
+    logger.addHandler(handler)
+    logger.setLevel(LOG_LEVEL)
+    logger.propagate = False
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """
+    Prometheus counter with labels.
+    """
+    type = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = dict(self.values)
+        for key, value in sorted(values.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+
+class Histogram:
+    """
+    Prometheus histogram with labels.
+    """
+    type = 'histogram'
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Per label values: the count of each bucket (not cumulative, the last one is +Inf), the sum and the count
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts, total, count = self.values.get(key) or ([0] * (len(self.buckets) + 1), 0.0, 0)
+            counts[index] += 1
+            self.values[key] = (counts, total + value, count + 1)
+
+    def samples(self):
+        with self.lock:
+            values = {key: (list(counts), total, count) for key, (counts, total, count) in self.values.items()}
+        for key, (counts, total, count) in sorted(values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', _format_value(float(bound)))])} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, key)} {count}"
+
+
+class MetricsRegistry:
+    """
+    The metrics served by /metrics, rendered in the Prometheus text format.
+    """
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, documentation, labelnames=()):
+        metric = Counter(name, documentation, labelnames)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, labelnames=(), buckets=Histogram.DEFAULT_BUCKETS):
+        metric = Histogram(name, documentation, labelnames, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+http_requests = metrics.counter('chatbot_http_requests_total', 'HTTP requests by endpoint, method and status.', ('endpoint', 'method', 'status'))
+http_latency = metrics.histogram('chatbot_http_request_duration_seconds', 'Time to the response headers, by endpoint and method.', ('endpoint', 'method'))
+stage_latency = metrics.histogram('chatbot_stage_duration_seconds', 'Duration of the stages of a request.', ('stage',))
+llm_latency = metrics.histogram('chatbot_llm_request_duration_seconds', 'Duration of the model calls by stage and model.', ('stage', 'model'))
+llm_tokens = metrics.counter('chatbot_llm_tokens_total', 'Tokens sent to and generated by the models.', ('stage', 'model', 'type'))
+
+
+def record_llm_call(stage, model, seconds, prompt_tokens=None, completion_tokens=None):
+    """
+    Records the duration and token usage of a model call.
+    """
+    llm_latency.observe(seconds, stage=stage, model=model)
+    if prompt_tokens:
+        llm_tokens.inc(prompt_tokens, stage=stage, model=model, type='prompt')
+    if completion_tokens:
+        llm_tokens.inc(completion_tokens, stage=stage, model=model, type='completion')
+
+
+def record_http_request(endpoint, method, status, seconds):
+    http_requests.inc(endpoint=endpoint, method=method, status=status)
+    http_latency.observe(seconds, endpoint=endpoint, method=method)
+
+
+class StageTimings:
+    """
+    Records how long each stage of a request took so the slowest stage can be identified.
+    Stages may be recorded from several threads.
+    """
+    def __init__(self, request_id=None):
+        self.request_id = request_id or request_id_var.get()
+        self.stages = {}
+        self.spans = []
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            elapsed = (end - start) * 1000
+            stage_latency.observe(end - start, stage=name)
+            with self.lock:
+                self.stages[name] = self.stages.get(name, 0.0) + elapsed
+                self.spans.append((name, round((start - self.started) * 1000, 1), round(elapsed, 1), threading.current_thread().name))
+
+    def run(self, name, function, *args, **kwargs):
+        # May run on a worker thread, the spans recorded by the function belong to this request
+        trace_token = trace_var.set(self)
+        request_token = request_id_var.set(self.request_id)
+        try:
+            with self.stage(name):
+                return function(*args, **kwargs)
+        finally:
+            request_id_var.reset(request_token)
+            trace_var.reset(trace_token)
+
+    def as_dict(self):
+        with self.lock:
+            stages = {name: round(ms, 1) for name, ms in self.stages.items()}
+        stages["total"] = round((time.perf_counter() - self.started) * 1000, 1)
+        return stages
+
+    def server_timing(self):
+        # Value of the Server-Timing response header
+        return ", ".join(f"{name};dur={ms}" for name, ms in self.as_dict().items())
+
+    def log(self):
+        logger.info("Stage timings: %s", self.as_dict())
+        logger.debug("Spans (name, start ms, ms, thread): %s", self.spans)
+
+
+def start_trace():
+    """
+    Starts the trace of the current request, the spans recorded until the end of the request are added to it.
+
+    Returns:
+    - StageTimings: The trace.
+    """
+    timings = StageTimings()
+    trace_var.set(timings)
+    return timings
+
+
+@contextmanager
+def span(name):
+    """
+    Times a block as a stage of the current request, or only in the stage histogram outside of a traced request.
+    """
+    timings = trace_var.get()
+    if timings is not None:
+        with timings.stage(name):
+            yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_latency.observe(time.perf_counter() - start, stage=name)
+
+
+@contextmanager
+def optional_stage(timings, name):
+    if timings is None:
+        with span(name):
+            yield
+    else:
+        with timings.stage(name):
+            yield
+
+
+def with_request_context(function):
+    """
+    Wraps a function submitted to a worker pool so that its spans and log lines belong to the submitting request.
+    """
+    timings = trace_var.get()
+    request_id = request_id_var.get()
+
+    def run(*args, **kwargs):
+        trace_token = trace_var.set(timings)
+        request_token = request_id_var.set(request_id)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            request_id_var.reset(request_token)
+            trace_var.reset(trace_token)
+    return run
@@ -0,0 +1,312 @@
+"""
+Chat completion and embedding providers.
+
+Every call to a language model goes through the provider `llm`, which is configured here
+from the environment:
+
+- LLM_PROVIDER selects "openai" (default) or "fake", a deterministic in-process stand-in.
+- LLM_BASE_URL points the OpenAI provider at any OpenAI-compatible endpoint, for example fake_llm_server.py.
+- LLM_MODEL is the chat model of every stage, LLM_MODEL_<STAGE> overrides it for one stage
+  (ROUTE, FORMAT, SUMMARY, PDF_ANSWER, PDF_METADATA).
+"""
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+
+import chromadb.utils.embedding_functions as embedding_functions
+from dotenv import load_dotenv
+from openai import OpenAI
+
+from observability import record_llm_call, span
+
+
+load_dotenv()
+
+LLM_PROVIDER = os.getenv('LLM_PROVIDER', 'openai')
+LLM_BASE_URL = os.getenv('LLM_BASE_URL')
+LLM_MODEL = os.getenv('LLM_MODEL', 'gpt-4o')
+EMBEDDING_MODEL = os.getenv('EMBEDDING_MODEL', 'text-embedding-3-large')
+
+# Stages of a request that call a chat model
+STAGES = ('route', 'format', 'summary', 'pdf_answer', 'pdf_metadata')
+
+# Settings of the fake provider, shared with fake_llm_server.py
+FAKE_LLM_LATENCY = float(os.getenv('FAKE_LLM_LATENCY', 0))
+FAKE_LLM_JITTER = float(os.getenv('FAKE_LLM_JITTER', 0))
+FAKE_LLM_TOKEN_LATENCY = float(os.getenv('FAKE_LLM_TOKEN_LATENCY', 0))
+FAKE_EMBEDDING_LATENCY = float(os.getenv('FAKE_EMBEDDING_LATENCY', 0))
+# text-embedding-3-large vectors have 3072 dimensions, the existing Chroma collections expect the same size
+FAKE_EMBEDDING_DIM = int(os.getenv('FAKE_EMBEDDING_DIM', 3072))
+FAKE_LLM_RESPONSES = os.getenv('FAKE_LLM_RESPONSES')
+
+
+def stage_model(stage):
+    """
+    Returns the chat model used for a stage.
+
+    Parameters:
+    - stage (str): One of STAGES.
+
+    Returns:
+    - str: LLM_MODEL_<STAGE> if it is set, LLM_MODEL otherwise.
+    """
+    return os.getenv(f'LLM_MODEL_{stage.upper()}', LLM_MODEL)
+
+
+class OpenAIProvider:
+    """
+    Provider backed by the OpenAI API or by any endpoint that implements it.
+    """
+    name = 'openai'
+
+    def __init__(self, api_key=None, base_url=None, embedding_model=EMBEDDING_MODEL):
+        self.client = OpenAI(api_key=api_key, base_url=base_url)
+        self.embedding_model = embedding_model
+        # Identifies the vectors in the embedding cache, another endpoint may return different ones for the same model
+        self.embedding_namespace = embedding_model if base_url is None else f"{embedding_model}@{base_url}"
+
+    def chat(self, stage, messages, max_tokens, json_mode=False):
+        """
+        Returns the completion of the messages.
+
+        Parameters:
+        - stage (str): The stage making the call, it selects the model.
+        - messages (list): The messages to send.
+        - max_tokens (int): The maximum number of tokens to generate.
+        - json_mode (bool): Whether the model must answer with a JSON object.
+
+        Returns:
+        - str: The content of the completion.
+        """
+        kwargs = {"response_format": {"type": "json_object"}} if json_mode else {}
+        model = stage_model(stage)
+        start = time.perf_counter()
+        with span(f"llm_{stage}"):
+            response = self.client.chat.completions.create(
+                model=model,
+                messages=messages,
+                max_tokens=max_tokens,
+                **kwargs
+            )
+        usage = response.usage
+        record_llm_call(stage, model, time.perf_counter() - start,
+                        usage.prompt_tokens if usage else None, usage.completion_tokens if usage else None)
+        return response.choices[0].message.content.strip()
+
+    def stream_chat(self, stage, messages, max_tokens):
+        """
+        Streams the completion of the messages.
+
+        Yields:
+        - str: The content of each chunk as it arrives.
+        """
+        model = stage_model(stage)
+        start = time.perf_counter()
+        usage = None
+        with span(f"llm_{stage}"):
+            stream = self.client.chat.completions.create(
+                model=model,
+                messages=messages,
+                max_tokens=max_tokens,
+                stream=True,
+                stream_options={"include_usage": True}
+            )
+            for chunk in stream:
+                # The last chunk has no choices and carries the usage of the whole completion
+                if chunk.usage:
+                    usage = chunk.usage
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        record_llm_call(stage, model, time.perf_counter() - start,
+                        usage.prompt_tokens if usage else None, usage.completion_tokens if usage else None)
+
+    def embed(self, texts):
+        """
+        Returns the embeddings of the texts.
+
+        Parameters:
+        - texts (list): The texts to embed.
+
+        Returns:
+        - list: One embedding vector per text.
+        """
+        start = time.perf_counter()
+        with span("llm_embedding"):
+            response = self.client.embeddings.create(
+                model=self.embedding_model,
+                input=texts,
+                encoding_format="float"
+            )
+        record_llm_call("embedding", self.embedding_model, time.perf_counter() - start,
+                        response.usage.prompt_tokens if response.usage else None)
+        return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+
+# Answers of the fake provider when no rule from FAKE_LLM_RESPONSES matches
+DEFAULT_FAKE_RULES = [
+    {
+        "system": r"meaningful brief title",
+        "json": True,
+        "response": {"Title": "Sample document", "Description": "A document used for local testing."}
+    },
+    {
+        "json": True,
+        "response": {
+            "Score": 10,
+            "Executable": "Yes",
+            "Answer": 'SELECT "Name", "City" FROM restaurants LIMIT 10',
+            "Location": "No",
+            "ChartName": "None"
+        }
+    }
+]
+
+
+class FakeProvider:
+    """
+    Deterministic stand-in for a model provider. Answers come from a list of rules and embeddings are derived
+    from a hash of the text, so the same input always gives the same output. Latency can be injected to make
+    offline load tests realistic.
+
+    A rule is a JSON object with an optional "match" regular expression searched in the last message, an optional
+    "system" regular expression searched in the first one, an optional "json" flag restricting it to JSON or text
+    requests, and the "response", a string or a JSON object. The first matching rule answers.
+    """
+    name = 'fake'
+
+    def __init__(self, rules=None, latency=FAKE_LLM_LATENCY, jitter=FAKE_LLM_JITTER, token_latency=FAKE_LLM_TOKEN_LATENCY,
+                 embedding_latency=FAKE_EMBEDDING_LATENCY, embedding_dim=FAKE_EMBEDDING_DIM):
+        self.rules = (rules or []) + DEFAULT_FAKE_RULES
+        self.latency = latency
+        self.jitter = jitter
+        self.token_latency = token_latency
+        self.embedding_latency = embedding_latency
+        self.embedding_dim = embedding_dim
+        self.embedding_model = f"fake-{embedding_dim}"
+        self.embedding_namespace = self.embedding_model
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    @classmethod
+    def from_file(cls, path, **kwargs):
+        """
+        Creates a fake provider with the rules stored in a JSON file.
+        """
+        with open(path, 'r') as file:
+            return cls(json.load(file), **kwargs)
+
+    def _count(self, stage):
+        with self.lock:
+            self.calls[stage] = self.calls.get(stage, 0) + 1
+
+    def _wait(self, base, key):
+        delay = base
+        if self.jitter:
+            # Seeded by the request so that a rerun waits the same
+            delay += random.Random(key).uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def answer(self, messages, json_mode=False):
+        """
+        Returns the canned answer of the first rule matching the messages.
+        """
+        first = messages[0]["content"] if messages else ""
+        last = messages[-1]["content"] if messages else ""
+        for rule in self.rules:
+            if "json" in rule and rule["json"] != json_mode:
+                continue
+            if "match" in rule and not re.search(rule["match"], last):
+                continue
+            if "system" in rule and not re.search(rule["system"], first):
+                continue
+            response = rule["response"]
+            return response if isinstance(response, str) else json.dumps(response)
+        return f"Sample answer to: {last[:200]}"
+
+    @staticmethod
+    def count_tokens(text):
+        # Rough estimate, about four characters per token
+        return (len(text) + 3) // 4
+
+    def chat(self, stage, messages, max_tokens, json_mode=False):
+        self._count(stage)
+        start = time.perf_counter()
+        with span(f"llm_{stage}"):
+            content = self.answer(messages, json_mode)
+            self._wait(self.latency, json.dumps(messages, sort_keys=True))
+        record_llm_call(stage, self.name, time.perf_counter() - start,
+                        sum(self.count_tokens(message["content"]) for message in messages), self.count_tokens(content))
+        return content
+
+    def stream_chat(self, stage, messages, max_tokens):
+        self._count(stage)
+        start = time.perf_counter()
+        with span(f"llm_{stage}"):
+            content = self.answer(messages)
+            self._wait(self.latency, json.dumps(messages, sort_keys=True))
+            for token in re.findall(r'\S+\s*', content):
+                if self.token_latency:
+                    time.sleep(self.token_latency)
+                yield token
+        record_llm_call(stage, self.name, time.perf_counter() - start,
+                        sum(self.count_tokens(message["content"]) for message in messages), self.count_tokens(content))
+
+    def embed(self, texts):
+        self._count('embedding')
+        start = time.perf_counter()
+        with span("llm_embedding"):
+            if self.embedding_latency:
+                time.sleep(self.embedding_latency)
+            vectors = [self.fake_embedding(text) for text in texts]
+        record_llm_call("embedding", self.embedding_model, time.perf_counter() - start, sum(self.count_tokens(text) for text in texts))
+        return vectors
+
+    def fake_embedding(self, text):
+        """
+        Returns a unit vector seeded by the hash of the text.
+        """
+        seed = int.from_bytes(hashlib.sha256(text.encode('utf-8')).digest()[:8], 'big')
+        rng = random.Random(seed)
+        vector = [rng.gauss(0, 1) for _ in range(self.embedding_dim)]
+        norm = sum(value * value for value in vector) ** 0.5 or 1.0
+        return [value / norm for value in vector]
+
+    def stats(self):
+        with self.lock:
+            return dict(self.calls)
+
+
+class ProviderEmbeddingFunction(embedding_functions.EmbeddingFunction):
+    """
+    Chroma embedding function that embeds documents and queries with the configured provider.
+    """
+    def __init__(self, provider):
+        self.provider = provider
+
+    def __call__(self, input):
+        return self.provider.embed(list(input))
+
+
+def create_provider():
+    """
+    Creates the provider selected by LLM_PROVIDER.
+
+    Returns:
+    - OpenAIProvider or FakeProvider: The provider.
+    """
+    if LLM_PROVIDER == 'fake':
+        if FAKE_LLM_RESPONSES:
+            return FakeProvider.from_file(FAKE_LLM_RESPONSES)
+        return FakeProvider()
+    if LLM_PROVIDER == 'openai':
+        return OpenAIProvider(api_key=os.getenv('OPENAI_API_KEY'), base_url=LLM_BASE_URL)
+    raise ValueError(f"Unknown LLM_PROVIDER: {LLM_PROVIDER}")
+
+
+llm = create_provider()
+embedding_function = ProviderEmbeddingFunction(llm)
@@ -0,0 +1,172 @@
+"""
+Shared fixtures of the test suite.
+
+The application reads its configuration when it is imported, so the environment is set here first: both databases
+are SQLite files, Chroma and the cache database live in a temporary directory and the model provider is the
+deterministic fake one. Run from the repository root with:
+
+    python -m pytest -q
+"""
+import os
+import re
+import shutil
+import sys
+import tempfile
+
+import pytest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKDIR = tempfile.mkdtemp(prefix='chatbot-tests-')
+
+# Files the application reads from its working directory
+for name in ['db_schema_prompt.txt', 'chart_code.txt', 'map_code.txt', 'heat_code.txt']:
+    shutil.copy(os.path.join(REPO, name), WORKDIR)
+
+os.environ.update({
+    'OPENAI_API_KEY': 'test',
+    'GOOGLE_MAPS_API_KEY': 'AIzaTest',
+    'SECRET_KEY': 'test',
+    'DB_CONFIG': f"sqlite:///{os.path.join(WORKDIR, 'main.sqlite3')}",
+    'DB_CONFIG_TEST': f"sqlite:///{os.path.join(WORKDIR, 'testing.sqlite3')}",
+    'CACHE_DB_PATH': os.path.join(WORKDIR, 'cache', 'cache.sqlite3'),
+    'ANONYMIZED_TELEMETRY': 'False',
+    'LLM_PROVIDER': 'fake',
+    'FAKE_EMBEDDING_DIM': '64',
+    'LOG_LEVEL': 'ERROR',
+})
+os.chdir(WORKDIR)
+sys.path.insert(0, REPO)
+
+# extensions opens the few-shot collection without creating it
+import chromadb
+from chromadb.config import Settings
+
+chromadb.PersistentClient(path="chroma_data", settings=Settings()).get_or_create_collection("few_shot")
+
+CITIES = ['San Luis Potosi', 'Cuernavaca', 'Ciudad Victoria']
+PRICES = ['Low', 'Medium', 'High']
+
+
+def seed_testing_data(db):
+    from model.test import Consumer, Rating, Restaurant
+
+    for restaurant_id in range(30):
+        db.session.add(Restaurant(
+            Restaurant_ID=restaurant_id, Name=f"Restaurant {restaurant_id}", City=CITIES[restaurant_id % 3], State='SLP',
+            Country='Mexico', Zip_Code=str(78000 + restaurant_id), Latitude=22.0 + restaurant_id * 0.01,
+            Longitude=-101.0 + restaurant_id * 0.01, Price=PRICES[restaurant_id % 3]
+        ))
+    for consumer in range(3):
+        db.session.add(Consumer(Consumer_ID=f"U{consumer}", City=CITIES[consumer], Latitude=22.0, Longitude=-101.0))
+    db.session.flush()
+    for consumer in range(3):
+        for restaurant_id in range(30):
+            db.session.add(Rating(Consumer_ID=f"U{consumer}", Restaurant_ID=restaurant_id, Overall_Rating=(restaurant_id + consumer) % 3,
+                                  Food_Rating=consumer, Service_Rating=1))
+    db.session.commit()
+
+
+@pytest.fixture(scope='session')
+def app():
+    from app import app
+    from extensions import db, spatial_index
+
+    with app.app_context():
+        db.create_all()
+        seed_testing_data(db)
+        spatial_index.refresh()
+    return app
+
+
+@pytest.fixture
+def app_context(app):
+    from extensions import db
+
+    with app.app_context():
+        yield
+        db.session.remove()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture(scope='session')
+def user(app):
+    from extensions import db, create_token
+    from model.user import User
+
+    with app.app_context():
+        account = User('tester', 'tester@example.com', 'Tester123!', 'tester')
+        db.session.add(account)
+        db.session.commit()
+        return {"id": account.id, "headers": {'Authorization': f"Bearer {create_token(account.id)}"}}
+
+
+@pytest.fixture
+def chat_id(app, user):
+    from extensions import db
+    from model.chat import Chat
+
+    with app.app_context():
+        chat = Chat('test', user["id"])
+        db.session.add(chat)
+        db.session.commit()
+        return chat.id
+
+
+class RecordingLLM:
+    """
+    Records the messages sent to the fake provider and routes questions to canned answers.
+    """
+    def __init__(self, provider):
+        self.provider = provider
+        self.calls = []
+
+    def route(self, question, answer):
+        self.provider.rules.insert(0, {"match": f"^{re.escape(question)}$", "json": True, "response": answer})
+
+    def messages(self, stage):
+        return [messages for called_stage, messages in self.calls if called_stage == stage]
+
+
+@pytest.fixture
+def fake_llm(monkeypatch):
+    from providers import llm
+
+    recorder = RecordingLLM(llm)
+    monkeypatch.setattr(llm, 'rules', list(llm.rules))
+    chat, stream_chat = llm.chat, llm.stream_chat
+
+    def recording_chat(stage, messages, max_tokens, json_mode=False):
+        recorder.calls.append((stage, messages))
+        return chat(stage, messages, max_tokens, json_mode)
+
+    def recording_stream_chat(stage, messages, max_tokens):
+        recorder.calls.append((stage, messages))
+        return stream_chat(stage, messages, max_tokens)
+
+    monkeypatch.setattr(llm, 'chat', recording_chat)
+    monkeypatch.setattr(llm, 'stream_chat', recording_stream_chat)
+    return recorder
+
+
+@pytest.fixture
+def sql_statements(app):
+    """
+    Records the statements sent to the main database.
+    """
+    from sqlalchemy import event
+    from extensions import db
+
+    with app.app_context():
+        engine = db.engine
+    statements = []
+
+    def record(connection, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', record)
+    yield statements
+    event.remove(engine, 'before_cursor_execute', record)
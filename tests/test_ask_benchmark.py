@@ -0,0 +1,59 @@
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+
+from conftest import REPO
+
+spec = importlib.util.spec_from_file_location("ask_benchmark", os.path.join(REPO, "benchmarks", "ask_benchmark.py"))
+ask_benchmark = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(ask_benchmark)
+
+
+def sample(path, ms, status=201, **stages):
+    return {"path": path, "status": status, "ms": ms, "stages": stages}
+
+
+def test_samples_are_summarized_by_path_and_stage():
+    samples = [sample("table", 100, sql=10), sample("table", 300, sql=30), sample("map", 200, geocode=50), sample("map", 900, status=500)]
+
+    summary = ask_benchmark.summarize(samples, 2.0)
+
+    assert summary["requests"] == 4 and summary["errors"] == 1
+    assert summary["throughput"] == 1.5
+    assert summary["p50"] == 200 and summary["p99"] == 300
+    assert summary["paths"] == {"map": {"count": 1, "p50": 200, "p95": 200}, "table": {"count": 2, "p50": 100, "p95": 300}}
+    assert summary["stages"]["sql"] == {"count": 2, "mean": 20, "p95": 30}
+
+
+def test_server_timing_headers_are_parsed():
+    assert ask_benchmark.parse_server_timing("history;dur=1.5, generate_sql;dur=20, total;dur=30.25") == {
+        "history": 1.5, "generate_sql": 20.0, "total": 30.25
+    }
+    assert ask_benchmark.parse_server_timing(None) == {}
+
+
+def test_regressions_are_reported_beyond_the_tolerance():
+    baseline = ask_benchmark.summarize([sample("table", 100, sql=10), sample("chart", 100)], 1.0)
+    slower = ask_benchmark.summarize([sample("table", 105, sql=20), sample("chart", 100)], 1.1)
+
+    assert ask_benchmark.compare(baseline, baseline, 0.1) == []
+    assert ask_benchmark.compare(slower, baseline, 0.1) == ["stage sql mean"]
+    assert ask_benchmark.compare(slower, baseline, 1.5) == []
+
+
+def test_every_path_of_the_corpus_answers(tmp_path):
+    result = tmp_path / "run.json"
+    env = {name: value for name, value in os.environ.items() if name not in ('DB_CONFIG', 'DB_CONFIG_TEST', 'CACHE_DB_PATH')}
+
+    completed = subprocess.run(
+        [sys.executable, "benchmarks/ask_benchmark.py", "--requests", "24", "--warmup", "0", "--concurrency", "2", "--restaurants", "40",
+         "--llm-latency", "0", "--llm-jitter", "0", "--embedding-latency", "0", "--geocode-latency", "0", "--save-baseline", str(result)],
+        cwd=REPO, env=env, capture_output=True, text=True, timeout=300
+    )
+
+    assert completed.returncode == 0, completed.stderr[-2000:]
+    summary = json.loads(result.read_text())
+    assert summary["errors"] == 0
+    assert set(summary["paths"]) == {"chart", "heatmap", "map", "pdf", "table"}
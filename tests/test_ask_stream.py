@@ -0,0 +1,71 @@
+import json
+
+from extensions import db
+from model.chat import Conversation
+
+# Five columns so that the formatting model writes the answer
+QUESTION = "List the names, cities, states, countries and prices of three restaurants for the stream test"
+ANSWER = {"Score": 10, "Executable": "Yes", "Answer": 'SELECT "Name", "City", "State", "Country", "Price" FROM restaurants ORDER BY "Restaurant_ID" LIMIT 3',
+          "Location": "No", "ChartName": "None"}
+
+
+def read_events(response):
+    events = []
+    for block in response.get_data(as_text=True).split("\n\n"):
+        if block:
+            event, data = block.split("\n")
+            events.append((event[len("event: "):], json.loads(data[len("data: "):])))
+    return events
+
+
+def stream(client, user, chat_id, question):
+    return client.post('/chat/ask/stream', json={'question': question, 'chat_id': chat_id}, headers=user["headers"])
+
+
+def test_events_follow_the_stages_of_the_answer(app, client, user, chat_id, fake_llm):
+    fake_llm.route(QUESTION, ANSWER)
+
+    response = stream(client, user, chat_id, QUESTION)
+
+    assert response.mimetype == 'text/event-stream'
+    events = read_events(response)
+    names = [name for name, _ in events]
+    first_token = names.index("token")
+    assert names[:first_token] == ["start", "routing", "sql", "rows", "formatting"]
+    assert set(names[first_token:-2]) == {"token"}
+    assert names[-2:] == ["timings", "done"]
+
+    data = dict(events)
+    assert data["start"] == {"chat_id": chat_id}
+    assert data["routing"]["Executable"] == "Yes"
+    assert data["sql"]["query"] == ANSWER["Answer"]
+    assert data["rows"]["count"] == 3 and data["rows"]["columns"] == ["Name", "City", "State", "Country", "Price"]
+    assert data["formatting"] == {"mode": "gpt"}
+    assert {"history", "generate_sql", "execute_sql"} <= set(data["timings"])
+
+    # The streamed tokens make up the stored answer
+    streamed = "".join(payload["content"] for name, payload in events if name == "token")
+    with app.app_context():
+        conversation = db.session.get(Conversation, data["done"]["conversation_id"])
+        assert conversation.response == streamed.strip() == data["done"]["message"]
+
+
+def test_simple_results_are_sent_as_one_token(client, user, chat_id, fake_llm):
+    question = "How many restaurants are there for the stream test?"
+    fake_llm.route(question, {"Score": 10, "Executable": "Yes", "Answer": 'SELECT COUNT(*) FROM restaurants', "Location": "No", "ChartName": "None"})
+
+    events = read_events(stream(client, user, chat_id, question))
+
+    assert ("formatting", {"mode": "rules"}) in events
+    assert len([name for name, _ in events if name == "token"]) == 1
+    assert fake_llm.messages("format") == []
+
+
+def test_rejected_queries_end_with_an_error_event(client, user, chat_id, fake_llm):
+    question = "Remove every restaurant for the stream test"
+    fake_llm.route(question, {"Score": 10, "Executable": "Yes", "Answer": 'DELETE FROM restaurants', "Location": "No", "ChartName": "None"})
+
+    events = read_events(stream(client, user, chat_id, question))
+
+    assert [name for name, _ in events] == ["start", "routing", "error"]
+    assert events[-1][1]["status"] == 403
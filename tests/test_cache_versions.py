@@ -0,0 +1,27 @@
+from extensions import bump_cache_version, get_cache_db, get_cache_version, get_cache_versions
+
+
+def test_versions_start_at_zero_and_are_bumped():
+    assert get_cache_version("versions_test_a") == 0
+
+    bump_cache_version("versions_test_a")
+    bump_cache_version("versions_test_a")
+    bump_cache_version("versions_test_b")
+
+    assert get_cache_version("versions_test_a") == 2
+    assert get_cache_versions(["versions_test_b", "versions_test_a", "versions_test_c"]) == (1, 2, 0)
+
+
+def test_reading_versions_does_not_touch_the_schema():
+    statements = []
+    connection = get_cache_db()
+    connection.set_trace_callback(statements.append)
+    try:
+        get_cache_version("versions_test_a")
+        get_cache_versions(["versions_test_a", "versions_test_b"])
+        bump_cache_version("versions_test_c")
+    finally:
+        connection.set_trace_callback(None)
+
+    assert statements
+    assert not [statement for statement in statements if 'CREATE' in statement.upper()]
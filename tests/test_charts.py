@@ -0,0 +1,157 @@
+import math
+import random
+
+import numpy as np
+import pytest
+
+import extensions
+from extensions import downsample_chart_data, lttb_indexes, pivot_heatmap
+
+
+def legacy_pivot(result):
+    # The loop ask() used before pivot_heatmap, see benchmarks/heatmap_pivot.py
+    xlabels = list(set([row[0] for row in result]))
+    ylabels = list(set([row[1] for row in result]))
+    heatmap_data = [[0 for _ in xlabels] for _ in ylabels]
+    for row in result:
+        x_index = xlabels.index(row[0])
+        y_index = ylabels.index(row[1])
+        heatmap_data[y_index][x_index] = row[2]
+    return xlabels, ylabels, heatmap_data
+
+
+def cells(xlabels, ylabels, grid):
+    return {(x, y): grid[j][i] for j, y in enumerate(ylabels) for i, x in enumerate(xlabels)}
+
+
+# One row per cell, with the (Wed, night) and (Sun, *) cells missing
+ROWS = [(day, slot, (3 * d + s) % 7 + 1) for d, day in enumerate(['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat'])
+        for s, slot in enumerate(['morning', 'noon', 'night']) if (day, slot) != ('Wed', 'night')]
+ROWS = random.Random(4).sample(ROWS, len(ROWS))
+
+
+def test_pivot_matches_the_legacy_loop_cell_by_cell():
+    xlabels, ylabels, grid = pivot_heatmap(ROWS, 'sum')
+
+    assert cells(xlabels, ylabels, grid) == cells(*legacy_pivot(ROWS))
+    assert grid[ylabels.index('night')][xlabels.index('Wed')] == 0
+    assert 'Sun' not in xlabels
+
+
+def test_pivot_labels_are_sorted_whatever_the_row_order():
+    xlabels, ylabels, grid = pivot_heatmap(ROWS, 'sum')
+
+    assert xlabels == ['Fri', 'Mon', 'Sat', 'Thu', 'Tue', 'Wed']
+    assert ylabels == ['morning', 'night', 'noon']
+    assert pivot_heatmap(list(reversed(ROWS)), 'sum') == (xlabels, ylabels, grid)
+
+
+def test_pivot_keeps_null_labels_and_values():
+    rows = [(None, 'a', 1), (2, 'a', None), (1, None, 5), (2, None, 4)]
+
+    xlabels, ylabels, grid = pivot_heatmap(rows, 'sum')
+
+    # Numbers first and NULL last, NULL labels are shown as "None" and NULL values count as 0
+    assert xlabels == [1, 2, 'None']
+    assert ylabels == ['a', 'None']
+    assert grid == [[0, 0, 1], [5, 4, 0]]
+    legacy = cells(*legacy_pivot(rows))
+    assert {(str(x) if x is None else x, str(y) if y is None else y): value or 0 for (x, y), value in legacy.items()} == cells(xlabels, ylabels, grid)
+
+
+def test_duplicate_cells_are_aggregated_instead_of_overwritten():
+    rows = ROWS + [('Mon', 'noon', 10), ('Mon', 'noon', 20)]
+    expected = cells(*pivot_heatmap(ROWS, 'sum'))
+    first = expected[('Mon', 'noon')]
+
+    summed = cells(*pivot_heatmap(rows, 'sum'))
+    counted = cells(*pivot_heatmap(rows, 'count'))
+    averaged = cells(*pivot_heatmap(rows, 'avg'))
+
+    # The legacy loop kept whichever duplicate came last
+    assert cells(*legacy_pivot(rows))[('Mon', 'noon')] == 20
+    assert summed == {**expected, ('Mon', 'noon'): first + 30}
+    assert counted == {cell: 0 if cell == ('Wed', 'night') else (3 if cell == ('Mon', 'noon') else 1) for cell in expected}
+    assert averaged[('Mon', 'noon')] == pytest.approx((first + 30) / 3)
+    assert averaged[('Wed', 'night')] == 0
+
+
+def test_unknown_aggregation_is_rejected():
+    with pytest.raises(ValueError):
+        pivot_heatmap(ROWS, 'median')
+
+
+def reference_lttb(values, threshold):
+    # Straightforward transcription of the algorithm of Steinarsson's thesis, one point at a time
+    every = (len(values) - 2) / (threshold - 2)
+    kept = [0]
+    a = 0
+    for i in range(threshold - 2):
+        average_start = math.floor((i + 1) * every) + 1
+        average_end = min(math.floor((i + 2) * every) + 1, len(values))
+        average_x = sum(range(average_start, average_end)) / (average_end - average_start)
+        average_y = sum(values[average_start:average_end]) / (average_end - average_start)
+        max_area, next_a = -1, None
+        for j in range(math.floor(i * every) + 1, math.floor((i + 1) * every) + 1):
+            area = abs((a - average_x) * (values[j] - values[a]) - (a - j) * (average_y - values[a])) * 0.5
+            if area > max_area:
+                max_area, next_a = area, j
+        kept.append(next_a)
+        a = next_a
+    kept.append(len(values) - 1)
+    return kept
+
+
+@pytest.mark.parametrize("count,threshold", [(1000, 100), (1001, 500), (37, 3), (10, 9)])
+def test_lttb_matches_the_reference_implementation(count, threshold):
+    generator = random.Random(count)
+    values = [math.sin(i / 15) * 50 + generator.gauss(0, 5) for i in range(count)]
+
+    assert lttb_indexes(np.array(values), threshold) == reference_lttb(values, threshold)
+
+
+def test_line_charts_keep_their_extremes_and_order(monkeypatch):
+    monkeypatch.setattr(extensions, 'LINE_CHART_MAX_POINTS', 50)
+    data = [{"labelX": f"2024-01-{i:04d}", "labelY": 100 if i == 400 else i % 10} for i in range(1000)]
+
+    reduced, reduction = downsample_chart_data(data, "LineChart")
+
+    assert reduction == {"method": "lttb", "original_points": 1000, "points": 50}
+    assert reduced[0] == data[0] and reduced[-1] == data[-1]
+    assert {"labelX": "2024-01-0400", "labelY": 100} in reduced
+    assert [point["labelX"] for point in reduced] == sorted(point["labelX"] for point in reduced)
+
+
+def test_small_charts_are_kept_as_is():
+    data = [{"labelX": str(i), "labelY": i} for i in range(20)]
+
+    assert downsample_chart_data(data, "LineChart") == (data, None)
+    assert downsample_chart_data(data, "BarChart") == (data, None)
+
+
+def test_bar_charts_keep_the_largest_categories_and_the_total(monkeypatch):
+    monkeypatch.setattr(extensions, 'BAR_CHART_MAX_CATEGORIES', 4)
+    data = [{"labelX": "a", "labelY": 5}, {"labelX": "b", "labelY": None}, {"labelX": "c", "labelY": 9},
+            {"labelX": "d", "labelY": "7"}, {"labelX": "e", "labelY": 1}, {"labelX": "f", "labelY": 2.5}]
+
+    reduced, reduction = downsample_chart_data(data, "BarChart")
+
+    # The three largest in the order of the query, the rest summed into "Other"
+    assert reduced == [{"labelX": "a", "labelY": 5}, {"labelX": "c", "labelY": 9}, {"labelX": "d", "labelY": "7"},
+                       {"labelX": "Other", "labelY": 3.5}]
+    assert reduction == {"method": "top_n", "original_points": 6, "points": 4}
+
+
+def test_reduced_charts_say_so(monkeypatch, client, user, chat_id, fake_llm):
+    question = "Show a pie chart of the IDs of the restaurants for the downsampling test"
+    fake_llm.route(question, {"Score": 10, "Executable": "Yes", "Answer": 'SELECT "Name", "Restaurant_ID" FROM restaurants ORDER BY "Restaurant_ID"',
+                              "Location": "No", "ChartName": "PieChart"})
+    monkeypatch.setattr(extensions, 'PIE_CHART_MAX_CATEGORIES', 10)
+
+    answer = client.post('/chat/ask', json={'question': question, 'chat_id': chat_id, 'response_mode': 'payload'}, headers=user["headers"]).json
+
+    visualization = answer["visualization"]
+    assert answer["message"] == "Here is your PieChart (reduced from 30 to 10 points)"
+    assert visualization["reduction"] == {"method": "top_n", "original_points": 30, "points": 10}
+    assert [point["labelX"] for point in visualization["values"]["data"]] == [f"Restaurant {i}" for i in range(21, 30)] + ["Other"]
+    assert visualization["values"]["data"][-1]["labelY"] == sum(range(21))
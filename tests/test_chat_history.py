@@ -0,0 +1,97 @@
+import json
+import re
+
+from extensions import db
+from model.chat import Chat, Conversation, Feedback
+
+# Five columns so that the formatting model writes the answer
+QUESTION = "List the names, cities, states, countries and prices of two restaurants"
+ANSWER = {"Score": 10, "Executable": "Yes", "Answer": 'SELECT "Name", "City", "State", "Country", "Price" FROM restaurants LIMIT 2',
+          "Location": "No", "ChartName": "None"}
+
+
+def add_conversations(chat_id, count):
+    # Each conversation is about 500 tokens, so that eight of them go over HISTORY_TOKEN_BUDGET
+    for number in range(count):
+        conversation = Conversation(chat_id, f"Question {number}", f"Answer {number} " + "x" * 2000, 'SELECT 1', 10, 'Yes', 'No', 'None')
+        db.session.add(conversation)
+        db.session.flush()
+        db.session.add(Feedback(conversation.id, 'positive', f"POSITIVE{number}"))
+        db.session.add(Feedback(conversation.id, 'negative', f"NEGATIVE{number}"))
+    db.session.commit()
+
+
+def selects_from(statements, table):
+    return [statement for statement in statements if re.match(rf'\s*SELECT\b.*\bFROM {table}\b', statement, re.DOTALL)]
+
+
+def test_folding_the_history_keeps_the_window_loaded_once(app, client, user, chat_id, fake_llm, sql_statements):
+    with app.app_context():
+        add_conversations(chat_id, 8)
+    fake_llm.route(QUESTION, ANSWER)
+    sql_statements.clear()
+
+    response = client.post('/chat/ask', json={'question': QUESTION, 'chat_id': chat_id}, headers=user["headers"])
+
+    assert response.status_code == 201
+    assert len(fake_llm.messages("summary")) == 1
+    for stage in ("route", "format"):
+        prompt = json.dumps(fake_llm.messages(stage)[0])
+        assert "(Negative feedback on assistant response: NEGATIVE7)" in prompt
+        assert "POSITIVE" not in prompt
+    # The history and its feedback are loaded by one query each, the window is not reloaded conversation by conversation
+    assert len(selects_from(sql_statements, 'conversation')) == 1
+    assert len(selects_from(sql_statements, 'feedback')) == 1
+
+    with app.app_context():
+        chat = db.session.get(Chat, chat_id)
+        assert chat.summary
+        assert chat.summarized_until is not None
+
+
+def test_only_the_conversations_after_the_summary_are_loaded(app, client, user, chat_id, fake_llm, sql_statements):
+    with app.app_context():
+        add_conversations(chat_id, 8)
+    fake_llm.route(QUESTION, ANSWER)
+    client.post('/chat/ask', json={'question': QUESTION, 'chat_id': chat_id}, headers=user["headers"])
+    with app.app_context():
+        summarized_until = db.session.get(Chat, chat_id).summarized_until
+    sql_statements.clear()
+
+    response = client.post('/chat/ask', json={'question': QUESTION, 'chat_id': chat_id}, headers=user["headers"])
+
+    assert response.status_code == 201
+    assert len(fake_llm.messages("summary")) == 1
+    [history_query] = selects_from(sql_statements, 'conversation')
+    assert 'conversation.id >' in history_query
+    verbatim = [message["content"] for message in fake_llm.messages("route")[-1] if message["role"] == "user"]
+    assert not any(content.startswith("Question 0 ") for content in verbatim)
+    with app.app_context():
+        assert db.session.get(Chat, chat_id).summarized_until == summarized_until
+
+
+def test_history_is_loaded_with_its_negative_feedback_in_two_queries(app, chat_id, sql_statements):
+    from blueprints.chat_bp import load_chat_history, query_with_feedback
+
+    with app.app_context():
+        add_conversations(chat_id, 3)
+        db.session.expunge_all()
+        sql_statements.clear()
+
+        history = load_chat_history(chat_id)
+        prompts = [query_with_feedback(convo) for convo in history]
+
+        assert len(sql_statements) == 2
+        assert prompts == [f"Question {number} (Negative feedback on assistant response: NEGATIVE{number})" for number in range(3)]
+
+
+def test_positive_feedback_is_never_sent_as_negative(app, chat_id):
+    from blueprints.chat_bp import query_with_feedback
+
+    with app.app_context():
+        add_conversations(chat_id, 1)
+        # Loaded without the negative-only criteria of load_chat_history
+        conversation = Conversation.query.filter_by(chat_id=chat_id).one()
+
+        assert len(conversation.feedbacks) == 2
+        assert query_with_feedback(conversation) == "Question 0 (Negative feedback on assistant response: NEGATIVE0)"
@@ -0,0 +1,61 @@
+import datetime
+import json
+from decimal import Decimal
+
+from extensions import CODE_TEMPLATES, compact_json, generate_chart_code, generate_map_code
+
+QUESTION = "Show a bar chart of the number of restaurants per price for the template test"
+ANSWER = {"Score": 10, "Executable": "Yes", "Answer": 'SELECT "Price", COUNT(*) FROM restaurants GROUP BY "Price" ORDER BY "Price"',
+          "Location": "No", "ChartName": "BarChart"}
+
+
+def test_rendering_matches_replacing_each_placeholder():
+    data = [{"labelX": "Low", "labelY": Decimal("10")}, {"labelX": datetime.date(2024, 1, 31), "labelY": 2.5}]
+    with open('chart_code.txt') as file:
+        source = file.read()
+
+    expected = source.replace("{chartName}", "BarChart").replace("{chartComponent}", "Bar").replace("{data}", compact_json(data))\
+        .replace("{labelX}", "Price").replace("{labelY}", "Total")
+
+    assert generate_chart_code(data, "Price", "Total", "BarChart") == expected
+    # Decimal and date values are written as JSON
+    assert '[{"labelX":"Low","labelY":10.0},{"labelX":"2024-01-31","labelY":2.5}]' in expected
+
+
+def test_map_types_are_written_as_strings():
+    code = generate_map_code([{"lat": 22.0, "lng": -101.0}], "TriangleMaps")
+
+    assert '[{"lat":22.0,"lng":-101.0}]' in code
+    assert '"triangle"' in code
+    assert "{coordinates}" not in code and "{type}" not in code
+
+
+def test_templates_are_served_with_an_etag(client, user):
+    template = CODE_TEMPLATES["heatmap"]
+
+    response = client.get('/chat/templates/heatmap', headers=user["headers"])
+
+    assert response.status_code == 200
+    assert response.headers["ETag"] == f'"{template.version}"'
+    assert response.json["source"] == template.source
+    assert set(response.json["placeholders"]) == {"xLabels", "yLabels", "heatMapData"}
+
+    revalidated = client.get('/chat/templates/heatmap', headers={**user["headers"], "If-None-Match": response.headers["ETag"]})
+    assert revalidated.status_code == 304
+    assert client.get('/chat/templates/missing', headers=user["headers"]).status_code == 404
+    assert client.get('/chat/templates/heatmap').status_code == 401
+
+
+def test_payload_mode_returns_the_values_instead_of_the_code(client, user, chat_id, fake_llm):
+    fake_llm.route(QUESTION, ANSWER)
+
+    code = client.post('/chat/ask', json={'question': QUESTION, 'chat_id': chat_id}, headers=user["headers"]).json
+    payload = client.post('/chat/ask', json={'question': QUESTION, 'chat_id': chat_id, 'response_mode': 'payload'}, headers=user["headers"]).json
+
+    visualization = payload["visualization"]
+    assert visualization["template"] == "chart"
+    assert visualization["version"] == CODE_TEMPLATES["chart"].version
+    assert visualization["values"]["data"] == [{"labelX": "High", "labelY": 10}, {"labelX": "Low", "labelY": 10}, {"labelX": "Medium", "labelY": 10}]
+    assert payload["message"] == visualization["caption"]
+    assert code["message"] == f"{visualization['caption']}: {CODE_TEMPLATES['chart'].render(visualization['values'])}"
+    assert json.dumps(visualization["values"]["data"], separators=(',', ':')) in code["message"]
@@ -0,0 +1,40 @@
+import pytest
+
+import extensions
+from extensions import CoordinateResolver, Gazetteer
+
+
+@pytest.fixture
+def resolver(app):
+    return CoordinateResolver(Gazetteer())
+
+
+def test_rows_with_coordinates_are_used_as_is(resolver):
+    assert resolver.resolve_offline(("Anywhere", "22.5", -100.5), ["Name", "Latitude", "Longitude"]) == ((22.5, -100.5), None)
+
+
+def test_known_restaurants_are_placed_exactly(resolver):
+    location, address = resolver.resolve_offline(("Restaurant 3", "San Luis Potosi"), ["Name", "City"])
+
+    assert location == pytest.approx((22.03, -100.97))
+    assert address is None
+
+
+def test_rows_describing_a_city_use_its_centroid(resolver):
+    location, address = resolver.resolve_offline(("San Luis Potosi", "SLP", "Mexico", 10), ["City", "State", "Country", "count"])
+
+    # Restaurants 0, 3, ..., 27 and consumer U0 are in San Luis Potosi
+    assert location == pytest.approx(((sum(22.0 + i * 0.01 for i in range(0, 30, 3)) + 22.0) / 11,
+                                      (sum(-101.0 + i * 0.01 for i in range(0, 30, 3)) - 101.0) / 11))
+    assert address is None
+
+
+def test_unknown_names_are_not_placed_at_the_city_centroid(resolver, monkeypatch):
+    row, keys = ("Unknown Bistro", "San Luis Potosi"), ["Name", "City"]
+
+    assert resolver.resolve_offline(row, keys) == (None, "Unknown Bistro, San Luis Potosi")
+
+    # Left unresolved when the geocoder does not find it either
+    monkeypatch.setattr(extensions, 'geocode_batch', lambda addresses: {})
+    assert resolver.resolve_all([row], keys) == [None]
+    assert resolver.stats()["unresolved"] == 1
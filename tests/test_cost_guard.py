@@ -0,0 +1,108 @@
+from types import SimpleNamespace
+
+import pytest
+
+import extensions
+from extensions import QueryCostError, guard_query_cost
+
+QUERY = 'SELECT * FROM ratings r1 CROSS JOIN ratings r2'
+
+
+@pytest.fixture
+def explained(monkeypatch):
+    """
+    Makes the read-only engine look like PostgreSQL and records the statements explained. The plan of the
+    cross join is over the row limit, the plan of a limited statement is not.
+    """
+    statements = []
+
+    def explain(sql_query):
+        statements.append(sql_query)
+        if "LIMIT" in sql_query:
+            return {"cost": 50.0, "rows": 1001.0}
+        return {"cost": 500.0, "rows": 8100.0}
+
+    monkeypatch.setattr(extensions, 'get_readonly_engine', lambda: SimpleNamespace(dialect=SimpleNamespace(name='postgresql')))
+    monkeypatch.setattr(extensions, 'explain_query', explain)
+    monkeypatch.setattr(extensions, 'SQL_MAX_ESTIMATED_ROWS', 5000)
+    monkeypatch.setattr(extensions, 'SQL_MAX_ESTIMATED_COST', 1000)
+    return statements
+
+
+def test_statements_over_the_row_limit_are_limited(explained, monkeypatch):
+    monkeypatch.setattr(extensions, 'SQL_COST_GUARD', 'limit')
+
+    sql_query, estimate = guard_query_cost(QUERY, row_limit=1000)
+
+    # One row past the limit tells the caller that the result goes on
+    assert sql_query == f"SELECT * FROM ({QUERY}\n) AS limited_query LIMIT 1001"
+    assert estimate == {"cost": 50.0, "rows": 1001.0}
+    assert explained == [QUERY, sql_query]
+
+
+def test_pages_past_the_row_cap_are_limited_to_the_end_of_the_page(explained, monkeypatch):
+    monkeypatch.setattr(extensions, 'SQL_COST_GUARD', 'limit')
+
+    sql_query, _ = guard_query_cost(QUERY, row_limit=3000)
+
+    assert sql_query.endswith("LIMIT 3001")
+
+
+def test_reject_mode_refuses_large_results(explained, monkeypatch):
+    monkeypatch.setattr(extensions, 'SQL_COST_GUARD', 'reject')
+
+    with pytest.raises(QueryCostError, match="8100 rows"):
+        guard_query_cost(QUERY)
+
+
+def test_expensive_statements_are_refused(explained, monkeypatch):
+    monkeypatch.setattr(extensions, 'SQL_COST_GUARD', 'limit')
+    monkeypatch.setattr(extensions, 'SQL_MAX_ESTIMATED_COST', 10)
+
+    with pytest.raises(QueryCostError, match="too long"):
+        guard_query_cost(QUERY)
+
+
+def test_statements_are_not_checked_when_the_guard_is_off(explained, monkeypatch):
+    monkeypatch.setattr(extensions, 'SQL_COST_GUARD', 'off')
+
+    assert guard_query_cost(QUERY) == (QUERY, None)
+    assert explained == []
+
+
+def test_other_databases_are_not_checked(app):
+    assert guard_query_cost(QUERY) == (QUERY, None)
+
+
+def test_result_pages_are_checked_up_to_their_last_row(app, client, user, chat_id, fake_llm, monkeypatch):
+    from blueprints import chat_bp
+
+    question = "List every rating for the cost guard test"
+    fake_llm.route(question, {"Score": 10, "Executable": "Yes", "Answer": 'SELECT "Consumer_ID", "Restaurant_ID" FROM ratings', "Location": "No", "ChartName": "None"})
+    url = client.post('/chat/ask', json={'question': question, 'chat_id': chat_id}, headers=user["headers"]).json["result_urls"][0]
+    row_limits = []
+
+    def guard(sql_query, row_limit=extensions.QUERY_ROW_CAP):
+        row_limits.append(row_limit)
+        return guard_query_cost(sql_query, row_limit)
+
+    monkeypatch.setattr(chat_bp, 'guard_query_cost', guard)
+
+    page = client.get(url.replace("page=1", "page=3") + "&page_size=20", headers=user["headers"]).json
+
+    assert row_limits == [60]
+    assert len(page["rows"]) == 20 and page["has_more"] is True
+
+
+def test_refused_statements_answer_with_a_403(client, user, chat_id, fake_llm, monkeypatch):
+    def refuse(sql_query, row_limit=extensions.QUERY_ROW_CAP):
+        raise QueryCostError("This question would take too long to answer, please narrow it down.")
+
+    monkeypatch.setattr(extensions, 'guard_query_cost', refuse)
+    question = "Cross every rating with every other for the cost guard test"
+    fake_llm.route(question, {"Score": 10, "Executable": "Yes", "Answer": QUERY, "Location": "No", "ChartName": "None"})
+
+    response = client.post('/chat/ask', json={'question': question, 'chat_id': chat_id}, headers=user["headers"])
+
+    assert response.status_code == 403
+    assert "too long" in response.json["message"]
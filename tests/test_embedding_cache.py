@@ -0,0 +1,59 @@
+import pytest
+
+import extensions
+from extensions import EmbeddingCache, get_embeddings
+from providers import llm
+
+
+@pytest.fixture
+def embed_calls(monkeypatch):
+    calls = []
+    embed = llm.embed
+
+    def recording_embed(texts):
+        calls.append(list(texts))
+        return embed(texts)
+
+    monkeypatch.setattr(llm, 'embed', recording_embed)
+    return calls
+
+
+def test_each_text_is_embedded_once(embed_calls):
+    first = get_embeddings("Which restaurants are open late for the embedding test?")
+    second = get_embeddings("Which restaurants are open late for the embedding test?")
+
+    assert first == pytest.approx(second)
+    assert embed_calls == [["Which restaurants are open late for the embedding test?"]]
+
+
+def test_embeddings_survive_a_restart():
+    cache = EmbeddingCache(2)
+    cache.set("model-a", "survives", [0.25, -1.5, 3.0])
+
+    # A new cache has an empty memory tier and reads the database
+    restarted = EmbeddingCache(2)
+
+    assert restarted.get("model-a", "survives") == [0.25, -1.5, 3.0]
+    assert restarted.get("model-b", "survives") is None
+    assert restarted.stats()["disk_hits"] == 1
+    assert restarted.stats()["misses"] == 1
+
+
+def test_the_memory_tier_keeps_the_most_recent_entries():
+    cache = EmbeddingCache(2)
+    for text in ("a", "b", "c"):
+        cache.set("model-lru", text, [1.0])
+    cache.get("model-lru", "b")
+
+    assert list(cache.memory) == [EmbeddingCache.make_key("model-lru", "c"), EmbeddingCache.make_key("model-lru", "b")]
+    # Evicted entries are still served from the database
+    assert cache.get("model-lru", "a") == [1.0]
+    assert cache.stats()["memory_hits"] == 1
+
+
+def test_the_model_is_part_of_the_key(monkeypatch, embed_calls):
+    get_embeddings("Same text, other model")
+    monkeypatch.setattr(extensions, 'EMBEDDING_MODEL', 'other-model')
+    get_embeddings("Same text, other model")
+
+    assert len(embed_calls) == 2
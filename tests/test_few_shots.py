@@ -0,0 +1,51 @@
+import threading
+
+import extensions
+from observability import StageTimings
+from providers import llm
+
+
+def test_both_collections_are_queried_concurrently_with_one_embedding(app, monkeypatch):
+    embedded = []
+    # Each query waits for the other one, so they only finish if they run at the same time
+    barrier = threading.Barrier(2, timeout=5)
+
+    def embed(text):
+        embedded.append(text)
+        return llm.fake_embedding(text)
+
+    def main_query(few_shot_collection, embedding, n_results, distance_threshold):
+        barrier.wait()
+        return [{"Question": "main"}]
+
+    def user_query(user_id, embedding, n_results, distance_threshold):
+        barrier.wait()
+        return [{"Question": f"user {user_id}"}]
+
+    monkeypatch.setattr(extensions, 'get_embeddings', embed)
+    monkeypatch.setattr(extensions, 'query_few_shots', main_query)
+    monkeypatch.setattr(extensions, 'query_user_few_shots', user_query)
+    timings = StageTimings()
+
+    futures = extensions.executor.submit(extensions.submit_few_shot_queries, "question", 7, timings).result()
+
+    assert [example for future in futures for example in future.result()] == [{"Question": "main"}, {"Question": "user 7"}]
+    assert embedded == ["question"]
+    assert {"few_shot_query", "few_shot_user_query"} <= set(timings.as_dict())
+
+
+def test_only_examples_within_the_distance_threshold_are_kept(app):
+    few_shot_collection = extensions.client_chroma.get_or_create_collection(name="few_shot_test", embedding_function=extensions.openai_ef)
+    few_shot_collection.add(
+        ids=["close", "far"],
+        embeddings=[llm.fake_embedding("close"), llm.fake_embedding("far")],
+        metadatas=[{"Question": question, "Score": 10, "Executable": "Yes", "Answer": "SELECT 1", "Location": "No", "ChartName": "None"}
+                   for question in ("close", "far")]
+    )
+    try:
+        examples = extensions.query_few_shots(few_shot_collection, llm.fake_embedding("close"), 2, 0.5)
+    finally:
+        extensions.client_chroma.delete_collection("few_shot_test")
+
+    assert [example["Question"] for example in examples] == ["close"]
+    assert examples[0]["Answer"] == "SELECT 1"
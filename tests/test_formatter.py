@@ -0,0 +1,99 @@
+import json
+from decimal import Decimal
+
+from extensions import QueryResult, column_label, db, format_result_with_rules
+from model.chat import Chat, Conversation, Feedback
+
+QUESTION = "How many restaurants are there for the formatter test?"
+ANSWER = {"Score": 10, "Executable": "Yes", "Answer": 'SELECT COUNT(*) FROM restaurants', "Location": "No", "ChartName": "None"}
+
+
+def ask(client, user, chat_id):
+    return client.post('/chat/ask', json={'question': QUESTION, 'chat_id': chat_id}, headers=user["headers"])
+
+
+def add_conversation(chat_id, feedback_type=None):
+    conversation = Conversation(chat_id, "How many cities are there?", "There are 3 cities.", 'SELECT 1', 10, 'Yes', 'No', 'None')
+    db.session.add(conversation)
+    db.session.flush()
+    if feedback_type:
+        db.session.add(Feedback(conversation.id, feedback_type, "Answer with a full sentence in Spanish"))
+    db.session.commit()
+    return conversation
+
+
+def test_simple_results_are_answered_without_the_model(app, client, user, chat_id, fake_llm):
+    with app.app_context():
+        add_conversation(chat_id, 'positive')
+    fake_llm.route(QUESTION, ANSWER)
+
+    response = ask(client, user, chat_id)
+
+    assert response.status_code == 201
+    assert "30" in response.json["message"]
+    assert fake_llm.messages("format") == []
+
+
+def test_chats_with_negative_feedback_are_answered_by_the_model(app, client, user, chat_id, fake_llm):
+    with app.app_context():
+        add_conversation(chat_id, 'negative')
+    fake_llm.route(QUESTION, ANSWER)
+
+    response = ask(client, user, chat_id)
+
+    assert response.status_code == 201
+    [messages] = fake_llm.messages("format")
+    assert "Answer with a full sentence in Spanish" in json.dumps(messages)
+
+
+def test_negative_feedback_folded_into_the_summary_is_found(app, chat_id):
+    from blueprints.chat_bp import has_negative_feedback, load_chat_history
+
+    with app.app_context():
+        folded = add_conversation(chat_id, 'negative')
+        add_conversation(chat_id)
+        chat = db.session.get(Chat, chat_id)
+        chat.summary, chat.summarized_until = "The user asked for the number of cities.", folded.id
+        db.session.commit()
+        window = load_chat_history(chat_id, after_id=folded.id)
+
+        assert has_negative_feedback(chat_id, window, chat.summary)
+        assert not has_negative_feedback(chat_id, window, None)
+
+
+def result(keys, rows, has_more=False):
+    return QueryResult([("SELECT", keys, rows, has_more)])
+
+
+def test_columns_are_named_in_words():
+    assert column_label('AVG("Food_Rating")') == "average food rating"
+    assert column_label('COUNT(*)') == "count"
+    assert column_label('num_restaurants') == "number of restaurants"
+    assert column_label('restaurantName') == "restaurant name"
+    assert column_label('?column?') is None
+
+
+def test_simple_results_are_answered_from_templates():
+    follow_ups = ("anything else", "help you")
+
+    assert format_result_with_rules(QUESTION, result(["Name"], [])).startswith("I could not find any results")
+    assert format_result_with_rules(QUESTION, result(['COUNT(*)'], [(30,)])).startswith("The count is 30.")
+    assert format_result_with_rules(QUESTION, result(['?column?'], [(Decimal("2.50"),)])).startswith("The answer is 2.5.")
+    single_row = format_result_with_rules(QUESTION, result(["Name", "City"], [("Tortas Locas", "Monterrey")]))
+    assert single_row.startswith("Here is what I found: Name: Tortas Locas, City: Monterrey.")
+    assert any(phrase in single_row.lower() for phrase in follow_ups)
+
+    listing = format_result_with_rules(QUESTION, result(["Name", "avg_rating"], [("Tortas Locas", 4.25), ("Cafe Ambar", None)]))
+    assert listing.splitlines()[:3] == [
+        "I found 2 results:",
+        "1) Tortas Locas (Average rating: 4.25)",
+        "2) Cafe Ambar (Average rating: unknown)",
+    ]
+
+
+def test_other_results_are_left_to_the_model():
+    # Too many rows, cut rows, too many columns and unnamed describing columns
+    assert format_result_with_rules(QUESTION, result(["Name"], [(str(i),) for i in range(11)])) is None
+    assert format_result_with_rules(QUESTION, result(["Name"], [("a",)], has_more=True)) is None
+    assert format_result_with_rules(QUESTION, result(list("abcde"), [(1, 2, 3, 4, 5)])) is None
+    assert format_result_with_rules(QUESTION, result(["Name", '"Price" * 2'], [("a", 1), ("b", 2)])) is None
@@ -0,0 +1,133 @@
+import threading
+import time
+
+import pytest
+
+import extensions
+from extensions import TokenBucket, geocode_batch, geocode_cache, get_google_maps_loc
+
+PLACES = {"cuernavaca, morelos": {"lat": 18.92, "lng": -99.23}, "centro, san luis potosi": {"lat": 22.15, "lng": -100.98}}
+
+
+class FakeMaps:
+    def __init__(self, fail=()):
+        self.calls = []
+        self.fail = set(fail)
+
+    def geocode(self, address):
+        self.calls.append(address)
+        if address in self.fail:
+            raise ConnectionError("Geocoding service unavailable")
+        location = PLACES.get(address.lower())
+        return [{"geometry": {"location": location}}] if location else []
+
+
+@pytest.fixture
+def maps(monkeypatch):
+    fake = FakeMaps()
+    monkeypatch.setattr(extensions, 'gmaps', fake)
+    return fake
+
+
+def test_found_addresses_are_geocoded_once(maps):
+    assert get_google_maps_loc("Centro, San Luis Potosi") == (22.15, -100.98)
+    assert get_google_maps_loc("  centro,   SAN LUIS POTOSI ") == (22.15, -100.98)
+
+    assert maps.calls == ["Centro, San Luis Potosi"]
+
+
+def test_unknown_addresses_are_cached_until_the_negative_ttl(maps, monkeypatch):
+    assert get_google_maps_loc("Nowhere") is None
+    assert get_google_maps_loc("Nowhere") is None
+    assert maps.calls == ["Nowhere"]
+
+    monkeypatch.setattr(geocode_cache, 'negative_ttl', -1)
+    assert get_google_maps_loc("Nowhere") is None
+    assert maps.calls == ["Nowhere", "Nowhere"]
+
+
+def test_the_geocoded_suffix_is_remembered_for_the_full_address(maps):
+    assert get_google_maps_loc("Calle Falsa 123, Cuernavaca, Morelos") == (18.92, -99.23)
+    assert maps.calls == ["Calle Falsa 123, Cuernavaca, Morelos", "Cuernavaca, Morelos"]
+
+    assert get_google_maps_loc("Calle Falsa 123, Cuernavaca, Morelos") == (18.92, -99.23)
+    assert geocode_cache.get("Calle Falsa 123, Cuernavaca, Morelos") == (True, 18.92, -99.23, "Cuernavaca, Morelos")
+    # The suffix was cached on its own too
+    assert get_google_maps_loc("Otra Calle 5, Cuernavaca, Morelos") == (18.92, -99.23)
+    assert maps.calls[-1] == "Otra Calle 5, Cuernavaca, Morelos"
+    assert len(maps.calls) == 3
+
+
+def test_failed_lookups_are_not_cached(monkeypatch):
+    maps = FakeMaps(fail={"Offline Street"})
+    monkeypatch.setattr(extensions, 'gmaps', maps)
+
+    assert get_google_maps_loc("Offline Street") is None
+    assert geocode_cache.get("Offline Street") is None
+    maps.fail.clear()
+    get_google_maps_loc("Offline Street")
+
+    assert maps.calls == ["Offline Street", "Offline Street"]
+
+
+def test_batches_are_geocoded_concurrently_once_per_address(monkeypatch):
+    # Each lookup waits for the other one, so they only finish if they run at the same time
+    barrier = threading.Barrier(2, timeout=5)
+    calls = []
+
+    def geocode(address):
+        calls.append(address)
+        barrier.wait()
+        return PLACES.get(address.lower()) and (1.0, 2.0)
+
+    monkeypatch.setattr(extensions, 'get_google_maps_loc', geocode)
+
+    locations = geocode_batch(["Cuernavaca, Morelos", "Nowhere", "Cuernavaca, Morelos", None])
+
+    assert locations == {"Cuernavaca, Morelos": (1.0, 2.0), "Nowhere": None}
+    assert sorted(calls) == ["Cuernavaca, Morelos", "Nowhere"]
+
+
+def test_batches_wait_at_most_the_timeout(monkeypatch):
+    release = threading.Event()
+
+    def geocode(address):
+        if address == "Slow":
+            release.wait(5)
+        return (1.0, 2.0)
+
+    monkeypatch.setattr(extensions, 'get_google_maps_loc', geocode)
+    start = time.monotonic()
+    try:
+        locations = geocode_batch(["Slow", "Fast"], timeout=0.2)
+    finally:
+        release.set()
+
+    assert time.monotonic() - start < 2
+    assert locations == {"Slow": None, "Fast": (1.0, 2.0)}
+
+
+def test_the_token_bucket_allows_a_burst_then_the_rate():
+    bucket = TokenBucket(rate=20, capacity=3)
+
+    start = time.monotonic()
+    assert all(bucket.acquire() for _ in range(3))
+    assert time.monotonic() - start < 0.04
+    assert bucket.acquire(timeout=0.01) is False
+    assert bucket.acquire(timeout=1)
+    # The fourth token took about 1 / rate seconds
+    assert time.monotonic() - start >= 0.04
+
+
+def test_maps_show_one_marker_per_row(client, user, chat_id, fake_llm, maps):
+    question = "Show the first three restaurants on a map for the geocoding test"
+    fake_llm.route(question, {"Score": 10, "Executable": "Yes", "Answer": 'SELECT "Name", "City" FROM restaurants ORDER BY "Restaurant_ID" LIMIT 3',
+                              "Location": "Yes", "ChartName": "GoogleMaps"})
+
+    answer = client.post('/chat/ask', json={'question': question, 'chat_id': chat_id, 'response_mode': 'payload'}, headers=user["headers"]).json
+
+    assert answer["message"] == "Here is the map of 3 locations"
+    coordinates = answer["visualization"]["values"]["coordinates"]
+    assert [(point["lat"], point["lng"]) for point in coordinates] == [pytest.approx((22.0 + i * 0.01, -101.0 + i * 0.01)) for i in range(3)]
+    # Known restaurants are placed from the gazetteer without geocoding
+    assert maps.calls == []
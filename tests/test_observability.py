@@ -0,0 +1,80 @@
+import re
+import threading
+
+from observability import MetricsRegistry, StageTimings, span, start_trace, trace_var, with_request_context
+
+
+def test_metrics_are_rendered_in_the_prometheus_format():
+    registry = MetricsRegistry()
+    requests = registry.counter('test_requests_total', 'Requests.', ('path',))
+    latency = registry.histogram('test_latency_seconds', 'Latency.', ('path',), buckets=(0.1, 1))
+    requests.inc(path='/a')
+    requests.inc(2, path='/b "quoted"\n')
+    latency.observe(0.05, path='/a')
+    latency.observe(0.5, path='/a')
+    latency.observe(0.1, path='/a')
+
+    assert registry.render().splitlines() == [
+        '# HELP test_requests_total Requests.',
+        '# TYPE test_requests_total counter',
+        'test_requests_total{path="/a"} 1',
+        'test_requests_total{path="/b \\"quoted\\"\\n"} 2',
+        '# HELP test_latency_seconds Latency.',
+        '# TYPE test_latency_seconds histogram',
+        # Buckets are cumulative and include their upper bound
+        'test_latency_seconds_bucket{path="/a",le="0.1"} 2',
+        'test_latency_seconds_bucket{path="/a",le="1.0"} 3',
+        'test_latency_seconds_bucket{path="/a",le="+Inf"} 3',
+        'test_latency_seconds_sum{path="/a"} 0.65',
+        'test_latency_seconds_count{path="/a"} 3',
+    ]
+
+
+def test_spans_of_worker_threads_belong_to_the_request():
+    timings = start_trace()
+    try:
+        def work():
+            with span("worker_step"):
+                pass
+
+        # Wrapped on the request thread, run on the worker
+        wrapped = with_request_context(work)
+        thread = threading.Thread(target=wrapped, name="worker")
+        thread.start()
+        thread.join()
+        with span("request_step"):
+            pass
+    finally:
+        trace_var.set(None)
+
+    assert {"worker_step", "request_step"} <= set(timings.as_dict())
+    assert ("worker_step", "worker") in [(name, thread) for name, _, _, thread in timings.spans]
+
+
+def test_stages_are_summed_and_sent_as_server_timing():
+    timings = StageTimings()
+    with timings.stage("sql"):
+        pass
+    with timings.stage("sql"):
+        pass
+
+    assert len(timings.spans) == 2
+    assert re.fullmatch(r'sql;dur=[\d.]+, total;dur=[\d.]+', timings.server_timing())
+
+
+def test_requests_are_traced_and_measured(client, user, chat_id, fake_llm):
+    question = "How many restaurants are there for the tracing test?"
+    # A statement of its own, so that no other test has cached its result
+    fake_llm.route(question, {"Score": 10, "Executable": "Yes", "Answer": 'SELECT COUNT(*) AS traced FROM restaurants', "Location": "No", "ChartName": "None"})
+
+    response = client.post('/chat/ask', json={'question': question, 'chat_id': chat_id}, headers={**user["headers"], "X-Request-ID": "trace-me"})
+
+    assert response.headers["X-Request-ID"] == "trace-me"
+    stages = dict(item.split(";dur=") for item in response.headers["Server-Timing"].split(", "))
+    assert {"history", "few_shots", "generate_sql", "execute_sql", "sql_query", "llm_route", "total"} <= set(stages)
+
+    exported = client.get('/metrics').get_data(as_text=True)
+    assert re.search(r'chatbot_http_requests_total\{endpoint="/chat/ask",method="POST",status="201"\} \d+', exported)
+    assert 'chatbot_stage_duration_seconds_count{stage="execute_sql"}' in exported
+    assert 'chatbot_llm_request_duration_seconds_count{stage="route",model="fake"}' in exported
+    assert 'chatbot_formatted_responses_total{formatter="rules"}' in exported
@@ -0,0 +1,87 @@
+import json
+import math
+import threading
+
+import pytest
+from werkzeug.serving import make_server
+
+from fake_llm_server import create_app
+from providers import LLM_MODEL, FakeProvider, OpenAIProvider, stage_model
+
+RULES = [
+    {"match": r"weather", "response": "I only know about restaurants."},
+    {"system": r"^Summarize", "response": "A summary."},
+    {"match": r"cities", "json": True, "response": {"Score": 9, "Executable": "Yes", "Answer": "SELECT 1"}},
+]
+
+
+def ask(question, system="Route the question"):
+    return [{"role": "system", "content": system}, {"role": "user", "content": question}]
+
+
+def test_the_first_matching_rule_answers():
+    provider = FakeProvider(RULES, embedding_dim=8)
+
+    assert provider.chat("route", ask("What is the weather?"), 100) == "I only know about restaurants."
+    assert provider.chat("summary", ask("Anything", system="Summarize the chat"), 100) == "A summary."
+    assert json.loads(provider.chat("route", ask("List the cities"), 100, json_mode=True))["Score"] == 9
+    # JSON rules do not answer text requests, which fall back to the echo
+    assert provider.chat("format", ask("List the cities"), 100) == "Sample answer to: List the cities"
+    # The default routing answer
+    assert json.loads(provider.chat("route", ask("Anything else"), 100, json_mode=True))["Executable"] == "Yes"
+    assert provider.stats() == {"route": 3, "summary": 1, "format": 1}
+
+
+def test_streamed_tokens_make_up_the_answer():
+    provider = FakeProvider(RULES, embedding_dim=8)
+
+    tokens = list(provider.stream_chat("format", ask("And the weather?"), 100))
+
+    assert len(tokens) == 5
+    assert "".join(tokens) == "I only know about restaurants."
+
+
+def test_embeddings_are_deterministic_unit_vectors():
+    provider = FakeProvider(embedding_dim=16)
+
+    first, second, other = provider.embed(["pizza", "pizza", "tacos"])
+
+    assert first == second != other
+    assert len(first) == 16
+    assert math.isclose(sum(value * value for value in first), 1.0)
+
+
+def test_rules_are_read_from_a_file(tmp_path):
+    path = tmp_path / "responses.json"
+    path.write_text(json.dumps(RULES))
+
+    assert FakeProvider.from_file(str(path)).chat("format", ask("weather"), 100) == "I only know about restaurants."
+
+
+def test_stages_can_use_their_own_model(monkeypatch):
+    monkeypatch.setenv('LLM_MODEL_SUMMARY', 'small-model')
+
+    assert stage_model('summary') == 'small-model'
+    assert stage_model('route') == LLM_MODEL
+
+
+@pytest.fixture
+def fake_server():
+    provider = FakeProvider(RULES, embedding_dim=8)
+    server = make_server('127.0.0.1', 0, create_app(provider), threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield provider, f"http://127.0.0.1:{server.server_port}/v1"
+    server.shutdown()
+
+
+def test_the_openai_provider_works_against_the_fake_server(fake_server):
+    provider, base_url = fake_server
+    client = OpenAIProvider(api_key='fake', base_url=base_url, embedding_model='fake-8')
+
+    assert client.chat("route", ask("Name two cities"), 100, json_mode=True) == provider.answer(ask("Name two cities"), json_mode=True)
+    assert "".join(client.stream_chat("format", ask("What about the weather?"), 100)) == "I only know about restaurants."
+    for received, expected in zip(client.embed(["pizza", "tacos"]), provider.embed(["pizza", "tacos"])):
+        assert received == pytest.approx(expected)
+    # Vectors from another endpoint are cached apart from the ones of the real API
+    assert client.embedding_namespace == f"fake-8@{base_url}"
@@ -0,0 +1,89 @@
+import pytest
+
+from extensions import QueryResultCache, db, query_result_cache, run_cached_query
+from model.test import ConsumerPreference
+
+QUERY = 'SELECT "Consumer_ID", "Preferred_Cuisine" FROM consumer_preferences ORDER BY "Preferred_Cuisine"'
+
+
+@pytest.fixture
+def preferences(app_context):
+    yield
+    ConsumerPreference.query.delete()
+    db.session.commit()
+
+
+def cuisines():
+    keys, rows, has_more, _ = run_cached_query(QUERY)
+    return [row[1] for row in rows]
+
+
+def test_results_are_served_from_the_cache_until_a_write_is_committed(preferences):
+    db.session.add(ConsumerPreference(Consumer_ID='U0', Preferred_Cuisine='Mexican'))
+    db.session.commit()
+    assert cuisines() == ['Mexican']
+    hits = query_result_cache.stats()["hits"]
+
+    db.session.add(ConsumerPreference(Consumer_ID='U0', Preferred_Cuisine='Italian'))
+    db.session.flush()
+    # Flushed but not committed: the cached result is still the committed one
+    assert cuisines() == ['Mexican']
+    assert query_result_cache.stats()["hits"] == hits + 1
+
+    db.session.commit()
+    assert cuisines() == ['Italian', 'Mexican']
+
+
+def test_rolled_back_writes_do_not_invalidate(preferences):
+    assert cuisines() == []
+    db.session.add(ConsumerPreference(Consumer_ID='U1', Preferred_Cuisine='Thai'))
+    db.session.flush()
+    db.session.rollback()
+    db.session.commit()
+    hits = query_result_cache.stats()["hits"]
+
+    assert cuisines() == []
+    assert query_result_cache.stats()["hits"] == hits + 1
+
+
+def test_bulk_deletes_invalidate(preferences):
+    db.session.add(ConsumerPreference(Consumer_ID='U2', Preferred_Cuisine='Greek'))
+    db.session.commit()
+    assert cuisines() == ['Greek']
+
+    ConsumerPreference.query.filter_by(Consumer_ID='U2').delete()
+    db.session.commit()
+
+    assert cuisines() == []
+
+
+def test_writes_to_other_tables_keep_the_entry(app_context):
+    cache = QueryResultCache(60, 100)
+    cache.set(QUERY, ["Consumer_ID"], [("U0",)])
+
+    from extensions import invalidate_query_cache
+    invalidate_query_cache(['restaurants'])
+    assert cache.get(QUERY) is not None
+
+    invalidate_query_cache(['consumer_preferences'])
+    assert cache.get(QUERY) is None
+
+
+def test_entries_expire_and_the_cached_rows_are_bounded(app_context):
+    expired = QueryResultCache(-1, 100)
+    expired.set(QUERY, ["a"], [(1,)])
+    assert expired.get(QUERY) is None
+
+    cache = QueryResultCache(60, 5)
+    cache.set("SELECT 1 FROM restaurants", ["a"], [(1,)] * 3)
+    cache.set("SELECT 2 FROM restaurants", ["a"], [(2,)] * 3)
+    cache.set("SELECT 3 FROM restaurants", ["a"], [(3,)] * 6)
+    assert cache.get("SELECT 1 FROM restaurants") is None
+    assert cache.get("SELECT 2 FROM restaurants") is not None
+    assert cache.get("SELECT 3 FROM restaurants") is None
+    assert cache.stats()["cached_rows"] == 3
+
+
+def test_whitespace_outside_literals_is_ignored():
+    assert QueryResultCache.normalize("SELECT  *\n FROM restaurants WHERE \"Name\" = 'a  b';") == "SELECT * FROM restaurants WHERE \"Name\" = 'a  b'"
+    assert QueryResultCache.tables_of('SELECT * FROM "Restaurants" JOIN ratings USING ("Restaurant_ID")') == ('ratings', 'restaurants')
@@ -0,0 +1,37 @@
+import pytest
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+from extensions import query_metrics, readonly_connection, run_readonly_query
+
+
+def test_generated_queries_cannot_write(app):
+    with pytest.raises(OperationalError, match="readonly"):
+        with readonly_connection() as connection:
+            connection.execute(text("UPDATE restaurants SET \"Price\" = 'Free'"))
+
+    keys, rows, _ = run_readonly_query('SELECT COUNT(*) FROM restaurants WHERE "Price" = \'Free\'')
+    assert rows[0][0] == 0
+
+
+def test_queries_are_measured(app):
+    before = query_metrics.stats()
+
+    run_readonly_query('SELECT "Name" FROM restaurants')
+    with pytest.raises(OperationalError):
+        run_readonly_query('SELECT * FROM missing_table')
+
+    after = query_metrics.stats()
+    assert after["checkouts"] == before["checkouts"] + 2
+    assert after["queries"] == before["queries"] + 2
+    assert after["errors"] == before["errors"] + 1
+    assert "pool" in after
+
+
+def test_data_altering_queries_are_rejected_before_running(client, user, chat_id, fake_llm):
+    question = "Make every restaurant free for the read-only test"
+    fake_llm.route(question, {"Score": 10, "Executable": "Yes", "Answer": 'UPDATE restaurants SET "Price" = \'Free\'', "Location": "No", "ChartName": "None"})
+
+    response = client.post('/chat/ask', json={'question': question, 'chat_id': chat_id}, headers=user["headers"])
+
+    assert response.status_code == 403
@@ -0,0 +1,68 @@
+from urllib.parse import parse_qs, urlparse
+
+from extensions import create_token, format_as_table, iter_table_html
+
+QUESTION = "List every rating for the table test"
+ANSWER = {"Score": 10, "Executable": "Yes", "Answer": 'SELECT "Consumer_ID", "Restaurant_ID" FROM ratings ORDER BY "Consumer_ID", "Restaurant_ID"',
+          "Location": "No", "ChartName": "None"}
+
+
+def test_headers_and_values_are_escaped():
+    table = format_as_table([("<script>alert(1)</script>", 'Tom & "Jerry"')], ["<b>Name</b>", "Owner"])
+
+    assert "<script>" not in table and "<b>" not in table
+    assert "&lt;script&gt;alert(1)&lt;/script&gt;" in table
+    assert "Tom &amp; &quot;Jerry&quot;" in table
+    assert "&lt;b&gt;Name&lt;/b&gt;" in table
+
+
+def test_rows_are_consumed_as_the_table_is_rendered():
+    consumed = []
+
+    def rows():
+        for number in range(100):
+            consumed.append(number)
+            yield (number,)
+
+    chunks = iter_table_html(rows(), ["n"], max_rows=3)
+    next(chunks)
+    assert consumed == []
+
+    table = "".join(chunks)
+    assert consumed == [0, 1, 2]
+    assert table.count("<tr>") == 3
+
+
+def test_long_tables_are_cut_and_paged(client, user, chat_id, fake_llm):
+    fake_llm.route(QUESTION, ANSWER)
+
+    answer = client.post('/chat/ask', json={'question': QUESTION, 'chat_id': chat_id}, headers=user["headers"]).json
+
+    # 90 ratings, shown up to TABLE_INLINE_ROWS
+    assert answer["message"].count("<tr>") == 1 + 50
+    assert answer["more_rows"] is True
+    [url] = answer["result_urls"]
+    assert parse_qs(urlparse(url).query) == {"statement": ["0"], "page": ["1"]}
+
+    first = client.get(url + "&page_size=40", headers=user["headers"]).json
+    last = client.get(f"{urlparse(url).path}?page=3&page_size=40", headers=user["headers"]).json
+    assert first["columns"] == ["Consumer_ID", "Restaurant_ID"]
+    assert first["rows"][0] == ["U0", 0] and len(first["rows"]) == 40 and first["has_more"] is True
+    assert last["rows"][-1] == ["U2", 29] and len(last["rows"]) == 10 and last["has_more"] is False
+
+    page = client.get(f"{urlparse(url).path}?page=2&page_size=40&format=html", headers=user["headers"])
+    assert page.mimetype == "text/html"
+    assert page.headers["X-Has-More"] == "true"
+    assert page.get_data(as_text=True).count("<tr>") == 1 + 40
+
+
+def test_result_pages_are_checked(client, user, chat_id, fake_llm):
+    fake_llm.route(QUESTION, ANSWER)
+    url = client.post('/chat/ask', json={'question': QUESTION, 'chat_id': chat_id}, headers=user["headers"]).json["result_urls"][0]
+    path = urlparse(url).path
+
+    assert client.get(path).status_code == 401
+    assert client.get(path, headers={'Authorization': f"Bearer {create_token(user['id'] + 1000)}"}).status_code == 403
+    assert client.get(f"{path}?page=0", headers=user["headers"]).status_code == 400
+    assert client.get(f"{path}?format=csv", headers=user["headers"]).status_code == 400
+    assert client.get(f"{path}?statement=1", headers=user["headers"]).status_code == 404
@@ -0,0 +1,33 @@
+from extensions import QueryResult, run_readonly_query
+
+QUERY = 'SELECT "Restaurant_ID" FROM restaurants ORDER BY "Restaurant_ID"'
+
+
+def ids(rows):
+    return [row[0] for row in rows]
+
+
+def test_rows_past_the_limit_are_not_kept(app):
+    keys, rows, has_more = run_readonly_query(QUERY, limit=10)
+
+    assert keys == ["Restaurant_ID"]
+    assert ids(rows) == list(range(10))
+    assert has_more
+
+
+def test_windows_are_read_from_the_offset(app):
+    assert ids(run_readonly_query(QUERY, limit=10, offset=20)[1]) == list(range(20, 30))
+    assert run_readonly_query(QUERY, limit=10, offset=20)[2] is False
+    assert run_readonly_query(QUERY, limit=10, offset=30)[1:] == ([], False)
+    # Exactly the limit: the result does not go on
+    assert run_readonly_query(QUERY, limit=30)[2] is False
+
+
+def test_cut_statements_are_reported():
+    result = QueryResult([("SELECT 1", ["a"], [(1,)], True), ("SELECT 2", ["a"], [(2,)], False)])
+
+    assert result.truncated == [0]
+    assert result.incomplete_statements() == [0]
+    result.inline_rows = 1
+    # Shown as one table of two rows cut at one row
+    assert result.incomplete_statements() == [0, 1]
@@ -0,0 +1,64 @@
+import random
+
+import numpy as np
+import pytest
+
+from extensions import SpatialGrid, haversine_km, run_spatial_query
+
+KEYS = ["Name", "Latitude", "Longitude"]
+generator = random.Random(19)
+# Clustered around two cities with a few isolated points, like the restaurants
+ROWS = [(f"P{i}", generator.gauss(22.15, 0.05), generator.gauss(-100.98, 0.05)) for i in range(300)] + \
+       [(f"Q{i}", generator.gauss(18.92, 0.02), generator.gauss(-99.23, 0.02)) for i in range(100)] + \
+       [(f"R{i}", generator.uniform(15, 30), generator.uniform(-115, -90)) for i in range(20)]
+GRID = SpatialGrid(KEYS, ROWS, 0.05)
+CENTERS = [(22.15, -100.98), (22.3, -101.2), (18.92, -99.23), (20.5, -100.0), (29.9, -90.1), (35.68, 139.69), (-33.9, 151.2), (89.9, 0.0)]
+
+
+def brute_force(lat, lng):
+    distances = haversine_km(lat, lng, np.array([row[1] for row in ROWS]), np.array([row[2] for row in ROWS]))
+    return sorted(zip(distances.tolist(), [row[0] for row in ROWS]))
+
+
+@pytest.mark.parametrize("lat,lng", CENTERS)
+@pytest.mark.parametrize("k", [1, 5, 50, 500])
+def test_nearest_matches_brute_force(lat, lng, k):
+    expected = brute_force(lat, lng)[:k]
+
+    rows = GRID.nearest(lat, lng, k)
+
+    assert [row[0] for row in rows] == [name for _, name in expected]
+    assert [row[-1] for row in rows] == [round(distance, 3) for distance, _ in expected]
+
+
+@pytest.mark.parametrize("lat,lng", CENTERS)
+@pytest.mark.parametrize("radius_km", [0.5, 5, 50, 1500])
+def test_within_matches_brute_force(lat, lng, radius_km):
+    expected = [name for distance, name in brute_force(lat, lng) if distance <= radius_km]
+
+    assert [row[0] for row in GRID.within(lat, lng, radius_km)] == expected
+
+
+def test_empty_grids_answer_nothing():
+    grid = SpatialGrid(KEYS, [], 0.05)
+
+    assert grid.nearest(22.15, -100.98, 3) == []
+    assert grid.within(22.15, -100.98, 10) == []
+
+
+def test_spatial_functions_are_served_from_the_index(app):
+    keys, rows, has_more = run_spatial_query("SELECT * FROM nearest_restaurants(22.0, -101.0, 3);")
+
+    assert keys == ["Name", "City", "State", "Country", "Latitude", "Longitude", "Distance_km"]
+    assert [row[0] for row in rows] == ["Restaurant 0", "Restaurant 1", "Restaurant 2"]
+    assert rows[0][-1] == 0.0
+    assert not has_more
+
+    # A consumer ID as the center, read by pages: restaurants are about 1.5 km apart
+    keys, rows, has_more = run_spatial_query("restaurants_within('U0', 4)", limit=1, offset=1)
+    assert [row[0] for row in rows] == ["Restaurant 1"]
+    assert has_more
+
+    assert run_spatial_query('SELECT "Name" FROM restaurants') is None
+    with pytest.raises(ValueError):
+        run_spatial_query("nearest_restaurants('Atlantis', 3)")
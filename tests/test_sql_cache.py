@@ -0,0 +1,142 @@
+import re
+
+import pytest
+
+import extensions
+from extensions import get_sql_cache_collection, invalidate_sql_cache, lookup_sql_cache, sql_cache_scope, store_sql_cache
+from providers import llm
+
+RESULT = ('SELECT "Name" FROM restaurants LIMIT 5', 10, 'Yes', 'No', 'None')
+
+
+@pytest.fixture(autouse=True)
+def empty_sql_cache(app):
+    invalidate_sql_cache()
+    yield
+    invalidate_sql_cache()
+
+
+@pytest.fixture
+def close_embeddings(monkeypatch):
+    # "best" and "top" are synonyms and numbers are ignored, so that such questions are close in embedding space
+    def embed(text):
+        return llm.fake_embedding(re.sub(r'\d+', '#', extensions.normalize_question(text).replace('best', 'top')))
+
+    monkeypatch.setattr(extensions, 'get_embeddings', embed)
+
+
+def test_exact_question_hits_only_in_its_scope():
+    store_sql_cache("Top 5 restaurants?", "scope-a", 1, RESULT)
+
+    assert lookup_sql_cache("  top 5   RESTAURANTS ", "scope-a") == RESULT
+    assert lookup_sql_cache("top 5 restaurants", "scope-b") is None
+
+
+def test_close_question_hits_when_its_numbers_match(close_embeddings):
+    store_sql_cache("top 5 restaurants", "scope-a", 1, RESULT)
+
+    assert lookup_sql_cache("best 5 restaurants", "scope-a") == RESULT
+    assert lookup_sql_cache("best 10 restaurants", "scope-a") is None
+    assert lookup_sql_cache("best 5 restaurants", "scope-b") is None
+
+
+def test_follow_up_questions_only_hit_exactly(close_embeddings):
+    store_sql_cache("top 5 restaurants", "scope-a", 1, RESULT)
+
+    assert lookup_sql_cache("best 5 restaurants", "scope-a", semantic=False) is None
+    assert lookup_sql_cache("top 5 restaurants", "scope-a", semantic=False) == RESULT
+
+
+def test_expired_answers_are_not_served(monkeypatch, close_embeddings):
+    monkeypatch.setattr(extensions, 'SQL_CACHE_TTL', -1)
+    store_sql_cache("top 5 restaurants", "scope-a", 1, RESULT)
+
+    assert lookup_sql_cache("best 5 restaurants", "scope-a") is None
+    assert lookup_sql_cache("top 5 restaurants", "scope-a") is None
+    assert get_sql_cache_collection().count() == 0
+
+
+def test_the_oldest_answers_are_removed_over_the_limit(monkeypatch):
+    monkeypatch.setattr(extensions, 'SQL_CACHE_MAX_ENTRIES', 10)
+    for number in range(12):
+        store_sql_cache(f"restaurants number {number}", "scope-a", 1, RESULT)
+
+    assert get_sql_cache_collection().count() <= 10
+    assert lookup_sql_cache("restaurants number 11", "scope-a") == RESULT
+    assert lookup_sql_cache("restaurants number 0", "scope-a") is None
+
+
+def test_scope_depends_on_the_latest_exchange_and_personal_examples(app, user):
+    prompt = "system prompt"
+    exchange = [{"role": "user", "content": "restaurants in A"}, {"role": "assistant", "content": "{}"}]
+    other_exchange = [{"role": "user", "content": "restaurants in B"}, {"role": "assistant", "content": "{}"}]
+
+    # Without context or personal examples, the first question of a chat is shared between users
+    assert sql_cache_scope(prompt, 1001, []) == sql_cache_scope(prompt, 1002, [])
+    assert sql_cache_scope(prompt, 1001, exchange) != sql_cache_scope(prompt, 1001, other_exchange)
+    assert sql_cache_scope(prompt, 1001, exchange) != sql_cache_scope(prompt, 1001, [])
+    assert sql_cache_scope(prompt, 1001, []) != sql_cache_scope("other prompt", 1001, [])
+
+    personal = extensions.client_chroma.get_or_create_collection(name="few_shot_user_1003", embedding_function=extensions.openai_ef)
+    personal.add(ids=["example"], embeddings=[llm.fake_embedding("example")], metadatas=[{"Question": "example"}])
+    try:
+        assert sql_cache_scope(prompt, 1003, []) != sql_cache_scope(prompt, 1002, [])
+    finally:
+        extensions.client_chroma.delete_collection("few_shot_user_1003")
+
+
+def ask(client, user, chat_id, question):
+    return client.post('/chat/ask', json={'question': question, 'chat_id': chat_id}, headers=user["headers"])
+
+
+def new_chat(app, user):
+    from extensions import db
+    from model.chat import Chat
+
+    with app.app_context():
+        chat = Chat('cache test', user["id"])
+        db.session.add(chat)
+        db.session.commit()
+        return chat.id
+
+
+def test_first_questions_of_chats_share_the_routing_answer(app, client, user, fake_llm):
+    question = "How many restaurants are in each city for the cache test?"
+    fake_llm.route(question, {"Score": 10, "Executable": "Yes", "Answer": 'SELECT "City", COUNT(*) FROM restaurants GROUP BY "City"', "Location": "No", "ChartName": "None"})
+
+    assert ask(client, user, new_chat(app, user), question).status_code == 201
+    assert ask(client, user, new_chat(app, user), question).status_code == 201
+
+    assert len(fake_llm.messages("route")) == 1
+
+
+def test_changing_the_examples_invalidates_the_cache(app, client, user, fake_llm):
+    question = "List the cities of the restaurants for the example test"
+    fake_llm.route(question, {"Score": 10, "Executable": "Yes", "Answer": 'SELECT DISTINCT "City" FROM restaurants', "Location": "No", "ChartName": "None"})
+    ask(client, user, new_chat(app, user), question)
+
+    response = client.post('/fewshot/fewshot', json={"Question": "Example question for the cache test", "Score": 10, "Executable": "Yes",
+                                                    "Answer": "SELECT 1", "Location": "No", "ChartName": "None"})
+    assert response.status_code == 201
+    try:
+        ask(client, user, new_chat(app, user), question)
+    finally:
+        client.delete(f"/fewshot/fewshot/{response.json['id']}")
+
+    assert len(fake_llm.messages("route")) == 2
+
+
+def test_negative_feedback_evicts_the_cached_answer(app, client, user, fake_llm):
+    question = "List the prices of the restaurants for the feedback test"
+    fake_llm.route(question, {"Score": 10, "Executable": "Yes", "Answer": 'SELECT DISTINCT "Price" FROM restaurants', "Location": "No", "ChartName": "None"})
+    ask(client, user, new_chat(app, user), question)
+    cached_chat = new_chat(app, user)
+    ask(client, user, cached_chat, question)
+    assert len(fake_llm.messages("route")) == 1
+
+    conversation_id = client.get(f'/chat/chats/{cached_chat}/conversations', headers=user["headers"]).json[0]["id"]
+    response = client.post('/chat/feedback', json={"conversation_id": conversation_id, "feedback_type": "negative", "feedback_comment": "Wrong column"})
+    assert response.status_code == 201
+    ask(client, user, new_chat(app, user), question)
+
+    assert len(fake_llm.messages("route")) == 2
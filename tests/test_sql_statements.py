@@ -0,0 +1,63 @@
+import threading
+
+import pytest
+
+import extensions
+from extensions import execute_sql_statements, split_sql_statements
+
+
+def test_statements_are_split_outside_literals_and_comments():
+    sql_query = """
+        -- Restaurants of the first city
+        SELECT "Name" FROM restaurants WHERE "City" = 'San Luis Potosi; SLP';
+        SELECT "Name" FROM restaurants WHERE "City" = 'Cuernavaca' -- trailing comment
+        ;;
+        /* block comment */ SELECT COUNT(*) FROM ratings
+    """
+
+    assert split_sql_statements(sql_query) == [
+        'SELECT "Name" FROM restaurants WHERE "City" = \'San Luis Potosi; SLP\'',
+        'SELECT "Name" FROM restaurants WHERE "City" = \'Cuernavaca\'',
+        'SELECT COUNT(*) FROM ratings',
+    ]
+    assert split_sql_statements("  ;\n-- nothing\n") == []
+
+
+def test_statements_with_the_same_columns_are_combined(app):
+    result = execute_sql_statements(
+        'SELECT "Name" FROM restaurants WHERE "Restaurant_ID" = 1; SELECT "Name" FROM restaurants WHERE "Restaurant_ID" = 2'
+    )
+
+    assert result.uniform
+    assert result.keys == ["Name"]
+    assert [tuple(row) for row in result.rows] == [("Restaurant 1",), ("Restaurant 2",)]
+    assert result.tables() == [(result.keys, result.rows)]
+
+
+def test_statements_with_other_columns_are_kept_apart(app):
+    result = execute_sql_statements('SELECT COUNT(*) AS total FROM restaurants; SELECT "Name" FROM restaurants WHERE "Restaurant_ID" = 3')
+
+    assert not result.uniform
+    assert [keys for keys, _ in result.tables()] == [["total"], ["Name"]]
+    assert result.keys == ["Name"] and [tuple(row) for row in result.rows] == [("Restaurant 3",)]
+    assert [[tuple(row) for row in rows] for rows in result.for_prompt()] == [[(30,)], [("Restaurant 3",)]]
+
+
+def test_statements_run_concurrently(app, monkeypatch):
+    # Each statement waits for the others, so they only finish if they run at the same time
+    barrier = threading.Barrier(3, timeout=5)
+
+    def run(statement):
+        barrier.wait()
+        return ["statement"], [(statement,)], False, None
+
+    monkeypatch.setattr(extensions, 'run_cached_query', run)
+
+    result = execute_sql_statements("SELECT 1; SELECT 2; SELECT 3")
+
+    assert [row[0] for row in result.rows] == ["SELECT 1", "SELECT 2", "SELECT 3"]
+
+
+def test_a_query_without_statements_is_rejected():
+    with pytest.raises(ValueError):
+        execute_sql_statements("-- nothing to run")
@@ -0,0 +1,46 @@
+from extensions import bump_cache_version
+
+QUESTION = "How many restaurants are there for the prompt test?"
+ANSWER = {"Score": 10, "Executable": "Yes", "Answer": 'SELECT COUNT(*) FROM restaurants', "Location": "No", "ChartName": "None"}
+
+
+def test_the_prompt_is_built_once_per_version_of_the_pdf_set(app, monkeypatch):
+    from blueprints import chat_bp
+
+    listed = []
+
+    def list_pdf_documents(user_id):
+        listed.append(user_id)
+        return {"doc-1": ("Menu", f"The menu, version {len(listed)}")}
+
+    monkeypatch.setattr(chat_bp, 'list_pdf_documents', list_pdf_documents)
+
+    first = chat_bp.get_system_prompt(2001)
+    assert chat_bp.get_system_prompt(2001) is first
+    assert "Menu (Document ID: doc-1)" in first
+    assert listed == [2001]
+
+    bump_cache_version("user_2001_pdfs")
+    updated = chat_bp.get_system_prompt(2001)
+
+    assert "The menu, version 2" in updated
+    assert listed == [2001, 2001]
+    # The prompt of the stale version is dropped
+    assert [key for key in chat_bp.system_prompts if key[0] == 2001] == [(2001, 1)]
+
+
+def test_routing_messages_only_grow_at_the_end(client, user, chat_id, fake_llm):
+    follow_up = "And how many ratings are there for the prompt test?"
+    fake_llm.route(QUESTION, ANSWER)
+    fake_llm.route(follow_up, {**ANSWER, "Answer": 'SELECT COUNT(*) FROM ratings'})
+
+    client.post('/chat/ask', json={'question': QUESTION, 'chat_id': chat_id}, headers=user["headers"])
+    client.post('/chat/ask', json={'question': follow_up, 'chat_id': chat_id}, headers=user["headers"])
+
+    first, second = fake_llm.messages("route")
+    # The examples depend on the question and sit right before it, the rest is a stable prefix
+    assert first[-2]["content"].startswith("The following are examples")
+    assert second[:len(first) - 2] == first[:-2]
+    assert second[len(first) - 2]["content"] == QUESTION
+    assert second[-2]["content"].startswith("The following are examples")
+    assert second[-1]["content"] == follow_up
@@ -0,0 +1,49 @@
+import json
+
+from extensions import CODE_TEMPLATES, db
+from model.chat import Conversation
+
+QUESTION = "Show a bar chart of the number of restaurants per city for the storage test"
+ANSWER = {"Score": 10, "Executable": "Yes", "Answer": 'SELECT "City", COUNT(*) FROM restaurants GROUP BY "City" ORDER BY "City"',
+          "Location": "No", "ChartName": "BarChart"}
+
+
+def test_visualizations_are_stored_as_payloads_and_rendered_when_read(app, client, user, chat_id, fake_llm):
+    fake_llm.route(QUESTION, ANSWER)
+
+    answer = client.post('/chat/ask', json={'question': QUESTION, 'chat_id': chat_id}, headers=user["headers"]).json
+
+    with app.app_context():
+        conversation = Conversation.query.filter_by(chat_id=chat_id).one()
+        assert conversation.response == "Here is your BarChart: [BarChart of 3 points shown to the user]"
+        assert conversation.visualization["values"]["data"] == [
+            {"labelX": "Ciudad Victoria", "labelY": 10}, {"labelX": "Cuernavaca", "labelY": 10}, {"labelX": "San Luis Potosi", "labelY": 10}
+        ]
+    [listed] = client.get(f'/chat/chats/{chat_id}/conversations', headers=user["headers"]).json
+    assert listed["response"] == answer["message"]
+    assert listed["response"].startswith("Here is your BarChart: ")
+
+
+def test_the_history_holds_the_placeholder_instead_of_the_code(client, user, chat_id, fake_llm):
+    fake_llm.route(QUESTION, ANSWER)
+    client.post('/chat/ask', json={'question': QUESTION, 'chat_id': chat_id}, headers=user["headers"])
+
+    # Five columns so that the formatting model, which sees the earlier answers, writes the answer
+    follow_up = "List the names, cities, states, countries and prices of two restaurants for the storage test"
+    fake_llm.route(follow_up, {"Score": 10, "Executable": "Yes", "Answer": 'SELECT "Name", "City", "State", "Country", "Price" FROM restaurants LIMIT 2',
+                               "Location": "No", "ChartName": "None"})
+    client.post('/chat/ask', json={'question': follow_up, 'chat_id': chat_id}, headers=user["headers"])
+
+    prompt = json.dumps(fake_llm.messages("format")[-1])
+    assert "[BarChart of 3 points shown to the user]" in prompt
+    assert CODE_TEMPLATES["chart"].segments[0].strip()[:20] not in prompt
+
+
+def test_templates_are_rendered_with_their_current_source(app, chat_id):
+    with app.app_context():
+        visualization = {"template": "map", "version": "old", "caption": "Here is the map", "values": {"coordinates": [{"lat": 1, "lng": 2}], "type": "normal"}}
+        conversation = Conversation(chat_id, "Where?", "Here is the map: [normal map of 1 points shown to the user]", 'SELECT 1', visualization=visualization)
+        db.session.add(conversation)
+        db.session.commit()
+
+        assert conversation.rendered_response == f"Here is the map: {CODE_TEMPLATES['map'].render(visualization['values'])}"